@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Compare the Zarr compression profiles on the sample MOGREPS-UK files.
+
+For each NetCDF file in data/mogreps and each profile in
+subset.COMPRESSION_PROFILES, report the compression ratio (uncompressed
+bytes / compressed bytes) and the wall time taken to compress and write
+the data to an in-memory Zarr store.
+
+Usage: python benchmarks/compression.py [--num-threads N]
+"""
+
+import argparse
+import glob
+import time
+
+import pandas as pd
+import zarr
+
+import xarray as xr
+from metoffice_ec2 import subset
+
+
+def store_size_bytes(store: zarr.MemoryStore) -> int:
+    return sum(len(value) for value in store.values())
+
+
+def benchmark_file(path: str, num_threads=None) -> pd.DataFrame:
+    dataset = xr.open_dataset(path).load()
+    var_name = subset.get_variable_name(dataset)
+    uncompressed_bytes = dataset[var_name].nbytes
+    results = []
+    for profile in subset.COMPRESSION_PROFILES:
+        store = zarr.MemoryStore()
+        time_start = time.time()
+        subset.write_zarr(dataset, store, compression=profile, num_threads=num_threads)
+        wall_time = time.time() - time_start
+        results.append(
+            {
+                "variable": var_name,
+                "profile": profile,
+                "ratio": uncompressed_bytes / store_size_bytes(store),
+                "wall_time_secs": wall_time,
+            }
+        )
+    return pd.DataFrame(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args()
+    paths = sorted(glob.glob("data/mogreps/*.nc"))
+    results = pd.concat([benchmark_file(path, args.num_threads) for path in paths])
+    print(results.to_string(index=False, float_format="{:.2f}".format))
+
+
+if __name__ == "__main__":
+    main()
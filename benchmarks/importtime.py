@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Profile the import time of the entry points, with `python -X importtime`.
+
+Each module is imported in a fresh interpreter, so nothing is already
+imported.  Reports the total import time of each module, and the slowest
+modules it imports (by cumulative time, only counting the outermost import
+of each package).
+
+Usage: python benchmarks/importtime.py [--top N] [MODULE ...]
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import List, Tuple
+
+import pandas as pd
+
+# `scripts.ec2` must be run from the root of the repository.
+DEFAULT_MODULES = [
+    "metoffice_ec2.cli",
+    "scripts.ec2",
+    "metoffice_ec2.predict",
+    "metoffice_ec2.nwp_plot",
+]
+
+
+def importtime(module: str) -> List[Tuple[str, int, float]]:
+    """Import `module` in a new interpreter.
+
+    Returns:
+      (imported module, nesting depth, cumulative import time in
+      milliseconds) for every module imported, in the order their imports
+      finished.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(cumulative_us) / 1000))
+    return imports
+
+
+def profile(module: str, top: int) -> pd.DataFrame:
+    imports = importtime(module)
+    index = next(i for i, (name, depth, _) in enumerate(imports) if name == module)
+    total_ms = imports[index][2]
+    # A module's imports are listed just before it, nested one level deeper.
+    # Only the first level is shown, so that e.g. xarray and the pandas it
+    # imports aren't both counted.  Imports by `site` are excluded.
+    direct = []
+    for name, depth, ms in reversed(imports[:index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            direct.append((name, ms))
+    direct.sort(key=lambda name_ms: name_ms[1], reverse=True)
+    rows = [{"module": module, "imports": "(total)", "import_time_ms": total_ms}]
+    rows.extend(
+        {"module": module, "imports": name, "import_time_ms": ms}
+        for name, ms in direct[:top]
+    )
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of slowest imports to show."
+    )
+    args = parser.parse_args()
+    results = pd.concat([profile(module, args.top) for module in args.modules])
+    print(results.to_string(index=False, float_format="{:.1f}".format))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Verify the lossy quantizations on the sample MOGREPS-UK and UKV files.
+
+For each NetCDF file in data/mogreps and data/ukv, write the data to an
+in-memory Zarr store with each candidate quantization (see
+subset.QUANTIZATIONS), read it back, and report the maximum absolute
+error and the size saving compared with lossless storage using the same
+compression profile.
+
+Usage: python benchmarks/quantization.py [--compression PROFILE]
+"""
+
+import argparse
+import glob
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import zarr
+
+import xarray as xr
+from metoffice_ec2 import subset
+
+
+def store_size_bytes(store: zarr.MemoryStore) -> int:
+    return sum(len(value) for value in store.values())
+
+
+def candidates(data_array: xr.DataArray) -> List[Dict]:
+    # int16 covers 65535 steps, so centre the offset on the data.
+    offset = float(np.round(np.nanmean(data_array.values)))
+    return [
+        {"method": "quantize", "precision": 0.1},
+        {"method": "quantize", "precision": 0.01},
+        {"method": "float16"},
+        {"method": "scale_offset", "precision": 0.01, "offset": offset},
+    ]
+
+
+def verify_file(path: str, compression: str) -> pd.DataFrame:
+    dataset = xr.open_dataset(path).load()
+    var_name = subset.get_variable_name(dataset)
+    lossless_store = zarr.MemoryStore()
+    subset.write_zarr(dataset, lossless_store, compression=compression)
+    lossless_bytes = store_size_bytes(lossless_store)
+    results = []
+    for quantization in candidates(dataset[var_name]):
+        result = {
+            "variable": var_name,
+            "quantization": ", ".join(
+                "{}={}".format(key, value) for key, value in quantization.items()
+            ),
+            "max_abs_error": np.nan,
+            "saving_percent": np.nan,
+        }
+        results.append(result)
+        store = zarr.MemoryStore()
+        try:
+            subset.write_zarr(
+                dataset, store, compression=compression, quantization=quantization
+            )
+        except ValueError:
+            # The values are out of range (NaN in the report).
+            continue
+        loaded = xr.open_zarr(store)[var_name].values
+        error = np.abs(loaded.astype(np.float64) - dataset[var_name].values)
+        result["max_abs_error"] = np.nanmax(error)
+        result["saving_percent"] = 100 * (1 - store_size_bytes(store) / lossless_bytes)
+    return pd.DataFrame(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--compression",
+        default="archive",
+        choices=list(subset.COMPRESSION_PROFILES),
+    )
+    args = parser.parse_args()
+    paths = sorted(glob.glob("data/mogreps/*.nc") + glob.glob("data/ukv/*.nc"))
+    results = pd.concat([verify_file(path, args.compression) for path in paths])
+    print(results.to_string(index=False, float_format="{:.4g}".format))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""Benchmark the ingest hot path on the sample data in data/.
+
+Runs each stage of the pipeline (load_netcdf, subset, write_zarr, predict
+and predict_as_geojson) against the bundled sample files, entirely
+offline, and reports wall time, peak memory and output size per stage.
+With --dest-url, also times saving each subset to that fsspec URL (the
+"save" stage), e.g. "memory://benchmark" for the CPU cost alone,
+"file:///mnt/nvme/tmp" for local disk, or "s3://<bucket>" to include the
+network cost.  The stores saved are deleted afterwards.
+
+Usage:
+  # Run the benchmarks and save the results:
+  python benchmarks/run.py --output results.json
+  # Compare two sets of saved results:
+  python benchmarks/run.py --compare before.json after.json
+  # Benchmark the working tree against another commit:
+  python benchmarks/run.py --against master
+  # Include the cost of saving to S3:
+  python benchmarks/run.py --dest-url s3://<bucket>
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import zarr
+
+from metoffice_ec2 import predict, storage, subset
+from metoffice_ec2.message import MetOfficeMessage
+
+# Same as DEFAULT_GEO_BOUNDARY in scripts/ec2.py.
+GEO_BOUNDARY = {
+    "north": 668920.2182797253,
+    "south": -742783.9449856092,
+    "east": 494613.07597373443,
+    "west": -611744.985010537,
+}
+NETCDF_PATHS = sorted(glob.glob("data/mogreps/*.nc") + glob.glob("data/ukv/*.nc"))
+IRRADIANCE_PATHS = [
+    "data/ukv/2020-06-04T090000Z-2020-06-04T170000Z-a45a52ba68fde0503738548205742728477e9db7.nc",
+    "data/mogreps/MOGREPS-UK__surface_downwelling_shortwave_flux_in_air__2020-09-08T12__2020-09-08T13.zarr.zip",
+]
+MODEL_PATH = "model/predict_pv_yield_nwp.csv"
+SQS_MESSAGE_PATH = "data/sqs_messages/mogreps_uk_wind_speed_10m.json"
+
+
+def measure(func: Callable, repeats: int) -> Tuple[object, float, float]:
+    """Run `func` `repeats` times.
+
+    Returns:
+      The result of the last call, the fastest wall time in seconds, and
+      the peak memory allocated during the last call, in megabytes.
+    """
+    wall_times = []
+    for _ in range(repeats):
+        tracemalloc.start()
+        time_start = time.perf_counter()
+        result = func()
+        wall_times.append(time.perf_counter() - time_start)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, min(wall_times), peak_bytes / 1e6
+
+
+def store_size_bytes(store: zarr.MemoryStore) -> int:
+    return sum(len(value) for value in store.values())
+
+
+def benchmark_ingest(
+    path: str, compression: str, repeats: int, dest_url: Optional[str] = None
+) -> List[Dict]:
+    with open(SQS_MESSAGE_PATH) as f:
+        mo_message = MetOfficeMessage(json.load(f))
+    with open(path, "rb") as f:
+        netcdf_bytes = f.read()
+
+    def load():
+        return mo_message.load_netcdf(netcdf_bytes).load()
+
+    dataset, load_secs, load_mb = measure(load, repeats)
+
+    def subset_dataset():
+        return subset.subset(dataset, **GEO_BOUNDARY).load()
+
+    subset_ds, subset_secs, subset_mb = measure(subset_dataset, repeats)
+
+    def write():
+        store = zarr.MemoryStore()
+        subset.write_zarr(subset_ds, store, compression=compression)
+        return store
+
+    store, write_secs, write_mb = measure(write, repeats)
+
+    name = os.path.basename(path)
+    results = [
+        _result(name, "load_netcdf", load_secs, load_mb, dataset.nbytes),
+        _result(name, "subset", subset_secs, subset_mb, subset_ds.nbytes),
+        _result(name, "write_zarr", write_secs, write_mb, store_size_bytes(store)),
+    ]
+    if dest_url is not None:
+        results.append(benchmark_save(name, subset_ds, compression, repeats, dest_url))
+    return results
+
+
+def benchmark_save(
+    name: str, subset_ds, compression: str, repeats: int, dest_url: str
+) -> Dict:
+    dest = storage.Storage(dest_url)
+    fs = dest.filesystem()
+    # Each repeat writes a new store, under a directory of its own.
+    benchmark_dir = dest.path("benchmark-" + uuid.uuid4().hex)
+    zarr_filenames = []
+
+    def save():
+        full_zarr_filename = subset.get_zarr_filename(
+            subset_ds, "{}/{}".format(benchmark_dir, len(zarr_filenames))
+        )
+        zarr_filenames.append(full_zarr_filename)
+        subset.write_zarr_to_s3(
+            subset_ds,
+            full_zarr_filename,
+            fs,
+            check_exists=False,
+            compression=compression,
+        )
+
+    try:
+        _, save_secs, save_mb = measure(save, repeats)
+        output_bytes = fs.du(zarr_filenames[-1])
+    finally:
+        if fs.exists(benchmark_dir):
+            fs.rm(benchmark_dir, recursive=True)
+    return _result(name, "save", save_secs, save_mb, output_bytes)
+
+
+def benchmark_predict(path: str, repeats: int) -> List[Dict]:
+    irradiance_dataset = predict.load_irradiance_data(path).load()
+    model_df = predict.load_model(MODEL_PATH)
+
+    predictions, predict_secs, predict_mb = measure(
+        lambda: predict.predict(irradiance_dataset, model_df), repeats
+    )
+    feature_collection, geojson_secs, geojson_mb = measure(
+        lambda: predict.predict_as_geojson(irradiance_dataset, model_df), repeats
+    )
+
+    name = os.path.basename(path)
+    return [
+        _result(
+            name,
+            "predict",
+            predict_secs,
+            predict_mb,
+            predictions.memory_usage(deep=True).sum(),
+        ),
+        _result(
+            name,
+            "predict_as_geojson",
+            geojson_secs,
+            geojson_mb,
+            len(json.dumps(feature_collection)),
+        ),
+    ]
+
+
+def _result(name, stage, wall_time_secs, peak_memory_mb, output_bytes) -> Dict:
+    return {
+        "file": name,
+        "stage": stage,
+        "wall_time_secs": wall_time_secs,
+        "peak_memory_mb": peak_memory_mb,
+        "output_mb": output_bytes / 1e6,
+    }
+
+
+def run(compression: str, repeats: int, dest_url: Optional[str] = None) -> pd.DataFrame:
+    results = []
+    for path in NETCDF_PATHS:
+        results.extend(benchmark_ingest(path, compression, repeats, dest_url))
+    for path in IRRADIANCE_PATHS:
+        results.extend(benchmark_predict(path, repeats))
+    return pd.DataFrame(results)
+
+
+def compare(before: pd.DataFrame, after: pd.DataFrame) -> pd.DataFrame:
+    """Join two sets of results, with the ratio after / before per metric."""
+    merged = before.merge(after, on=["file", "stage"], suffixes=("_before", "_after"))
+    for metric in ["wall_time_secs", "peak_memory_mb", "output_mb"]:
+        merged[metric + "_ratio"] = (
+            merged[metric + "_after"] / merged[metric + "_before"]
+        )
+    return merged
+
+
+def run_against(git_ref: str, args) -> pd.DataFrame:
+    """Run this script on `git_ref`, checked out into a temporary worktree."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        worktree = os.path.join(tmp_dir, "worktree")
+        output = os.path.join(tmp_dir, "results.json")
+        subprocess.run(
+            ["git", "worktree", "add", "--detach", worktree, git_ref], check=True
+        )
+        try:
+            subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--output",
+                    output,
+                    "--compression",
+                    args.compression,
+                    "--repeats",
+                    str(args.repeats),
+                ],
+                cwd=worktree,
+                env=dict(os.environ, PYTHONPATH=worktree),
+                check=True,
+            )
+        finally:
+            subprocess.run(
+                ["git", "worktree", "remove", "--force", worktree], check=True
+            )
+        return pd.read_json(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="Save the results to this JSON file.")
+    parser.add_argument("--compression", default="archive")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument(
+        "--dest-url", help="Also time saving each subset to this fsspec URL."
+    )
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare results."
+    )
+    parser.add_argument("--against", metavar="GIT_REF", help="Compare with a commit.")
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = [pd.read_json(path) for path in args.compare]
+        results = compare(before, after)
+    else:
+        results = run(args.compression, args.repeats, args.dest_url)
+        if args.output:
+            results.to_json(args.output, orient="records", indent=2)
+        if args.against:
+            results = compare(run_against(args.against, args), results)
+    print(results.to_string(index=False, float_format="{:.3f}".format))
+
+
+if __name__ == "__main__":
+    main()
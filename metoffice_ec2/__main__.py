@@ -0,0 +1,5 @@
+import sys
+
+from metoffice_ec2.cli import main
+
+sys.exit(main())
@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Iterable, List, Mapping, MutableMapping, Optional, TypeVar
+
+_LOG = logging.getLogger("metoffice_ec2")
+
+T = TypeVar("T")
+
+# Written last when copying a Zarr store, so that a store with consolidated
+# metadata is always complete (see manifest.Manifest.rebuild).
+ZARR_CONSOLIDATED_METADATA_KEY = ".zmetadata"
+
+
+async def run_blocking(executor: Optional[Executor], func: Callable[..., T], *args) -> T:
+    """Run a blocking function (e.g. a boto3 call) in `executor`, without
+    blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args))
+
+
+async def gather_bounded(
+    funcs: Iterable[Callable[[], T]],
+    max_concurrency: int,
+    executor: Optional[Executor] = None,
+) -> List[T]:
+    """Call each blocking function in `executor`, with at most
+    `max_concurrency` running at once.
+
+    Returns:
+      The functions' return values, in order.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(func):
+        async with semaphore:
+            return await run_blocking(executor, func)
+
+    return await asyncio.gather(*(run(func) for func in funcs))
+
+
+def copy_store(
+    source: Mapping[str, bytes],
+    dest: MutableMapping,
+    max_concurrency: int = 16,
+) -> int:
+    """Copy every key of a Zarr store to `dest`, e.g. an s3fs.S3Map, with
+    up to `max_concurrency` writes in flight.
+
+    The consolidated metadata is copied after everything else.  Must not
+    be called from a running event loop.
+
+    Returns:
+      The number of bytes copied.
+    """
+    keys = [key for key in source if key != ZARR_CONSOLIDATED_METADATA_KEY]
+
+    def copy(key: str) -> int:
+        value = source[key]
+        dest[key] = value
+        return len(value)
+
+    async def copy_all() -> int:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            sizes = await gather_bounded(
+                [functools.partial(copy, key) for key in keys],
+                max_concurrency,
+                executor,
+            )
+            if ZARR_CONSOLIDATED_METADATA_KEY in source:
+                sizes.append(
+                    await run_blocking(executor, copy, ZARR_CONSOLIDATED_METADATA_KEY)
+                )
+        return sum(sizes)
+
+    num_bytes = asyncio.run(copy_all())
+    _LOG.debug("Copied %d keys (%d bytes) of Zarr store", len(source), num_bytes)
+    return num_bytes
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import IO, Dict, Iterable, Iterator, List, Optional
+
+
+def sqs_message_from_notification(notification: Dict) -> Dict:
+    """Wrap an SNS notification in an SQS message, as SQS would deliver it,
+    so it can be passed to `message.MetOfficeMessage`."""
+    body = json.dumps(notification)
+    return {
+        "MessageId": notification["MessageId"],
+        "Body": body,
+        "MD5OfBody": hashlib.md5(body.encode("utf-8")).hexdigest(),
+        "Attributes": {"ApproximateReceiveCount": "1"},
+    }
+
+
+def _archive_files(path: str) -> List[str]:
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        os.path.join(directory, filename)
+        for directory, _, filenames in os.walk(path)
+        for filename in filenames
+        if not filename.startswith(".")
+    )
+
+
+def _read_json_objects(file: IO[str]) -> List[Dict]:
+    """A file can hold one JSON object, a JSON list of them, or one JSON
+    object per line."""
+    text = file.read()
+    try:
+        loaded = json.loads(text)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return loaded if isinstance(loaded, list) else [loaded]
+
+
+def read_archive(paths: Iterable[str]) -> Iterator[Dict]:
+    """Read archived notifications, e.g. those in data/sns_messages and
+    data/sqs_messages.
+
+    Args:
+      paths: JSON files, or directories of them (searched recursively, in
+        filename order).  Each file holds SNS notifications or SQS
+        messages: see `_read_json_objects`.
+
+    Yields:
+      SQS messages, for `message.MetOfficeMessage`.  SNS notifications are
+      wrapped as if delivered once.
+    """
+    for path in paths:
+        for filename in _archive_files(path):
+            with open(filename) as file:
+                objects = _read_json_objects(file)
+            for obj in objects:
+                if "Body" in obj:
+                    obj.setdefault("Attributes", {})
+                    obj["Attributes"].setdefault("ApproximateReceiveCount", "1")
+                    yield obj
+                elif obj.get("Type") == "Notification":
+                    yield sqs_message_from_notification(obj)
+                else:
+                    raise ValueError(
+                        "Not an SNS notification or SQS message in {}".format(filename)
+                    )
+
+
+class Checkpoint:
+    """Records which archived messages have been processed, so that an
+    interrupted backfill can be resumed.
+
+    Each message's ID is appended to the file (one per line) and flushed as
+    soon as the message has been processed.  Not safe to share between
+    processes.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Args:
+          path: The checkpoint file.  Created if it doesn't exist.  If None,
+            nothing is saved.
+        """
+        self.path = path
+        self._done = set()
+        self._file = None
+        if path is not None:
+            if os.path.exists(path):
+                with open(path) as file:
+                    self._done.update(line.strip() for line in file if line.strip())
+            self._file = open(path, "a")
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._done
+
+    def add(self, message_id: str):
+        self._done.add(message_id)
+        if self._file is not None:
+            self._file.write(message_id + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Throughput:
+    """Counts the messages and bytes processed by a backfill, by outcome
+    (e.g. 'written', 'existing', 'failed').  Thread-safe."""
+
+    def __init__(self):
+        self.time_start = time.time()
+        self.counts: Dict[str, int] = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def add(self, outcome: str, bytes_in: int = 0, bytes_out: int = 0):
+        with self._lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def summary(self) -> Dict[str, float]:
+        """The counts by outcome, and the rates since the backfill started:
+        files_per_sec counts the files written, and mb_per_sec the NetCDF
+        megabytes read."""
+        with self._lock:
+            elapsed_secs = max(time.time() - self.time_start, 1e-9)
+            summary: Dict[str, float] = dict(self.counts)
+            summary["elapsed_secs"] = elapsed_secs
+            summary["files_per_sec"] = self.counts.get("written", 0) / elapsed_secs
+            summary["mb_per_sec"] = self.bytes_in / 1e6 / elapsed_secs
+            summary["mb_out_per_sec"] = self.bytes_out / 1e6 / elapsed_secs
+        return summary
+
+    def __str__(self) -> str:
+        summary = self.summary()
+        counts = ", ".join(
+            "{} {}".format(count, outcome)
+            for outcome, count in sorted(self.counts.items())
+        )
+        return "{} in {:.1f} s: {:.2f} files/s, {:.1f} MB/s in, {:.1f} MB/s out".format(
+            counts or "nothing",
+            summary["elapsed_secs"],
+            summary["files_per_sec"],
+            summary["mb_per_sec"],
+            summary["mb_out_per_sec"],
+        )
@@ -0,0 +1,152 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Iterator, MutableMapping, Optional
+
+DEFAULT_MAX_SIZE_MB = 10000
+
+
+class ChunkCache(MutableMapping):
+    """Read-through, on-disk cache around a Zarr store, e.g. an fsspec mapper.
+
+    Every key read from the store (chunks and metadata) is saved in
+    `cache_dir`, so opening the same Zarr store again, e.g. in the next
+    plotting or backtest run, reads from local disk instead of S3.  Files
+    are named by a hash of the store's path and the key, so one cache
+    directory can be shared by many stores, and by several processes.
+
+    The least recently used files are deleted once the cache is bigger
+    than `max_size_mb`.  Writes go straight to the store, replacing any
+    cached copy.  The Zarr stores written by scripts/ec2.py are never
+    modified once written, so cached keys don't go stale.
+
+    Attributes:
+        hits: Number of keys read from the cache.
+        misses: Number of keys read from the store.
+    """
+
+    def __init__(
+        self,
+        store: MutableMapping,
+        cache_dir: str,
+        max_size_mb: float = DEFAULT_MAX_SIZE_MB,
+        namespace: Optional[str] = None,
+    ):
+        """
+        Args:
+          store: The Zarr store to cache.
+          cache_dir: Directory to keep cached files in.  Created if needed.
+          max_size_mb: Maximum total size of the cached files.
+          namespace: Identifies the store in cache filenames.  Defaults to
+            the protocol and root of an fsspec mapper.
+        """
+        if namespace is None:
+            if not hasattr(store, "root"):
+                raise ValueError("A namespace is needed for stores without a root")
+            protocol = getattr(getattr(store, "fs", None), "protocol", "")
+            if not isinstance(protocol, str):
+                protocol = protocol[0]
+            namespace = "{}://{}".format(protocol, store.root)
+        self.store = store
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb * 1e6)
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # Maps cached filename to size in bytes, least recently used first.
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, filename, size in sorted(entries):
+            self._sizes[filename] = size
+        self._total_bytes = sum(self._sizes.values())
+
+    def _filename(self, key: str) -> str:
+        address = "{}/{}".format(self.namespace.rstrip("/"), key)
+        return hashlib.sha256(address.encode("utf-8")).hexdigest()
+
+    def __getitem__(self, key: str) -> bytes:
+        filename = self._filename(key)
+        path = os.path.join(self.cache_dir, filename)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            pass
+        else:
+            with self._lock:
+                self.hits += 1
+                if filename in self._sizes:
+                    self._sizes.move_to_end(filename)
+            # Other processes evict by modification time.
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            return value
+
+        value = self.store[key]
+        with self._lock:
+            self.misses += 1
+        self._save(filename, value)
+        return value
+
+    def _save(self, filename: str, value: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, os.path.join(self.cache_dir, filename))
+        with self._lock:
+            self._total_bytes += len(value) - self._sizes.pop(filename, 0)
+            self._sizes[filename] = len(value)
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_size_bytes and len(self._sizes) > 1:
+            filename, size = self._sizes.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except FileNotFoundError:
+                pass
+
+    def _discard(self, key: str):
+        filename = self._filename(key)
+        with self._lock:
+            self._total_bytes -= self._sizes.pop(filename, 0)
+        try:
+            os.remove(os.path.join(self.cache_dir, filename))
+        except FileNotFoundError:
+            pass
+
+    def __setitem__(self, key: str, value: bytes):
+        self._discard(key)
+        self.store[key] = value
+
+    def __delitem__(self, key: str):
+        self._discard(key)
+        del self.store[key]
+
+    def __contains__(self, key) -> bool:
+        if os.path.exists(os.path.join(self.cache_dir, self._filename(key))):
+            return True
+        return key in self.store
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    @property
+    def size_bytes(self) -> int:
+        """Total size of the files cached by this process and found in
+        `cache_dir` when it was opened."""
+        return self._total_bytes
@@ -0,0 +1,66 @@
+"""Command line entry point, installed as `metoffice_ec2`.
+
+Usage: metoffice_ec2 ingest
+       metoffice_ec2 backfill [--checkpoint FILE] [--workers N] ARCHIVE...
+
+Only the standard library is imported until a command has been chosen, so
+that `metoffice_ec2 --help` is instant and each command only pays for the
+imports it needs.  tests/cli_test.py enforces an import-time budget.
+"""
+
+import argparse
+import pathlib
+import runpy
+import sys
+from typing import List, Optional, Sequence
+
+# scripts/ is not installed as a package, so is found relative to this file
+# (e.g. in the Docker image, which installs metoffice_ec2 with `pip install -e`).
+SCRIPTS_DIR = pathlib.Path(__file__).resolve().parent.parent / "scripts"
+
+
+def run_script(name: str, args: Sequence[str] = ()):
+    """Run a script in the scripts directory, as if with
+    `python <script> <args>`."""
+    path = SCRIPTS_DIR / name
+    if not path.exists():
+        raise FileNotFoundError(
+            "{} not found: metoffice_ec2 must be installed from a source"
+            " checkout, e.g. with `pip install -e .`".format(path)
+        )
+    sys.argv = [str(path)] + list(args)
+    runpy.run_path(str(path), run_name="__main__")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="metoffice_ec2",
+        description="Extract parts of the Met Office UKV and MOGREPS-UK NWPs"
+        " from AWS, and save to S3 as Zarr.",
+    )
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+    commands.add_parser(
+        "ingest",
+        help="Process Met Office SQS notifications until stopped (scripts/ec2.py)."
+        "  Configured with environment variables: see README.md.",
+    )
+    commands.add_parser(
+        "backfill",
+        add_help=False,
+        help="Process archived SNS/SQS notifications (scripts/ec2.py backfill)."
+        "  See `metoffice_ec2 backfill --help`.",
+    )
+    # The backfill arguments are parsed by scripts/ec2.py.
+    args, script_args = parser.parse_known_args(argv)
+    if script_args and args.command != "backfill":
+        parser.error("unrecognized arguments: {}".format(" ".join(script_args)))
+    if args.command == "ingest":
+        run_script("ec2.py")
+    elif args.command == "backfill":
+        run_script("ec2.py", ["backfill"] + script_args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from metoffice_ec2.metrics import MetricsRegistry
+
+_LOG = logging.getLogger("metoffice_ec2")
+
+# The longest visibility timeout SQS allows.
+MAX_VISIBILITY_TIMEOUT_SECS = 12 * 60 * 60
+
+
+class MemoryBudget:
+    """Bounds the (approximate) amount of memory used by in-flight work.
+
+    Callers `acquire` an amount of memory before starting a piece of work
+    and `release` it when the work is done.  `acquire` blocks until
+    enough of the budget is free.  A single request larger than the whole
+    budget is allowed through once nothing else is in flight, so that an
+    unusually large NWP file can never deadlock the pool.
+
+    Attributes:
+        max_mb: The total budget, in megabytes.
+        in_flight_mb: The amount of the budget currently in use.
+    """
+
+    def __init__(self, max_mb: float):
+        """
+        Args:
+          max_mb: The total budget, in megabytes.
+        """
+        self.max_mb = max_mb
+        self.in_flight_mb = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, mb: float):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.in_flight_mb == 0 or self.in_flight_mb + mb <= self.max_mb
+            )
+            self.in_flight_mb += mb
+
+    def release(self, mb: float):
+        with self._condition:
+            self.in_flight_mb = max(self.in_flight_mb - mb, 0.0)
+            self._condition.notify_all()
+
+
+class ProcessingTimes:
+    """Learns how long each kind of message takes to process, e.g. per
+    variable (see metrics.MessageMetrics.kind), so that `VisibilityHeartbeat`
+    can keep each message invisible for about as long as it will need.
+
+    Keeps an exponentially weighted moving mean and variance of each kind's
+    processing times, so the estimates follow changes such as bigger files
+    or a different instance type.  Thread-safe.
+    """
+
+    def __init__(self, alpha: float = 0.2, num_stddevs: float = 2.0):
+        """
+        Args:
+          alpha: Weight of each new processing time, from 0 to 1.
+          num_stddevs: `estimate` adds this many standard deviations to the
+            mean, so that most messages finish within the estimate.
+        """
+        self.alpha = alpha
+        self.num_stddevs = num_stddevs
+        # Maps kind to its mean, variance and number of processing times.
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    def record(self, kind: str, secs: float):
+        with self._lock:
+            stats = self._stats.get(kind)
+            if stats is None:
+                self._stats[kind] = {"mean": secs, "variance": 0.0, "count": 1}
+                return
+            diff = secs - stats["mean"]
+            increment = self.alpha * diff
+            stats["mean"] += increment
+            stats["variance"] = (1 - self.alpha) * (
+                stats["variance"] + diff * increment
+            )
+            stats["count"] += 1
+
+    def estimate(self, kind: str) -> Optional[float]:
+        """A generous estimate of how long a message of this kind takes to
+        process, in seconds, or None if none have been recorded."""
+        with self._lock:
+            stats = self._stats.get(kind)
+            if stats is None:
+                return None
+            return stats["mean"] + self.num_stddevs * math.sqrt(stats["variance"])
+
+    def save(self, path: str):
+        """Atomically write the learned statistics to a JSON file."""
+        with self._lock:
+            text = json.dumps(self._stats, indent=2, sort_keys=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "ProcessingTimes":
+        """Load statistics saved by `save`, e.g. by an earlier process.
+        Returns an empty ProcessingTimes if the file doesn't exist."""
+        processing_times = cls(**kwargs)
+        if os.path.exists(path):
+            with open(path) as f:
+                processing_times._stats = json.load(f)
+        return processing_times
+
+
+class _InFlightMessage:
+    def __init__(self, kind: Optional[str], added_at: float):
+        self.kind = kind
+        self.added_at = added_at
+        # When the visibility timeout will expire (unknown until extended).
+        self.deadline = added_at
+
+
+class VisibilityHeartbeat:
+    """Background thread which keeps in-flight SQS messages invisible.
+
+    When a message is registered, its visibility timeout is set: to
+    `visibility_timeout_secs` or, once `processing_times` has learned how
+    long messages of its kind take, to `safety_factor` times that (but at
+    least three beats).  Every `interval_secs`, each registered message
+    whose timeout would expire within the next two beats is extended in the
+    same way, or by `safety_factor` times its time in flight so far if
+    that's longer.  So slow messages (e.g. large multi-level files) are kept
+    invisible for long enough with few API calls, and are not redelivered
+    to another consumer while we're still working on them, while the
+    messages of a consumer which dies soon become visible again.
+
+    Use as a context manager to start and stop the thread.
+    """
+
+    def __init__(
+        self,
+        sqs,
+        queue_url: str,
+        visibility_timeout_secs: int = 600,
+        interval_secs: float = 60,
+        processing_times: Optional[ProcessingTimes] = None,
+        safety_factor: float = 2.0,
+        registry: Optional[MetricsRegistry] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+          sqs: A boto3 SQS client.
+          queue_url: The URL of the queue the messages were received from.
+          visibility_timeout_secs: The visibility timeout to set for messages
+            of unknown kinds.
+          interval_secs: Time between beats.  Must be at most half of
+            `visibility_timeout_secs`.
+          processing_times: Learned processing times, by message kind.
+          safety_factor: Multiplies the expected processing times.
+          registry: If given, the number of messages in flight and the
+            visibility timeouts set are recorded here.
+          clock: Returns the current time in seconds.  For tests.
+        """
+        if interval_secs > visibility_timeout_secs / 2:
+            raise ValueError(
+                "Heartbeat interval ({} secs) must be at most half the visibility"
+                " timeout ({} secs).".format(interval_secs, visibility_timeout_secs)
+            )
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.visibility_timeout_secs = visibility_timeout_secs
+        self.interval_secs = interval_secs
+        self.processing_times = processing_times
+        self.safety_factor = safety_factor
+        self.registry = registry
+        self.num_extensions = 0
+        self._clock = clock
+        self._in_flight: Dict[str, _InFlightMessage] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="VisibilityHeartbeat", daemon=True
+        )
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def add(self, receipt_handle: str, kind: Optional[str] = None):
+        """Register a message, and immediately extend its visibility timeout.
+
+        Args:
+          receipt_handle: The message's receipt handle.
+          kind: The kind of message, for `processing_times`.
+        """
+        with self._lock:
+            self._in_flight[receipt_handle] = _InFlightMessage(kind, self._clock())
+        self._set_in_flight_gauge()
+        self._extend(receipt_handle)
+
+    def remove(self, receipt_handle: str):
+        with self._lock:
+            self._in_flight.pop(receipt_handle, None)
+        self._set_in_flight_gauge()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def timeout_secs(self, kind: Optional[str], elapsed_secs: float = 0.0) -> int:
+        """The visibility timeout to set for a message of this kind which
+        has been in flight for `elapsed_secs`."""
+        estimate = None
+        if self.processing_times is not None and kind is not None:
+            estimate = self.processing_times.estimate(kind)
+        if estimate is None:
+            timeout = self.visibility_timeout_secs
+        else:
+            timeout = self.safety_factor * estimate
+        timeout = max(
+            timeout, self.safety_factor * elapsed_secs, 3 * self.interval_secs
+        )
+        return int(min(math.ceil(timeout), MAX_VISIBILITY_TIMEOUT_SECS))
+
+    def beat(self):
+        """Extend the visibility timeout of the registered messages which
+        would otherwise expire within the next two beats."""
+        now = self._clock()
+        with self._lock:
+            receipt_handles = [
+                receipt_handle
+                for receipt_handle, in_flight in self._in_flight.items()
+                if in_flight.deadline - now <= 2 * self.interval_secs
+            ]
+        for receipt_handle in receipt_handles:
+            self._extend(receipt_handle)
+
+    def _extend(self, receipt_handle: str):
+        now = self._clock()
+        with self._lock:
+            in_flight = self._in_flight.get(receipt_handle)
+        if in_flight is None:
+            return
+        timeout_secs = self.timeout_secs(in_flight.kind, now - in_flight.added_at)
+        try:
+            self.sqs.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=timeout_secs,
+            )
+        except Exception as e:
+            _LOG.warning("Failed to extend visibility timeout: %s", e)
+            return
+        with self._lock:
+            in_flight.deadline = now + timeout_secs
+            self.num_extensions += 1
+        if self.registry is not None:
+            kind = in_flight.kind or "unknown"
+            self.registry.increment("visibility_extensions_total", kind=kind)
+            self.registry.set_gauge(
+                "visibility_timeout_seconds", timeout_secs, kind=kind
+            )
+
+    def _set_in_flight_gauge(self):
+        if self.registry is not None:
+            self.registry.set_gauge("messages_in_flight", len(self._in_flight))
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval_secs):
+            self.beat()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,125 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Optional, Set, Tuple
+
+import fsspec
+import pandas as pd
+
+import xarray as xr
+from metoffice_ec2 import storage, subset
+
+_LOG = logging.getLogger("metoffice_ec2")
+
+# (model, variable, forecast_reference_time, valid_time), with the times
+# formatted as in Zarr filenames, e.g. '2020-07-16T14'.
+ManifestKey = Tuple[str, str, str, str]
+
+_TIME_FORMAT = "%Y-%m-%dT%H"
+
+
+def key_for_dataset(dataset: xr.Dataset) -> ManifestKey:
+    """The manifest key of a subset, e.g. from `subset.subset`."""
+    return (
+        dataset.attrs["title"].split()[0],
+        subset.get_variable_name(dataset),
+        pd.Timestamp(dataset.forecast_reference_time.values).strftime(_TIME_FORMAT),
+        pd.Timestamp(dataset.time.values).strftime(_TIME_FORMAT),
+    )
+
+
+def key_for_zarr_filename(zarr_filename: str) -> Optional[ManifestKey]:
+    """Parse the manifest key from a path made by `subset.get_zarr_filename`.
+
+    Returns None if the path isn't in that format.
+    """
+    basename = os.path.basename(zarr_filename.rstrip("/"))
+    if basename.endswith(".zarr" + storage.ZIP_SUFFIX):
+        basename = basename[: -len(storage.ZIP_SUFFIX)]
+    if not basename.endswith(".zarr"):
+        return None
+    parts = basename[: -len(".zarr")].split("__")
+    if len(parts) != 4:
+        return None
+    return tuple(parts)  # type: ignore
+
+
+class Manifest:
+    """Index of the Zarr stores which have been written, in SQLite.
+
+    All keys are also kept in memory, so checking for an existing store
+    needs no network calls or disk reads.  Each key is committed to the
+    database as soon as its store has been written.  The manifest can be
+    rebuilt from a listing of the destination bucket, e.g. when starting
+    on a new machine.
+
+    Thread-safe.  Each process should open its own Manifest.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        """
+        Args:
+          path: Path of the SQLite database.  Created if it doesn't exist.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS written ("
+                " model TEXT, variable TEXT, forecast_reference_time TEXT,"
+                " valid_time TEXT, path TEXT, written_at TEXT,"
+                " PRIMARY KEY (model, variable, forecast_reference_time, valid_time))"
+            )
+        self._keys: Set[ManifestKey] = set(
+            self._connection.execute(
+                "SELECT model, variable, forecast_reference_time, valid_time"
+                " FROM written"
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: ManifestKey) -> bool:
+        return key in self._keys
+
+    def add(self, key: ManifestKey, path: str = ""):
+        """Record that the store for `key` has been written to `path`."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO written VALUES (?, ?, ?, ?, ?, ?)",
+                key + (path, datetime.now(timezone.utc).isoformat()),
+            )
+            self._keys.add(key)
+
+    def rebuild(self, s3: fsspec.AbstractFileSystem, dest_path: str) -> int:
+        """Add every complete Zarr store under `dest_path` to the manifest.
+
+        A store is complete once its consolidated metadata has been
+        written.  Zipped stores are written in one go, so are always
+        complete.  Only stores named by `subset.get_zarr_filename` are
+        recognised.
+
+        Returns:
+          The number of stores added.
+        """
+        num_added = 0
+        for path in s3.find(dest_path):
+            if path.endswith(".zarr/.zmetadata"):
+                zarr_path = path[: -len("/.zmetadata")]
+            elif path.endswith(".zarr" + storage.ZIP_SUFFIX):
+                zarr_path = path
+            else:
+                continue
+            key = key_for_zarr_filename(zarr_path)
+            if key is not None and key not in self:
+                self.add(key, zarr_path)
+                num_added += 1
+        _LOG.info("Added %d Zarr stores under %s to the manifest", num_added, dest_path)
+        return num_added
+
+    def close(self):
+        self._connection.close()
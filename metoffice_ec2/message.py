@@ -1,14 +1,60 @@
 import hashlib
 import json
 import os
-from typing import Dict
+import threading
+from collections import OrderedDict
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import boto3
+import fsspec
 import netCDF4
 import numpy as np
 import pandas as pd
 
 import xarray as xr
+from metoffice_ec2.ranged import S3RangedFile
+from metoffice_ec2.storage import ZIP_SUFFIX
+from xarray.backends.locks import HDF5_LOCK
+
+# Maps the 'model' in Met Office messages to the model name at the start
+# of the NetCDF files' 'title' attribute, which is used in Zarr filenames.
+MODEL_NAMES = {
+    "mo-atmospheric-mogreps-uk-prd": "MOGREPS-UK",
+    "mo-atmospheric-ukv-prd": "UKV",
+}
+
+# Maps each wanted NWP field name to the sets of heights (in meters) which
+# a message must include to be wanted.  An empty set means any height.
+CompiledParams = Dict[str, Tuple[FrozenSet[float], ...]]
+
+
+def compile_params(nwp_params: pd.DataFrame) -> CompiledParams:
+    """Compile the wanted NWP parameters into a lookup table for `is_wanted`.
+
+    Args:
+      nwp_params: The Numerical Weather Prediction parameters we want.
+          A Pandas DataFrame, one row per NWP field we want.  Must have
+          index set to 'name' (for the NWP field name).  Can have
+          a 'height' column.
+    """
+    compiled: Dict[str, List[FrozenSet[float]]] = {}
+    for var_name, row in nwp_params.iterrows():
+        row = row.dropna()
+        heights = frozenset(row["height"]) if "height" in row else frozenset()
+        compiled.setdefault(var_name, []).append(heights)
+    return {var_name: tuple(heights) for var_name, heights in compiled.items()}
 
 
 class MetOfficeMessage:
@@ -20,6 +66,8 @@ class MetOfficeMessage:
         sqs_message: A Dict representing the SQS message.
     """
 
+    __slots__ = ("message", "sqs_message", "_height_meters", "_height_set")
+
     def __init__(self, sqs_message: Dict):
         """
         Args:
@@ -30,6 +78,8 @@ class MetOfficeMessage:
         body_dict = json.loads(body_json_string)
         self.message = json.loads(body_dict["Message"])
         self.sqs_message = sqs_message
+        self._height_meters: Optional[np.ndarray] = None
+        self._height_set: Optional[FrozenSet[float]] = None
 
     def sqs_message_sent_timestamp(self) -> pd.Timestamp:
         """Returns the time the message was sent to the queue."""
@@ -44,43 +94,52 @@ class MetOfficeMessage:
         return int(attributes["ApproximateReceiveCount"])
 
     def height_meters(self) -> np.ndarray:
-        try:
-            height_str = self.message["height"]
-        except KeyError:
-            return np.array([])
-        height_list = height_str.split(" ")
-        height_array = np.array(height_list).astype(float)
-        return height_array
+        """Returns the heights in this message.  Parsed once, then cached."""
+        if self._height_meters is None:
+            try:
+                height_str = self.message["height"]
+            except KeyError:
+                self._height_meters = np.array([])
+            else:
+                height_list = height_str.split(" ")
+                self._height_meters = np.array(height_list).astype(float)
+        return self._height_meters
+
+    def _heights(self) -> FrozenSet[float]:
+        if self._height_set is None:
+            self._height_set = frozenset(self.height_meters().tolist())
+        return self._height_set
 
     def is_multi_level(self):
         """Return True if this message is about an NWP with multiple
         vertical levels."""
         return len(self.height_meters()) > 1
 
-    def is_wanted(self, nwp_params: pd.DataFrame, max_receive_count: int = 10) -> bool:
+    def is_wanted(
+        self,
+        nwp_params: Union[pd.DataFrame, CompiledParams],
+        max_receive_count: int = 10,
+    ) -> bool:
         """Returns True if this message describes an NWP we want.
 
         Args:
           nwp_params: The Numerical Weather Prediction parameters we want.
-              A Pandas DataFrame, one row per NWP field we want.  Must have
-              index set to 'name' (for the NWP field name).  Can have
-              a 'height' column.
+              Either the output of `compile_params` (fastest, when checking
+              many messages), or a Pandas DataFrame as described in
+              `compile_params`.
           max_receive_count: If this message has been received more than
             `max_receive_count` times, then we don't want this message.
         """
         if self.sqs_approx_receive_count() > max_receive_count:
             return False
 
-        height_meters = set(self.height_meters())
-        for var_name, row in nwp_params.iterrows():
-            if self.message["name"] != var_name:
-                continue
-            row = row.dropna()
-            if "height" in row:
-                if not height_meters.issuperset(row["height"]):
-                    continue
-            return True
-        return False
+        if isinstance(nwp_params, pd.DataFrame):
+            nwp_params = compile_params(nwp_params)
+        wanted_heights = nwp_params.get(self.message["name"])
+        if wanted_heights is None:
+            return False
+        heights = self._heights()
+        return any(required <= heights for required in wanted_heights)
 
     def source_url(self) -> str:
         """Return the URL for the NetCDF file described by this message."""
@@ -88,19 +147,103 @@ class MetOfficeMessage:
         source_key = self.message["key"]
         return os.path.join(source_bucket, source_key)
 
-    def load_netcdf(self) -> xr.Dataset:
-        """Opens the NetCDF described by this message."""
+    def download_netcdf(self, source: Optional[str] = None) -> bytes:
+        """Downloads the NetCDF described by this message into memory.
+
+        Args:
+          source: If given, read the file from `<source>/<bucket>/<key>`
+            (any fsspec URL, e.g. a local directory of archived files)
+            instead of from the Met Office's S3 bucket.
+        """
+        if source is not None:
+            with fsspec.open(os.path.join(source, self.source_url()), "rb") as file:
+                return file.read()
         boto_s3 = boto3.client("s3")
         get_obj_response = boto_s3.get_object(
             Bucket=self.message["bucket"], Key=self.message["key"]
         )
-        netcdf_bytes = get_obj_response["Body"].read()
+        return get_obj_response["Body"].read()
+
+    def ranged_file(self, **kwargs) -> S3RangedFile:
+        """Returns a file object which reads the NetCDF using range requests.
+
+        Args:
+          **kwargs: Passed to S3RangedFile.
+        """
+        return S3RangedFile(self.message["bucket"], self.message["key"], **kwargs)
+
+    def load_netcdf(
+        self, netcdf_file: Optional[Union[bytes, IO[bytes]]] = None
+    ) -> xr.Dataset:
+        """Opens the NetCDF described by this message.
+
+        Args:
+          netcdf_file: Either the NetCDF file's bytes, from `download_netcdf()`,
+            or a file object, e.g. from `ranged_file()`.  A file object is
+            opened lazily, so only the HDF5 chunks which are actually used
+            are read.  If None, the NetCDF is downloaded first.
+        """
+        if netcdf_file is None:
+            netcdf_file = self.download_netcdf()
+        if not isinstance(netcdf_file, bytes):
+            return xr.open_dataset(netcdf_file, engine="h5netcdf")
         # Adapted from
         # https://github.com/pydata/xarray/issues/1075#issuecomment-373541528
-        nc4_ds = netCDF4.Dataset("MetOffice", memory=netcdf_bytes)
+        # HDF5 isn't thread-safe, so hold xarray's HDF5 lock while opening,
+        # in case several messages are being processed in worker threads.
+        with HDF5_LOCK:
+            nc4_ds = netCDF4.Dataset("MetOffice", memory=netcdf_file)
         store = xr.backends.NetCDF4DataStore(nc4_ds)
         return xr.open_dataset(store, engine="netcdf4")
 
+    def manifest_key(self) -> Optional[Tuple[str, str, str, str]]:
+        """Returns the key of the subset of this message in a
+        manifest.Manifest, without downloading the NetCDF.
+
+        Returns None if the model isn't in MODEL_NAMES.
+        """
+        model_name = MODEL_NAMES.get(self.message["model"])
+        if model_name is None:
+            return None
+        time_format = "%Y-%m-%dT%H"
+        return (
+            model_name,
+            self.message["name"],
+            pd.Timestamp(self.message["forecast_reference_time"]).strftime(time_format),
+            pd.Timestamp(self.message["time"]).strftime(time_format),
+        )
+
+    def zarr_filename(self, dest_path: str, zipped: bool = False) -> Optional[str]:
+        """Returns the same path as `subset.get_zarr_filename` will for the
+        subset of this message, without downloading the NetCDF.
+
+        Returns None if the model isn't in MODEL_NAMES.
+        """
+        key = self.manifest_key()
+        if key is None:
+            return None
+        model_name, var_name, ref_time, valid_time = key
+        ref_timestamp = pd.Timestamp(self.message["forecast_reference_time"])
+        path = os.path.join(
+            dest_path, model_name, var_name, ref_timestamp.strftime("%Y/m%m/d%d/h%H")
+        )
+        basename = "{}__{}__{}__{}.zarr".format(
+            model_name, var_name, ref_time, valid_time
+        )
+        if zipped:
+            basename += ZIP_SUFFIX
+        return os.path.join(path, basename)
+
+    def forecast_reference_time(self) -> pd.Timestamp:
+        """Returns the start time of the forecast run."""
+        return pd.Timestamp(self.message["forecast_reference_time"])
+
+    def queue_latency_secs(self) -> float:
+        """Returns the number of seconds since the message was sent to the
+        queue."""
+        now = pd.Timestamp.utcnow().tz_localize(None)
+        return (now - self.sqs_message_sent_timestamp()).total_seconds()
+
     def object_size_mb(self) -> float:
         """Return the object size in megabytes."""
         return self.message["object_size"] / 1e6
@@ -127,6 +270,116 @@ class MetOfficeMessage:
         return string
 
 
+class RecentlySeen:
+    """Remembers the most recently processed messages.
+
+    Both the SQS MessageId (which is the same when SQS redelivers a
+    message) and the source URL (which is the same when the Met Office
+    sends duplicate notifications) are remembered.  Thread-safe.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        """
+        Args:
+          max_size: Number of messages to remember.  The least recently
+            added are forgotten first.
+        """
+        self.max_size = max_size
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _ids_of(mo_message: MetOfficeMessage) -> Tuple[str, str]:
+        return mo_message.sqs_message["MessageId"], mo_message.source_url()
+
+    def add(self, mo_message: MetOfficeMessage):
+        with self._lock:
+            for message_id in self._ids_of(mo_message):
+                self._ids[message_id] = None
+                self._ids.move_to_end(message_id)
+            while len(self._ids) > 2 * self.max_size:
+                self._ids.popitem(last=False)
+
+    def __contains__(self, mo_message: MetOfficeMessage) -> bool:
+        with self._lock:
+            return any(
+                message_id in self._ids for message_id in self._ids_of(mo_message)
+            )
+
+
+def classify_messages(
+    sqs_messages: Iterable[Dict],
+    nwp_params: Union[pd.DataFrame, CompiledParams],
+    max_receive_count: int = 10,
+) -> Tuple[List[MetOfficeMessage], List[MetOfficeMessage]]:
+    """Split a batch of SQS messages into wanted and unwanted messages.
+
+    Args:
+      sqs_messages: AWS Simple Queue Service messages, e.g. the 'Messages'
+        of a `receive_message` reply.
+      nwp_params: See `MetOfficeMessage.is_wanted`.
+      max_receive_count: See `MetOfficeMessage.is_wanted`.
+
+    Returns:
+      The wanted and the unwanted messages, in their original order.
+    """
+    if isinstance(nwp_params, pd.DataFrame):
+        nwp_params = compile_params(nwp_params)
+    wanted, unwanted = [], []
+    for sqs_message in sqs_messages:
+        mo_message = MetOfficeMessage(sqs_message)
+        if mo_message.is_wanted(nwp_params, max_receive_count):
+            wanted.append(mo_message)
+        else:
+            unwanted.append(mo_message)
+    return wanted, unwanted
+
+
+# Maps each priority which messages can be ordered by to a function which
+# returns a message's sort key.  Lower keys are processed first.
+PRIORITIES: Dict[str, Callable[[MetOfficeMessage, FrozenSet[str]], Any]] = {
+    # Messages for the variables used for inference.
+    "inference": lambda mo_message, inference_variables: (
+        mo_message.message["name"] not in inference_variables
+    ),
+    # Messages from the most recent forecast runs.
+    "freshness": lambda mo_message, _: -mo_message.forecast_reference_time().value,
+    # The smallest NetCDF files.
+    "size": lambda mo_message, _: mo_message.object_size_mb(),
+    # Messages which have been redelivered the fewest times.
+    "redeliveries": lambda mo_message, _: mo_message.sqs_approx_receive_count(),
+}
+
+
+def prioritise(
+    mo_messages: Iterable[MetOfficeMessage],
+    priorities: Sequence[str],
+    inference_variables: Iterable[str] = (),
+) -> List[MetOfficeMessage]:
+    """Order messages by priority.
+
+    Args:
+      mo_messages: The messages to order.
+      priorities: Names of PRIORITIES, most important first.  Ties are
+        broken by the next priority, and then by the original order.
+      inference_variables: The NWP field names used for inference.
+
+    Returns:
+      The messages, highest priority first.
+    """
+    for priority in priorities:
+        if priority not in PRIORITIES:
+            raise ValueError("Unrecognised priority: {}".format(priority))
+    inference_variables = frozenset(inference_variables)
+    return sorted(
+        mo_messages,
+        key=lambda mo_message: tuple(
+            PRIORITIES[priority](mo_message, inference_variables)
+            for priority in priorities
+        ),
+    )
+
+
 def _check_md5(text: str, md5_of_body: str):
     text_utf8 = text.encode("utf-8")
     md5 = hashlib.md5(text_utf8)
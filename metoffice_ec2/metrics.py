@@ -0,0 +1,219 @@
+import logging
+import os
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+_LOG = logging.getLogger("metoffice_ec2")
+
+# Label names attached to every per-message metric, in this order.
+LABEL_NAMES = ("model", "variable", "multi_level")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class MessageMetrics:
+    """Measurements made while processing a single message.
+
+    Plain data, so it can be returned from a worker process and recorded
+    in the main process's `MetricsRegistry`.
+
+    Attributes:
+        labels: Dict mapping each of LABEL_NAMES to a string.
+        stage_secs: Dict mapping stage name (e.g. 'download', 'subset')
+            to the time spent in that stage, in seconds.
+        bytes_in: Number of bytes of NetCDF downloaded.
+        bytes_subset: Uncompressed size of the subset, in bytes.
+        bytes_out: Size of the compressed Zarr written, in bytes.
+        peak_rss_mb: Peak resident set size of the process which processed
+            the message, in megabytes.
+        queue_latency_secs: Time between the message being sent to SQS and
+            processing starting, in seconds, or None if unknown.
+        work_avoided: Why the message needed no work, e.g. 'manifest' if
+            its Zarr store was already in the manifest, or None.
+    """
+
+    def __init__(self, model: str = "", variable: str = "", multi_level=False):
+        self.labels = {
+            "model": model,
+            "variable": variable,
+            "multi_level": str(bool(multi_level)).lower(),
+        }
+        self.stage_secs: Dict[str, float] = {}
+        self.bytes_in = 0
+        self.bytes_subset = 0
+        self.bytes_out = 0
+        self.peak_rss_mb = 0.0
+        self.queue_latency_secs: Optional[float] = None
+        self.work_avoided: Optional[str] = None
+
+    @classmethod
+    def from_message(cls, mo_message) -> "MessageMetrics":
+        """Call when starting to process the message, so that the queue
+        latency is measured."""
+        metrics = cls(
+            model=mo_message.message["model"],
+            variable=mo_message.message["name"],
+            multi_level=mo_message.is_multi_level(),
+        )
+        if "SentTimestamp" in mo_message.sqs_message.get("Attributes", {}):
+            metrics.queue_latency_secs = mo_message.queue_latency_secs()
+        return metrics
+
+    def kind(self) -> str:
+        """Identifies messages which take similar times to process, e.g.
+        'mo-atmospheric-mogreps-uk-prd/wind_speed/multi_level'."""
+        kind = "{}/{}".format(self.labels["model"], self.labels["variable"])
+        if self.labels["multi_level"] == "true":
+            kind += "/multi_level"
+        return kind
+
+    def add_stage(self, stage: str, secs: float):
+        self.stage_secs[stage] = self.stage_secs.get(stage, 0.0) + secs
+
+    def compression_ratio(self) -> Optional[float]:
+        if not self.bytes_out:
+            return None
+        return self.bytes_subset / self.bytes_out
+
+
+class MetricsRegistry:
+    """Aggregates `MessageMetrics` and renders them for Prometheus.
+
+    All metrics are labelled with LABEL_NAMES, so it's easy to see which
+    variables dominate the cost of processing.  Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+
+    def record(self, message_metrics: MessageMetrics, success: bool = True):
+        labels = tuple((name, message_metrics.labels[name]) for name in LABEL_NAMES)
+        status_labels = labels + (("status", "success" if success else "failure"),)
+        with self._lock:
+            self._counters[("messages_total", status_labels)] += 1
+            for stage, secs in message_metrics.stage_secs.items():
+                stage_labels = labels + (("stage", stage),)
+                self._counters[("stage_seconds_sum", stage_labels)] += secs
+                self._counters[("stage_seconds_count", stage_labels)] += 1
+            # Failures are often recorded long after processing started.
+            latency_secs = message_metrics.queue_latency_secs
+            if success and latency_secs is not None:
+                self._counters[("queue_latency_seconds_sum", labels)] += latency_secs
+                self._counters[("queue_latency_seconds_count", labels)] += 1
+            self._counters[("bytes_in_total", labels)] += message_metrics.bytes_in
+            self._counters[("bytes_out_total", labels)] += message_metrics.bytes_out
+            if message_metrics.work_avoided is not None:
+                self._counters[
+                    (
+                        "duplicate_work_avoided_total",
+                        labels + (("reason", message_metrics.work_avoided),),
+                    )
+                ] += 1
+            ratio = message_metrics.compression_ratio()
+            if ratio is not None:
+                self._gauges[("compression_ratio", labels)] = ratio
+            peak_key = ("peak_rss_megabytes", ())
+            self._gauges[peak_key] = max(
+                self._gauges.get(peak_key, 0.0), message_metrics.peak_rss_mb
+            )
+
+    def observe(self, stage: str, secs: float):
+        """Record the duration of a stage which isn't tied to one message,
+        e.g. receiving a batch of messages from SQS."""
+        stage_labels = (("stage", stage),)
+        with self._lock:
+            self._counters[("stage_seconds_sum", stage_labels)] += secs
+            self._counters[("stage_seconds_count", stage_labels)] += 1
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        """Add to a counter, e.g. the number of duplicate messages skipped
+        (labelled by LABEL_NAMES, if they're per-message)."""
+        with self._lock:
+            self._counters[(name, tuple(labels.items()))] += value
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        """Set a gauge which isn't tied to one message, e.g. the
+        utilization of a pipeline stage."""
+        with self._lock:
+            self._gauges[(name, tuple(labels.items()))] = value
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            samples = [(key, value, "counter") for key, value in self._counters.items()]
+            samples += [(key, value, "gauge") for key, value in self._gauges.items()]
+        lines = []
+        typed = set()
+        for (name, labels), value, metric_type in sorted(samples):
+            full_name = "metoffice_ec2_" + name
+            type_name = full_name
+            for suffix in ("_sum", "_count"):
+                if full_name.endswith(suffix):
+                    type_name = full_name[: -len(suffix)]
+                    metric_type = "summary"
+            if type_name not in typed:
+                lines.append("# TYPE {} {}".format(type_name, metric_type))
+                typed.add(type_name)
+            label_str = ",".join(
+                '{}="{}"'.format(key, _escape(value)) for key, value in labels
+            )
+            if label_str:
+                label_str = "{" + label_str + "}"
+            lines.append("{}{} {}".format(full_name, label_str, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Atomically write the rendered metrics to `path`."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = "") -> ThreadingHTTPServer:
+        """Serve the rendered metrics over HTTP, from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=server.serve_forever, name="MetricsServer", daemon=True
+        ).start()
+        _LOG.info("Serving metrics on port %d", server.server_address[1])
+        return server
+
+    def flush_periodically(self, path: str, interval_secs: float) -> threading.Event:
+        """Write the metrics to `path` every `interval_secs`, from a daemon
+        thread.  Set the returned Event to stop."""
+        stop_event = threading.Event()
+
+        def run():
+            while not stop_event.wait(interval_secs):
+                try:
+                    self.write(path)
+                except OSError as e:
+                    _LOG.warning("Failed to write metrics to %s: %s", path, e)
+
+        threading.Thread(target=run, name="MetricsFlusher", daemon=True).start()
+        return stop_event
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = MetricsRegistry()
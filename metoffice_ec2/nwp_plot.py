@@ -1,11 +1,14 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import IO, Any, List, Union
+from typing import IO, Any, Dict, Iterable, List, Optional, Tuple, Union
 
+import dask
 import fsspec
-from cartopy import crs as ccrs
-from matplotlib import pyplot as plt
+import numpy as np
 
 import xarray as xr
+from metoffice_ec2 import chunk_cache
 
 
 def find_zarr(
@@ -15,6 +18,20 @@ def find_zarr(
     return [dir for dir in fs.listdir(directory, detail=False) if dir.endswith(suffix)]
 
 
+def open_zarr(
+    fs: fsspec.spec.AbstractFileSystem,
+    zarr_path: str,
+    cache_dir: Optional[str] = None,
+    cache_size_mb: float = chunk_cache.DEFAULT_MAX_SIZE_MB,
+) -> xr.Dataset:
+    """Open a Zarr store found by `find_zarr`.  If `cache_dir` is set, the
+    store's chunks are cached there (see chunk_cache.ChunkCache)."""
+    store = fs.get_mapper(zarr_path)
+    if cache_dir is not None:
+        store = chunk_cache.ChunkCache(store, cache_dir, max_size_mb=cache_size_mb)
+    return xr.open_zarr(store)
+
+
 def filename_for_plot(directory, zarr_path: str, qualifier: str = "") -> str:
     """Get a suitable output filename for a plot produced from a Zarr path"""
     basename = Path(zarr_path).stem.replace(
@@ -35,6 +52,11 @@ def plot_xarray_data_array(
     dataset: xr.Dataset, da: xr.DataArray, file: IO[Any]
 ) -> None:
     """Create an image plot for a data array"""
+    # Imported here, as cartopy and matplotlib are slow to import, and
+    # only needed for plotting.
+    from cartopy import crs as ccrs
+    from matplotlib import pyplot as plt
+
     central_latitude = (
         dataset.lambert_azimuthal_equal_area.latitude_of_projection_origin[0]
     )
@@ -52,3 +74,302 @@ def plot_xarray_data_array(
     ax.gridlines(draw_labels=True)
 
     plt.savefig(file, format="png")
+
+
+def projection_origin(dataset: xr.Dataset) -> Tuple[float, float]:
+    """The (latitude, longitude) of the origin of the dataset's Lambert
+    azimuthal equal area projection."""
+    projection = dataset.lambert_azimuthal_equal_area
+    return (
+        float(np.ravel(projection.latitude_of_projection_origin)[0]),
+        float(np.ravel(projection.longitude_of_projection_origin)[0]),
+    )
+
+
+def extract_frame(dataset: xr.Dataset, height: Optional[float] = None) -> xr.DataArray:
+    """Get the data array to plot: the first realization (for MOGREPS) of
+    the dataset's gridded variable, at `height` if it has a height
+    dimension."""
+    data_array = next(
+        data_array
+        for data_array in dataset.data_vars.values()
+        if "projection_x_coordinate" in data_array.dims
+        and "projection_y_coordinate" in data_array.dims
+    )
+    if "realization" in data_array.dims:
+        data_array = data_array.isel(realization=0)
+    if height is not None:
+        data_array = data_array.sel(height=height)
+    return data_array
+
+
+class FrameRenderer:
+    """Renders many frames of data on the same grid, reusing one figure.
+
+    The figure, the projections, the coastlines and the gridlines are only
+    made once: rendering a frame just replaces the image data and saves the
+    figure.  Uses matplotlib's Agg canvas directly rather than pyplot, so
+    figures are never shown and don't accumulate.
+    """
+
+    def __init__(
+        self,
+        x_coords: np.ndarray,
+        y_coords: np.ndarray,
+        origin: Tuple[float, float],
+        cmap: str = "viridis",
+        vmin: Optional[float] = None,
+        vmax: Optional[float] = None,
+        coastline_resolution: Optional[str] = "10m",
+    ):
+        """
+        Args:
+          x_coords, y_coords: The projection coordinates of the grid.
+          origin: The grid's projection origin, from `projection_origin`.
+          cmap: The colormap.
+          vmin, vmax: The data range of the colormap.  By default, each
+            frame is scaled to its own range.
+          coastline_resolution: '10m', '50m' or '110m', or None to not draw
+            coastlines (e.g. if cartopy can't download them).
+        """
+        from cartopy import crs as ccrs
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.vmin = vmin
+        self.vmax = vmax
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(projection=ccrs.OSGB(approx=True))
+        if coastline_resolution is not None:
+            self.ax.coastlines(resolution=coastline_resolution)
+        self.ax.gridlines(draw_labels=True)
+        self.mesh = self.ax.pcolormesh(
+            x_coords,
+            y_coords,
+            np.zeros((len(y_coords), len(x_coords))),
+            transform=ccrs.LambertAzimuthalEqualArea(
+                central_latitude=origin[0], central_longitude=origin[1]
+            ),
+            cmap=cmap,
+            shading="auto",
+        )
+
+    def render(self, values: np.ndarray, file: Union[str, IO[Any]], title: str = ""):
+        """Plot a frame of data, with the shape of the grid, as a PNG."""
+        values = np.ma.masked_invalid(values)
+        self.mesh.set_array(values.ravel())
+        vmin = values.min() if self.vmin is None else self.vmin
+        vmax = values.max() if self.vmax is None else self.vmax
+        self.mesh.set_clim(vmin, vmax)
+        self.ax.set_title(title)
+        self.figure.savefig(file, format="png")
+
+    def close(self):
+        self.figure.clear()
+
+
+# The renderers made by this process, keyed by grid and style.
+_RENDERERS: "OrderedDict[Tuple, FrameRenderer]" = OrderedDict()
+
+# Number of renderers (i.e. figures) kept per process.
+MAX_CACHED_RENDERERS = 4
+
+
+def _get_renderer(
+    x_coords: np.ndarray,
+    y_coords: np.ndarray,
+    origin: Tuple[float, float],
+    renderer_kwargs: Dict[str, Any],
+) -> FrameRenderer:
+    key = (
+        x_coords.tobytes(),
+        y_coords.tobytes(),
+        origin,
+        tuple(sorted(renderer_kwargs.items())),
+    )
+    renderer = _RENDERERS.get(key)
+    if renderer is None:
+        renderer = FrameRenderer(x_coords, y_coords, origin, **renderer_kwargs)
+        _RENDERERS[key] = renderer
+        while len(_RENDERERS) > MAX_CACHED_RENDERERS:
+            _RENDERERS.popitem(last=False)[1].close()
+    else:
+        _RENDERERS.move_to_end(key)
+    return renderer
+
+
+def _frame_title(data_array: xr.DataArray) -> str:
+    if "time" in data_array.coords and data_array.time.size == 1:
+        time = np.datetime_as_string(data_array.time.values, unit="m")
+        return "{} {}".format(data_array.name, time)
+    return str(data_array.name)
+
+
+def _render_values(
+    values: np.ndarray,
+    x_coords: np.ndarray,
+    y_coords: np.ndarray,
+    origin: Tuple[float, float],
+    title: str,
+    output_path: str,
+    renderer_kwargs: Dict[str, Any],
+) -> str:
+    renderer = _get_renderer(x_coords, y_coords, origin, renderer_kwargs)
+    renderer.render(values, output_path, title)
+    return output_path
+
+
+def _render_data_array(
+    data_array: xr.DataArray,
+    origin: Tuple[float, float],
+    output_path: str,
+    renderer_kwargs: Dict[str, Any],
+) -> str:
+    data_array = data_array.transpose(
+        "projection_y_coordinate", "projection_x_coordinate"
+    )
+    # Each worker process loads one small frame at a time.  Besides, dask's
+    # thread pool can't be used in a process forked after it was started.
+    with dask.config.set(scheduler="synchronous"):
+        values = np.asarray(data_array.values)
+    return _render_values(
+        values,
+        data_array.projection_x_coordinate.values,
+        data_array.projection_y_coordinate.values,
+        origin,
+        _frame_title(data_array),
+        output_path,
+        renderer_kwargs,
+    )
+
+
+def _render_zarr_store(
+    fs: fsspec.spec.AbstractFileSystem,
+    zarr_path: str,
+    output_path: str,
+    height: Optional[float],
+    cache_dir: Optional[str],
+    renderer_kwargs: Dict[str, Any],
+) -> str:
+    dataset = open_zarr(fs, zarr_path, cache_dir=cache_dir)
+    return _render_data_array(
+        extract_frame(dataset, height),
+        projection_origin(dataset),
+        output_path,
+        renderer_kwargs,
+    )
+
+
+def _map(func, args: Iterable[Tuple], num_workers: int) -> List:
+    """Call func on each tuple of args, in `num_workers` processes (or in
+    this process, if num_workers is 1), and return the results in order."""
+    args = list(args)
+    if num_workers <= 1:
+        return [func(*func_args) for func_args in args]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(func, *zip(*args)))
+
+
+def plot_zarr_stores(
+    fs: fsspec.spec.AbstractFileSystem,
+    zarr_paths: List[str],
+    directory: str,
+    height: Optional[float] = None,
+    num_workers: int = 1,
+    animation_path: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    **renderer_kwargs,
+) -> List[str]:
+    """Plot every Zarr store, e.g. a whole run found by `find_zarr`.
+
+    The stores are loaded and plotted by `num_workers` processes, each of
+    which reuses one figure per grid (see `FrameRenderer`).
+
+    Args:
+      fs: The filesystem the stores are on.
+      zarr_paths: The stores to plot, in order.
+      directory: Where to save the plots, named by `filename_for_plot`.
+      height: The height to plot, for variables with a height dimension.
+      num_workers: Number of processes to render with.
+      animation_path: If given, also save the plots, in order, as an
+        animated GIF.
+      cache_dir: Passed to `open_zarr`.
+      **renderer_kwargs: Passed to `FrameRenderer`, e.g. `vmin` and `vmax`
+        (best set when animating, so that every frame has the same scale).
+
+    Returns:
+      The paths of the plots.
+    """
+    qualifier = "" if height is None else f"_height{height}"
+    args = [
+        (
+            fs,
+            zarr_path,
+            filename_for_plot(directory, zarr_path, qualifier=qualifier),
+            height,
+            cache_dir,
+            renderer_kwargs,
+        )
+        for zarr_path in zarr_paths
+    ]
+    output_paths = _map(_render_zarr_store, args, num_workers)
+    if animation_path is not None:
+        save_animation(output_paths, animation_path)
+    return output_paths
+
+
+def plot_frames(
+    dataset: xr.Dataset,
+    directory: str,
+    dim: str = "time",
+    height: Optional[float] = None,
+    num_workers: int = 1,
+    animation_path: Optional[str] = None,
+    **renderer_kwargs,
+) -> List[str]:
+    """Plot every step along a dimension of `dataset`, e.g. 'time' for
+    stores opened together with `xr.open_mfdataset`.
+
+    Like `plot_zarr_stores`, except that each frame is sent to a worker
+    process to be loaded (if the dataset is backed by dask) and rendered.
+    The plots are named after the dataset's variable and the step's index.
+    """
+    data_array = extract_frame(dataset, height)
+    origin = projection_origin(dataset)
+
+    def frames():
+        for i in range(data_array.sizes[dim]):
+            output_path = str(
+                Path(directory, "{}_{}{:04d}.png".format(data_array.name, dim, i))
+            )
+            yield (
+                data_array.isel({dim: i}),
+                origin,
+                output_path,
+                renderer_kwargs,
+            )
+
+    output_paths = _map(_render_data_array, frames(), num_workers)
+    if animation_path is not None:
+        save_animation(output_paths, animation_path)
+    return output_paths
+
+
+def save_animation(
+    frame_paths: List[str], animation_path: str, frame_secs: float = 0.5
+):
+    """Combine PNG frames into an animated GIF."""
+    from PIL import Image
+
+    if not frame_paths:
+        raise ValueError("No frames to animate")
+    frames = [Image.open(path) for path in frame_paths]
+    frames[0].save(
+        animation_path,
+        format="GIF",
+        save_all=True,
+        append_images=frames[1:],
+        duration=int(frame_secs * 1000),
+        loop=0,
+    )
@@ -0,0 +1,156 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from metoffice_ec2.concurrency import MemoryBudget
+
+_LOG = logging.getLogger("metoffice_ec2")
+
+# Tells a stage's worker thread to exit.
+_STOP = object()
+
+
+class Stage:
+    """One stage of a `Pipeline`.
+
+    Attributes:
+        name: Name of the stage, e.g. 'download'.
+        func: Called with each item and the output of the previous stage
+            (None for the first stage).  Returns the input for the next
+            stage, or None if the item needs no more work.
+        num_workers: Number of threads running `func`.
+        busy_secs: Time spent in `func`, summed over all workers.
+    """
+
+    def __init__(self, name: str, func: Callable[[Any, Any], Any], num_workers=1):
+        self.name = name
+        self.func = func
+        self.num_workers = num_workers
+        self.busy_secs = 0.0
+        self._lock = threading.Lock()
+
+    def add_busy_secs(self, secs: float):
+        with self._lock:
+            self.busy_secs += secs
+
+
+class Pipeline:
+    """Runs items through a sequence of stages, connected by bounded queues.
+
+    Every stage has its own worker threads, so each stage can work on a
+    different item at the same time, e.g. downloading one NWP file while
+    subsetting another.  There is backpressure at two levels: a stage
+    blocks when the queue into the next stage is full, and new items are
+    only started while the total size of the items in flight fits in the
+    `budget`.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int = 1,
+        budget: Optional[MemoryBudget] = None,
+        size_mb: Optional[Callable[[Any], float]] = None,
+    ):
+        """
+        Args:
+          stages: The stages, in order.
+          queue_size: Maximum number of items waiting in front of each stage.
+          budget: If given, limits the summed `size_mb` of the items in flight.
+          size_mb: Returns the size of an item, in megabytes.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.budget = budget
+        self.size_mb = size_mb if size_mb is not None else (lambda item: 0.0)
+        self.wall_secs = 0.0
+
+    def run(
+        self,
+        items: Iterable[Any],
+        on_done: Callable[[Any, Any, Optional[Exception]], None],
+    ):
+        """Run every item through the pipeline, and wait until all are done.
+
+        Args:
+          items: The items to process.
+          on_done: Called once for every item with the item, the output of
+            the last stage which ran, and the exception raised by a stage
+            (or None).  Called from the worker thread which finished the
+            item.
+        """
+        for stage in self.stages:
+            stage.busy_secs = 0.0
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        def finish(item, value, error):
+            try:
+                on_done(item, value, error)
+            except Exception as e:
+                _LOG.exception(e)
+            finally:
+                if self.budget is not None:
+                    self.budget.release(self.size_mb(item))
+
+        def work(stage_index: int):
+            stage = self.stages[stage_index]
+            is_last_stage = stage_index == len(self.stages) - 1
+            while True:
+                job = queues[stage_index].get()
+                if job is _STOP:
+                    return
+                item, value = job
+                time_start = time.time()
+                try:
+                    value = stage.func(item, value)
+                except Exception as e:
+                    finish(item, None, e)
+                    continue
+                finally:
+                    stage.add_busy_secs(time.time() - time_start)
+                if value is None or is_last_stage:
+                    finish(item, value, None)
+                else:
+                    queues[stage_index + 1].put((item, value))
+
+        time_start = time.time()
+        workers = []
+        for stage_index, stage in enumerate(self.stages):
+            threads = [
+                threading.Thread(
+                    target=work,
+                    args=(stage_index,),
+                    name="Pipeline-{}-{}".format(stage.name, i),
+                    daemon=True,
+                )
+                for i in range(stage.num_workers)
+            ]
+            for thread in threads:
+                thread.start()
+            workers.append(threads)
+
+        for item in items:
+            if self.budget is not None:
+                self.budget.acquire(self.size_mb(item))
+            queues[0].put((item, None))
+
+        # Each stage's queue is only stopped once every earlier stage has
+        # finished, so no item can be added after the stop signals.
+        for stage_index, threads in enumerate(workers):
+            for _ in threads:
+                queues[stage_index].put(_STOP)
+            for thread in threads:
+                thread.join()
+        self.wall_secs = time.time() - time_start
+
+    def utilization(self) -> Dict[str, float]:
+        """The fraction of the last run's duration each stage's workers
+        spent busy, from 0 to 1.  A stage close to 1 is the bottleneck."""
+        if not self.wall_secs:
+            return {stage.name: 0.0 for stage in self.stages}
+        return {
+            stage.name: stage.busy_secs / (self.wall_secs * stage.num_workers)
+            for stage in self.stages
+        }
@@ -1,9 +1,16 @@
+from collections import OrderedDict
 from datetime import datetime, timezone
-import math
+import json
+import os
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+import fsspec
+import numpy as np
 import pandas as pd
-from geojson import Feature, FeatureCollection, Point
+from geojson import FeatureCollection
 import xarray as xr
+from metoffice_ec2 import chunk_cache
 
 
 def load_model(path: str) -> pd.DataFrame:
@@ -12,39 +19,197 @@ def load_model(path: str) -> pd.DataFrame:
     return model_df
 
 
-def load_irradiance_data(path: str) -> xr.Dataset:
-    """Load the NWP irradiance data"""
+# Number of grids whose interpolation weights are cached per model.
+MAX_CACHED_GRIDS = 8
+
+
+class PVModel:
+    """A loaded PV yield model, with cached interpolation weights.
+
+    The PV system coordinates are converted to arrays once.  For each NWP
+    grid seen, the indices of the four grid points surrounding each PV
+    system and their bilinear weights are computed once, so predicting
+    on the same grid again is just a gather and a multiply-add.
+
+    Attributes:
+        model_df: The model, as returned by `load_model`.
+    """
+
+    def __init__(self, model_df: pd.DataFrame):
+        """
+        Args:
+          model_df: A model produced by the predict_pv_yield_nwp module.
+        """
+        self.model_df = model_df
+        self.system_id = model_df["system_id"].values
+        self.easting = model_df["easting"].values.astype(np.float64)
+        self.northing = model_df["northing"].values.astype(np.float64)
+        self._weights: "OrderedDict[Tuple[bytes, bytes], Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def interpolation_weights(self, x_coords: np.ndarray, y_coords: np.ndarray) -> Dict:
+        """Bilinear interpolation indices and weights for the PV systems on
+        the grid with the given 1D coordinates."""
+        key = (x_coords.tobytes(), y_coords.tobytes())
+        with self._lock:
+            weights = self._weights.get(key)
+            if weights is not None:
+                self._weights.move_to_end(key)
+                return weights
+        x0, x1, wx, x_valid = _linear_weights(x_coords, self.easting)
+        y0, y1, wy, y_valid = _linear_weights(y_coords, self.northing)
+        weights = {
+            "y0": y0,
+            "y1": y1,
+            "x0": x0,
+            "x1": x1,
+            "w00": (1 - wy) * (1 - wx),
+            "w01": (1 - wy) * wx,
+            "w10": wy * (1 - wx),
+            "w11": wy * wx,
+            "valid": x_valid & y_valid,
+        }
+        with self._lock:
+            self._weights[key] = weights
+            while len(self._weights) > MAX_CACHED_GRIDS:
+                self._weights.popitem(last=False)
+        return weights
+
+    def interp(self, data_array: xr.DataArray) -> xr.DataArray:
+        """Bilinearly interpolate `data_array` to the PV system locations.
+
+        Equivalent to `data_array.interp()` at the systems' eastings and
+        northings: systems outside the grid get NaN.  Returns a DataArray
+        whose spatial dimensions are replaced by a 'system_id' dimension.
+        """
+        x_dim, y_dim = "projection_x_coordinate", "projection_y_coordinate"
+        data_array = data_array.transpose(..., y_dim, x_dim)
+        interpolated = self.interp_values(
+            np.asarray(data_array.values),
+            data_array[x_dim].values,
+            data_array[y_dim].values,
+        )
+        other_dims = data_array.dims[:-2]
+        coords = {
+            name: coord
+            for name, coord in data_array.coords.items()
+            if x_dim not in coord.dims and y_dim not in coord.dims
+        }
+        coords["system_id"] = self.system_id
+        return xr.DataArray(
+            interpolated,
+            dims=other_dims + ("system_id",),
+            coords=coords,
+            name=data_array.name,
+        )
+
+    def interp_values(
+        self, values: np.ndarray, x_coords: np.ndarray, y_coords: np.ndarray
+    ) -> np.ndarray:
+        """Like `interp`, on a plain array whose last two axes are y and x.
+
+        Returns an array whose last axis is the PV systems, in the order of
+        `model_df`.
+        """
+        weights = self.interpolation_weights(x_coords, y_coords)
+        y0, y1, x0, x1 = weights["y0"], weights["y1"], weights["x0"], weights["x1"]
+        interpolated = (
+            weights["w00"] * values[..., y0, x0]
+            + weights["w01"] * values[..., y0, x1]
+            + weights["w10"] * values[..., y1, x0]
+            + weights["w11"] * values[..., y1, x1]
+        )
+        interpolated[..., ~weights["valid"]] = np.nan
+        return interpolated
+
+
+def _linear_weights(
+    coords: np.ndarray, points: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """For each point, the indices of the two surrounding coords, the weight
+    of the second one, and whether the point is within the coords."""
+    coords = coords.astype(np.float64)
+    n = len(coords)
+    descending = n > 1 and coords[0] > coords[-1]
+    if descending:
+        coords = coords[::-1]
+    i0 = np.clip(np.searchsorted(coords, points, side="right") - 1, 0, max(n - 2, 0))
+    i1 = np.minimum(i0 + 1, n - 1)
+    spacing = coords[i1] - coords[i0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = np.where(spacing > 0, (points - coords[i0]) / spacing, 0.0)
+    valid = (points >= coords[0]) & (points <= coords[-1])
+    if descending:
+        i0, i1 = n - 1 - i0, n - 1 - i1
+    return i0, i1, weight, valid
+
+
+class ModelRegistry:
+    """Loads each model file once, and reloads it when the file changes."""
+
+    def __init__(self):
+        self._models: Dict[str, Tuple[float, PVModel]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> PVModel:
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._models.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, PVModel(load_model(path)))
+                self._models[path] = cached
+            return cached[1]
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def load_irradiance_data(
+    path: str,
+    cache_dir: Optional[str] = None,
+    cache_size_mb: float = chunk_cache.DEFAULT_MAX_SIZE_MB,
+) -> xr.Dataset:
+    """Load the NWP irradiance data
+
+    Args:
+      path: Path or URL (e.g. 's3://...') of a NetCDF file or Zarr store.
+      cache_dir: If set, the Zarr store's chunks are cached in this
+        directory (see chunk_cache.ChunkCache), so loading the same store
+        again reads from local disk.
+      cache_size_mb: Maximum size of the cache.
+    """
     if ".zarr" in path:
-        return xr.open_zarr(path)
+        if cache_dir is None:
+            return xr.open_zarr(path)
+        store = chunk_cache.ChunkCache(
+            fsspec.get_mapper(path), cache_dir, max_size_mb=cache_size_mb
+        )
+        return xr.open_zarr(store)
     return xr.open_dataset(path, engine="netcdf4")
 
 
-def predict(irradiance_dataset: xr.Dataset, model_df: pd.DataFrame) -> pd.DataFrame:
-    """Predict PV yield for PV systems with irradiance values in irradiance_dataset"""
+def predict(
+    irradiance_dataset: xr.Dataset, model_df: Union[pd.DataFrame, PVModel]
+) -> pd.DataFrame:
+    """Predict PV yield for PV systems with irradiance values in irradiance_dataset
+
+    Pass a PVModel (e.g. from MODEL_REGISTRY) rather than a DataFrame to
+    reuse the interpolation weights across calls on the same grid.
+    """
+    model = model_df if isinstance(model_df, PVModel) else PVModel(model_df)
+    model_df = model.model_df
 
-    # Get the PV system locations, and interpolate the irradiance data to those locations
-    easting = xr.DataArray(
-        model_df["easting"].values,
-        coords=[model_df["system_id"].values],
-        dims="system_id",
-    )
-    northing = xr.DataArray(
-        model_df["northing"].values,
-        coords=[model_df["system_id"].values],
-        dims="system_id",
-    )
     # MOGREPS has multiple realizations (UKV doesn't)
     if "realization" in irradiance_dataset:
         # just get the first realization
         irradiance_dataset = irradiance_dataset.isel(realization=0)
-    nwp_interp = irradiance_dataset.interp(
-        projection_x_coordinate=easting, projection_y_coordinate=northing
+    # Interpolate the irradiance data to the PV system locations
+    nwp_interp = model.interp(
+        irradiance_dataset["surface_downwelling_shortwave_flux_in_air"]
     )
 
     # Convert to a dataframe
-    irradiance_df = nwp_interp[
-        "surface_downwelling_shortwave_flux_in_air"
-    ].to_dataframe()
+    irradiance_df = nwp_interp.to_dataframe()
 
     # Merge with the model dataframe and use the linear regression parameters
     # to predict a PV yield for each system
@@ -58,24 +223,214 @@ def predict(irradiance_dataset: xr.Dataset, model_df: pd.DataFrame) -> pd.DataFr
     return df
 
 
+# Maximum number of NWP grids interpolated at once by `predict_batch`.  A
+# MOGREPS-UK grid of float32 irradiance is about 1.5 MB.
+BATCH_MAX_STEPS = 256
+
+
+def _irradiance_steps(irradiance_dataset: xr.Dataset) -> xr.DataArray:
+    """The irradiance in `irradiance_dataset` (first realization only), with
+    any other non-spatial dimensions, e.g. 'time', stacked into one 'step'
+    dimension.  Stays lazy if the dataset is backed by dask."""
+    x_dim, y_dim = "projection_x_coordinate", "projection_y_coordinate"
+    if "realization" in irradiance_dataset:
+        irradiance_dataset = irradiance_dataset.isel(realization=0)
+    data_array = irradiance_dataset["surface_downwelling_shortwave_flux_in_air"]
+    step_dims = [dim for dim in data_array.dims if dim not in (x_dim, y_dim)]
+    if step_dims:
+        data_array = data_array.stack(step=step_dims)
+    else:
+        data_array = data_array.expand_dims("step")
+    return data_array.transpose("step", y_dim, x_dim)
+
+
+def _step_times(data_array: xr.DataArray, name: str) -> np.ndarray:
+    """The values of the time coordinate `name` for each step of a
+    DataArray from `_irradiance_steps` (NaT if it has no such coordinate)."""
+    num_steps = data_array.sizes["step"]
+    try:
+        # Also finds levels of the 'step' MultiIndex, which aren't in coords.
+        values = data_array[name].values
+    except KeyError:
+        return np.full(num_steps, np.datetime64("NaT", "ns"))
+    return np.broadcast_to(values, (num_steps,))
+
+
+def _predict_steps(
+    model: PVModel,
+    values: List[np.ndarray],
+    x_coords: np.ndarray,
+    y_coords: np.ndarray,
+    forecast_reference_times: List[np.ndarray],
+    times: List[np.ndarray],
+) -> pd.DataFrame:
+    irradiance = model.interp_values(np.concatenate(values), x_coords, y_coords)
+    num_steps, num_systems = irradiance.shape
+    model_df = model.model_df
+    pv_yield = model_df["slope"].values * irradiance + model_df["intercept"].values
+    return pd.DataFrame(
+        {
+            "system_id": np.tile(model.system_id, num_steps),
+            "longitude": np.tile(model_df["longitude"].values, num_steps),
+            "latitude": np.tile(model_df["latitude"].values, num_steps),
+            "forecast_reference_time": np.repeat(
+                np.concatenate(forecast_reference_times), num_systems
+            ),
+            "time": np.repeat(np.concatenate(times), num_systems),
+            "pv_yield_predicted": pv_yield.ravel(),
+        }
+    )
+
+
+def iter_predict_batch(
+    irradiance_datasets: Union[xr.Dataset, Iterable[xr.Dataset]],
+    model_df: Union[pd.DataFrame, PVModel],
+    max_steps: int = BATCH_MAX_STEPS,
+) -> Iterator[pd.DataFrame]:
+    """Like `predict_batch`, but yields the predictions for up to
+    `max_steps` NWP grids at a time, so they can be written out as they
+    are made."""
+    model = model_df if isinstance(model_df, PVModel) else PVModel(model_df)
+    if isinstance(irradiance_datasets, xr.Dataset):
+        irradiance_datasets = [irradiance_datasets]
+
+    # The steps waiting to be predicted, which are all on the same grid.
+    pending: Dict[str, List[np.ndarray]] = {
+        "values": [],
+        "forecast_reference_times": [],
+        "times": [],
+    }
+    num_pending = 0
+    grid = None
+
+    def predict_pending() -> pd.DataFrame:
+        nonlocal num_pending
+        predictions = _predict_steps(
+            model, x_coords=grid[0], y_coords=grid[1], **pending
+        )
+        for values in pending.values():
+            values.clear()
+        num_pending = 0
+        return predictions
+
+    for irradiance_dataset in irradiance_datasets:
+        data_array = _irradiance_steps(irradiance_dataset)
+        x_coords = data_array["projection_x_coordinate"].values
+        y_coords = data_array["projection_y_coordinate"].values
+        if num_pending and not (
+            np.array_equal(x_coords, grid[0]) and np.array_equal(y_coords, grid[1])
+        ):
+            yield predict_pending()
+        grid = (x_coords, y_coords)
+        forecast_reference_times = _step_times(data_array, "forecast_reference_time")
+        times = _step_times(data_array, "time")
+        start = 0
+        while start < data_array.sizes["step"]:
+            stop = min(data_array.sizes["step"], start + max_steps - num_pending)
+            # Only this slice is loaded, if the data is backed by dask.
+            pending["values"].append(
+                np.asarray(data_array.isel(step=slice(start, stop)).values)
+            )
+            pending["forecast_reference_times"].append(
+                forecast_reference_times[start:stop]
+            )
+            pending["times"].append(times[start:stop])
+            num_pending += stop - start
+            start = stop
+            if num_pending == max_steps:
+                yield predict_pending()
+    if num_pending:
+        yield predict_pending()
+
+
+def predict_batch(
+    irradiance_datasets: Union[xr.Dataset, Iterable[xr.Dataset]],
+    model_df: Union[pd.DataFrame, PVModel],
+    max_steps: int = BATCH_MAX_STEPS,
+) -> pd.DataFrame:
+    """Predict PV yield for many NWP runs and times at once.
+
+    Equivalent to calling `predict` on each dataset and concatenating the
+    results, but consecutive grids with the same coordinates are
+    interpolated and predicted together, `max_steps` at a time, which
+    avoids the per-call overhead of `predict`.  Only `max_steps` grids are
+    loaded into memory at once, so e.g. `map(load_irradiance_data, paths)`
+    or a lazy, dask-backed dataset over many Zarr stores can be passed.
+
+    Args:
+      irradiance_datasets: Datasets like those passed to `predict`, or one
+        dataset with extra dimensions, e.g. 'time'.  As in `predict`, only
+        the first realization of MOGREPS data is used.
+      model_df: The model, as for `predict`.
+      max_steps: Maximum number of NWP grids to load and predict at once.
+
+    Returns:
+      The same columns as `predict`, plus 'forecast_reference_time'.
+    """
+    predictions = list(iter_predict_batch(irradiance_datasets, model_df, max_steps))
+    if not predictions:
+        return pd.DataFrame(
+            columns=[
+                "system_id",
+                "longitude",
+                "latitude",
+                "forecast_reference_time",
+                "time",
+                "pv_yield_predicted",
+            ]
+        )
+    return pd.concat(predictions, ignore_index=True)
+
+
 def predict_as_geojson(
-    irradiance_dataset: xr.Dataset, model_df: pd.DataFrame
+    irradiance_dataset: xr.Dataset, model_df: Union[pd.DataFrame, PVModel]
 ) -> FeatureCollection:
     """Predict PV yield for PV systems with irradiance values in irradiance_dataset, and return a GeoJSON FeatureCollection"""
-    rows = predict(irradiance_dataset, model_df).to_dict("records")
-    feature_collection = FeatureCollection([_to_geojson_feature(row) for row in rows], properties={
-        "forecastCreationTime": datetime.now(timezone.utc).isoformat()
-    })
-    return feature_collection
-
-
-def _to_geojson_feature(row):
-    return Feature(
-        geometry=Point((row["longitude"], row["latitude"])),
-        properties={
-            "system_id": row["system_id"],
-            "forecastTime": row["time"].isoformat(),
-            # TODO(#50): Remove the nan check once issue is fixed
-            "pv_yield_predicted": None if math.isnan(row["pv_yield_predicted"]) else row["pv_yield_predicted"],
-        },
+    return predictions_to_geojson(predict(irradiance_dataset, model_df))
+
+
+def predictions_to_geojson(predictions: pd.DataFrame) -> FeatureCollection:
+    """Convert the output of `predict` to a GeoJSON FeatureCollection.
+
+    Each column is converted to a list of Python objects in one go (NaN
+    predictions become None, times become ISO 8601 strings), rather than
+    converting row by row.
+    """
+    system_ids = predictions["system_id"].values.tolist()
+    longitudes = predictions["longitude"].values.tolist()
+    latitudes = predictions["latitude"].values.tolist()
+    times = np.datetime_as_string(predictions["time"].values, unit="s").tolist()
+    # TODO(#50): Remove the nan check once issue is fixed
+    pv_yield = predictions["pv_yield_predicted"].values
+    pv_yield = np.where(np.isnan(pv_yield), None, pv_yield).tolist()
+    features = [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+            "properties": {
+                "system_id": system_id,
+                "forecastTime": time,
+                "pv_yield_predicted": pv_yield_predicted,
+            },
+        }
+        for system_id, longitude, latitude, time, pv_yield_predicted in zip(
+            system_ids, longitudes, latitudes, times, pv_yield
+        )
+    ]
+    return FeatureCollection(
+        features,
+        properties={"forecastCreationTime": datetime.now(timezone.utc).isoformat()},
+    )
+
+
+def dumps_geojson(feature_collection: FeatureCollection) -> str:
+    """Serialise GeoJSON compactly, without indentation or spaces."""
+    return json.dumps(feature_collection, separators=(",", ":"))
+
+
+def predictions_to_ndjson(predictions: pd.DataFrame) -> str:
+    """Convert the output of `predict` to newline-delimited JSON, one
+    record per PV system and forecast time."""
+    return predictions.to_json(
+        orient="records", lines=True, date_format="iso", date_unit="s"
     )
@@ -0,0 +1,67 @@
+import logging
+import tracemalloc
+from typing import List, Optional
+
+_LOG = logging.getLogger("metoffice_ec2")
+
+# Allocations made by tracemalloc itself, or while importing modules, are
+# not interesting when looking for leaks.
+_IGNORED_FILES = ("<frozen importlib._bootstrap>", "<unknown>", tracemalloc.__file__)
+
+
+class MemoryProfiler:
+    """Finds memory leaks by diffing tracemalloc snapshots.
+
+    Call `log_top_allocations` periodically (e.g. once per loop).  It logs
+    the source lines whose allocations grew the most since the previous
+    call, so code which keeps allocating without freeing stands out.
+
+    Attributes:
+        top_n: Number of allocation sites to log.
+    """
+
+    def __init__(self, top_n: int = 10, num_frames: int = 1):
+        """
+        Args:
+          top_n: Number of allocation sites to log.
+          num_frames: Number of stack frames stored per allocation.  More
+            frames make it easier to find where leaks come from, but make
+            tracing slower.
+        """
+        self.top_n = top_n
+        self._previous: Optional[tracemalloc.Snapshot] = None
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(num_frames)
+
+    def take_snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in _IGNORED_FILES]
+        )
+
+    def top_allocations(self) -> List[tracemalloc.StatisticDiff]:
+        """Returns the `top_n` allocation sites which grew the most since
+        the previous call (or since tracing started, on the first call)."""
+        snapshot = self.take_snapshot()
+        if self._previous is None:
+            stats = [
+                tracemalloc.StatisticDiff(
+                    stat.traceback, stat.size, stat.size, stat.count, stat.count
+                )
+                for stat in snapshot.statistics("lineno")
+            ]
+        else:
+            stats = snapshot.compare_to(self._previous, "lineno")
+        self._previous = snapshot
+        return sorted(stats, key=lambda stat: stat.size_diff, reverse=True)[
+            : self.top_n
+        ]
+
+    def log_top_allocations(self):
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        _LOG.info(
+            "Traced memory: %.1f MB (peak %.1f MB).  Biggest increases:",
+            current_bytes / 1e6,
+            peak_bytes / 1e6,
+        )
+        for stat in self.top_allocations():
+            _LOG.info("  %s", stat)
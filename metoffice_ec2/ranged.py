@@ -0,0 +1,146 @@
+import io
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import boto3
+
+# HDF5 chunks in the Met Office NetCDFs are 1 x 128 x 128 float32s
+# compressed with zlib, i.e. a few tens of KB each.  Larger blocks mean
+# fewer requests but more bytes downloaded which aren't needed.
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_BLOCKS = 1024
+
+
+class S3RangedFile(io.RawIOBase):
+    """Read-only, seekable file object backed by S3 HTTP range requests.
+
+    Lets HDF5 (via h5netcdf) read only the byte ranges it needs, instead of
+    downloading the whole object into memory.  The object is fetched in
+    blocks of `block_size` bytes.  At most `max_blocks` blocks are cached
+    (least recently used blocks are evicted first), so memory use is
+    bounded regardless of the size of the object.  Runs of adjacent missing
+    blocks are fetched with a single request.
+
+    Attributes:
+        size: Size of the object in bytes.
+        bytes_transferred: Total number of bytes downloaded so far.
+        num_requests: Total number of GET requests issued so far.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        key: str,
+        s3_client=None,
+        size: Optional[int] = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        max_blocks: int = DEFAULT_MAX_BLOCKS,
+    ):
+        """
+        Args:
+          bucket: S3 bucket name.
+          key: S3 object key.
+          s3_client: A boto3 S3 client.  If None, a new one is created.
+          size: Size of the object in bytes.  If None, a HEAD request is
+            issued to find it.
+          block_size: Number of bytes fetched per block.
+          max_blocks: Maximum number of blocks kept in memory.
+        """
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.s3 = s3_client if s3_client is not None else boto3.client("s3")
+        if size is None:
+            size = self.s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.size = size
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.bytes_transferred = 0
+        self.num_requests = 0
+        self._pos = 0
+        self._blocks: "OrderedDict[int, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._blocks.clear()
+        super().close()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence: {}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        start = self._pos
+        end = min(start + len(view), self.size)
+        if start >= end:
+            return 0
+        with self._lock:
+            self._fetch(start, end)
+            n_read = 0
+            pos = start
+            while pos < end:
+                block_index, offset = divmod(pos, self.block_size)
+                block = self._blocks[block_index]
+                chunk = block[offset : offset + end - pos]
+                view[n_read : n_read + len(chunk)] = chunk
+                n_read += len(chunk)
+                pos += len(chunk)
+        self._pos = end
+        return n_read
+
+    def _fetch(self, start: int, end: int):
+        """Make sure all blocks covering bytes [start, end) are cached."""
+        first_block = start // self.block_size
+        last_block = (end - 1) // self.block_size
+        missing = [
+            i for i in range(first_block, last_block + 1) if i not in self._blocks
+        ]
+        # Group runs of adjacent missing blocks into single requests.
+        run_start = None
+        for i, block_index in enumerate(missing):
+            if run_start is None:
+                run_start = block_index
+            is_end_of_run = i == len(missing) - 1 or missing[i + 1] != block_index + 1
+            if is_end_of_run:
+                self._fetch_blocks(run_start, block_index)
+                run_start = None
+        for block_index in range(first_block, last_block + 1):
+            self._blocks.move_to_end(block_index)
+        while len(self._blocks) > max(self.max_blocks, last_block - first_block + 1):
+            self._blocks.popitem(last=False)
+
+    def _fetch_blocks(self, first_block: int, last_block: int):
+        range_start = first_block * self.block_size
+        range_end = min((last_block + 1) * self.block_size, self.size) - 1
+        response = self.s3.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range="bytes={:d}-{:d}".format(range_start, range_end),
+        )
+        data = response["Body"].read()
+        self.num_requests += 1
+        self.bytes_transferred += len(data)
+        for block_index in range(first_block, last_block + 1):
+            offset = (block_index - first_block) * self.block_size
+            self._blocks[block_index] = data[offset : offset + self.block_size]
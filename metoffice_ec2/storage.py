@@ -0,0 +1,82 @@
+import io
+import zipfile
+from typing import Dict, Mapping
+
+import fsspec
+
+# Suffix of Zarr stores written as a single zip file (see zip_store).
+ZIP_SUFFIX = ".zip"
+
+# Default options for each protocol's filesystem.  Every Zarr chunk is
+# written once and never read back, so s3fs's read cache only wastes memory,
+# and local directories are created as files are written into them.
+DEFAULT_STORAGE_OPTIONS: Dict[str, Dict] = {
+    "s3": {"default_fill_cache": False, "default_cache_type": "none"},
+    "file": {"auto_mkdir": True},
+}
+
+
+class Storage:
+    """A directory on any filesystem supported by fsspec, given by URL.
+
+    e.g. "s3://uk-metoffice-nwp", "file:///mnt/nvme/nwp" (to stage output
+    on fast local disk, and sync it to S3 in bulk later) or "memory://nwp"
+    (e.g. to benchmark without any network or disk I/O).  A URL without a
+    protocol is a local path.
+
+    Attributes:
+        url: The URL of the directory.
+        protocol: The fsspec protocol, e.g. 's3'.
+        root: The directory's path on the filesystem (without the protocol),
+            e.g. 'uk-metoffice-nwp'.
+    """
+
+    def __init__(self, url: str, **storage_options):
+        """
+        Args:
+          url: The URL of the directory.
+          storage_options: Passed to the filesystem, overriding
+            DEFAULT_STORAGE_OPTIONS.
+        """
+        protocol, _ = fsspec.core.split_protocol(url)
+        self.url = url
+        self.protocol = protocol or "file"
+        filesystem_class = fsspec.get_filesystem_class(self.protocol)
+        self.root = filesystem_class._strip_protocol(url).rstrip("/")
+        self.storage_options = dict(
+            DEFAULT_STORAGE_OPTIONS.get(self.protocol, {}), **storage_options
+        )
+
+    def __repr__(self) -> str:
+        return "Storage({!r})".format(self.url)
+
+    def filesystem(self) -> fsspec.AbstractFileSystem:
+        """Returns a new filesystem instance.
+
+        fsspec returns a cached instance by default, complete with possibly
+        stale directory listings, and instances can't be shared with other
+        processes.
+        """
+        return fsspec.filesystem(
+            self.protocol, skip_instance_cache=True, **self.storage_options
+        )
+
+    def path(self, *parts: str) -> str:
+        """The path of a file under the directory, for `filesystem()`."""
+        return "/".join([self.root] + [part.strip("/") for part in parts])
+
+
+def zip_store(store: Mapping[str, bytes]) -> bytes:
+    """Pack a Zarr store (e.g. a dict written by `subset.write_zarr`) into a
+    zip file, like the '.zarr.zip' files in data/mogreps, which can be read
+    with zarr.ZipStore or `xr.open_zarr`.
+
+    The chunks are already compressed, so are stored in the zip as they
+    are.  Writing one file is much quicker than writing each chunk, and
+    makes copying finished stores around cheap.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zip_file:
+        for key in sorted(store):
+            zip_file.writestr(key, store[key])
+    return buffer.getvalue()
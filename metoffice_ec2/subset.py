@@ -1,13 +1,87 @@
+import hashlib
 import lzma
+import math
 import os
 import pathlib
-from typing import List, MutableMapping, Optional, Union
+import re
+import threading
+import time
+from typing import Callable, Dict, List, MutableMapping, Optional, Tuple, Union
 
+import dask
+import dask.array
+import fsspec
 import numcodecs
+import numpy as np
 import pandas as pd
-import s3fs
+import zarr
 
 import xarray as xr
+from metoffice_ec2 import aio, storage
+
+# Maps (grid signature, boundary) to the integer slices selecting that
+# boundary, and (height signature, heights) to the integer positions of
+# those heights.  The MOGREPS-UK and UKV grids are fixed, so these only
+# need computing once per grid.
+_INDEXERS: Dict[Tuple, Union[slice, List[int]]] = {}
+_MAX_CACHED_INDEXERS = 256
+
+
+def coord_signature(dataset: xr.Dataset, dim: str) -> Tuple[str, int, str]:
+    """Identifies the values of a dimension coordinate, cheaply."""
+    values = np.ascontiguousarray(dataset[dim].values)
+    digest = hashlib.sha1(values.view(np.uint8)).hexdigest()
+    return dim, len(values), digest
+
+
+def _cached_indexer(key: Tuple, compute: Callable[[], Union[slice, List[int]]]):
+    try:
+        return _INDEXERS[key]
+    except KeyError:
+        pass
+    indexer = compute()
+    if len(_INDEXERS) >= _MAX_CACHED_INDEXERS:
+        _INDEXERS.clear()
+    _INDEXERS[key] = indexer
+    return indexer
+
+
+def spatial_indexers(
+    dataset: xr.Dataset,
+    north: Optional[float] = None,
+    east: Optional[float] = None,
+    south: Optional[float] = None,
+    west: Optional[float] = None,
+) -> Dict[str, slice]:
+    """Integer slices for `isel` which select the same region as
+    `dataset.loc` would with coordinate slices."""
+    indexers = {}
+    for dim, start, stop in (
+        ("projection_x_coordinate", west, east),
+        ("projection_y_coordinate", south, north),
+    ):
+        key = (coord_signature(dataset, dim), start, stop)
+        indexers[dim] = _cached_indexer(
+            key, lambda: dataset.indexes[dim].slice_indexer(start, stop)
+        )
+    return indexers
+
+
+def height_indexer(dataset: xr.Dataset, height_meters: List[float]) -> List[int]:
+    """Integer positions for `isel` of the heights `sel` would select."""
+
+    def compute() -> List[int]:
+        positions = dataset.indexes["height"].get_indexer(height_meters)
+        if (positions < 0).any():
+            raise KeyError(
+                "Heights not found: {}".format(
+                    np.asarray(height_meters)[positions < 0].tolist()
+                )
+            )
+        return positions.tolist()
+
+    key = (coord_signature(dataset, "height"), tuple(height_meters))
+    return _cached_indexer(key, compute)
 
 
 def subset(
@@ -18,20 +92,22 @@ def subset(
     south: Optional[float] = None,
     west: Optional[float] = None,
 ) -> xr.Dataset:
+    """Select heights and a spatial region from `dataset`.
 
+    Integer indexers are computed once per grid, and selected with `isel`.
+    If `dataset` hasn't been loaded, the indexers are passed through to
+    the NetCDF reader, so only the selected hyperslab is read and decoded
+    when the subset is loaded.
+    """
+    indexers = {}
     if (
         height_meters is not None
         and not isinstance(height_meters, float)
         and len(height_meters) > 1
     ):
-        dataset = dataset.sel(height=height_meters)
-
-    return dataset.loc[
-        dict(
-            projection_x_coordinate=slice(west, east),
-            projection_y_coordinate=slice(south, north),
-        )
-    ]
+        indexers["height"] = height_indexer(dataset, height_meters)
+    indexers.update(spatial_indexers(dataset, north, east, south, west))
+    return dataset.isel(indexers)
 
 
 def get_variable_name(dataset: xr.Dataset) -> str:
@@ -39,7 +115,12 @@ def get_variable_name(dataset: xr.Dataset) -> str:
     return str(var_name)
 
 
-def get_zarr_filename(dataset: xr.Dataset, dest_path: str) -> str:
+def get_zarr_filename(dataset: xr.Dataset, dest_path: str, zipped: bool = False) -> str:
+    """
+    Args:
+      zipped: If True, the filename is for a Zarr store written as a single
+        zip file (see storage.zip_store), ending '.zarr.zip'.
+    """
     forecast_ref_time = dataset.forecast_reference_time.values
     forecast_ref_time = pd.Timestamp(forecast_ref_time)
     valid_time = dataset.time.values
@@ -57,6 +138,28 @@ def get_zarr_filename(dataset: xr.Dataset, dest_path: str) -> str:
         ref_time=forecast_ref_time.strftime("%Y-%m-%dT%H"),
         valid_time=valid_time.strftime("%Y-%m-%dT%H"),
     )
+    if zipped:
+        basename += storage.ZIP_SUFFIX
+
+    return os.path.join(path, basename)
+
+
+def get_run_zarr_filename(dataset: xr.Dataset, dest_path: str) -> str:
+    """Like `get_zarr_filename`, but for the Zarr store which holds every
+    valid time of this variable's forecast run (see `write_zarr_region`)."""
+    forecast_ref_time = pd.Timestamp(dataset.forecast_reference_time.values)
+    var_name = get_variable_name(dataset)
+    model_name = dataset.attrs["title"].split()[0]
+
+    path = os.path.join(
+        dest_path, model_name, var_name, forecast_ref_time.strftime("%Y/m%m/d%d/h%H")
+    )
+
+    basename = "{model_name}__{var_name}__{ref_time}.zarr".format(
+        model_name=model_name,
+        var_name=var_name,
+        ref_time=forecast_ref_time.strftime("%Y-%m-%dT%H"),
+    )
 
     return os.path.join(path, basename)
 
@@ -65,14 +168,128 @@ class FileExistsError(Exception):
     pass
 
 
-def prep_and_check_s3(full_zarr_filename: str, s3: s3fs.S3FileSystem):
+def prep_and_check_s3(full_zarr_filename: str, s3: fsspec.AbstractFileSystem):
+    # Nothing needs creating: S3 has no directories, and fsspec creates
+    # local directories as files are written into them.
     if s3.exists(full_zarr_filename):
         raise FileExistsError(
             "Destination already exists: {}".format(full_zarr_filename)
         )
 
-    zarr_path, _ = os.path.split(full_zarr_filename)
-    s3.makedirs(path=zarr_path)
+
+def lzma_compressor(preset: int = 9, dist: int = 4) -> numcodecs.LZMA:
+    lzma_filters = [
+        dict(id=lzma.FILTER_DELTA, dist=dist),
+        dict(id=lzma.FILTER_LZMA2, preset=preset),
+    ]
+    return numcodecs.LZMA(filters=lzma_filters, format=lzma.FORMAT_RAW)
+
+
+# Maps compression profile name to a function which returns a compressor.
+# "archive" gives the best compression ratio but is slow.  "fast" is
+# roughly two orders of magnitude faster, but gives larger files.
+COMPRESSION_PROFILES: Dict[str, Callable[[], numcodecs.abc.Codec]] = {
+    "archive": lzma_compressor,
+    "balanced": lambda: numcodecs.Blosc(
+        cname="zstd", clevel=6, shuffle=numcodecs.Blosc.BITSHUFFLE
+    ),
+    "fast": lambda: numcodecs.Blosc(
+        cname="zstd", clevel=1, shuffle=numcodecs.Blosc.SHUFFLE
+    ),
+}
+
+
+def _quantize(data_array: xr.DataArray, precision: float) -> Dict:
+    """Round values to multiples of a power of two no bigger than
+    `precision`, which is rounded down to a power of ten.  The values stay
+    floats, but compress much better."""
+    digits = math.ceil(-math.log10(precision))
+    return {"filters": [numcodecs.Quantize(digits=digits, dtype=data_array.dtype)]}
+
+
+def _float16(data_array: xr.DataArray) -> Dict:
+    """Store half-precision floats, with about 3 significant digits."""
+    return {"dtype": "float16"}
+
+
+def _scale_offset(
+    data_array: xr.DataArray, precision: float, offset: float = 0.0
+) -> Dict:
+    """Store (value - offset) / precision as int16.
+
+    Raises ValueError if `data_array` has values which can't be stored,
+    i.e. which are more than 32767 * precision from `offset`.
+    """
+    int16_info = np.iinfo(np.int16)
+    limit = int16_info.max * precision
+    min_value, max_value = float(data_array.min()), float(data_array.max())
+    if min_value < offset - limit or max_value > offset + limit:
+        raise ValueError(
+            "Values from {} to {} can't be stored to a precision of {} with an"
+            " offset of {}".format(min_value, max_value, precision, offset)
+        )
+    return {
+        "dtype": "int16",
+        "scale_factor": precision,
+        "add_offset": offset,
+        "_FillValue": int16_info.min,
+    }
+
+
+# Lossy encodings which reduce the precision of the stored values, so that
+# they take much less space.  Each maps a method name (the "method" of a
+# quantization in PARAMS_TO_COPY) to a function which takes the data and
+# the quantization's other options, and returns Zarr encoding.
+QUANTIZATIONS: Dict[str, Callable[..., Dict]] = {
+    "quantize": _quantize,
+    "float16": _float16,
+    "scale_offset": _scale_offset,
+}
+
+
+def quantization_encoding(
+    data_array: xr.DataArray, quantization: Optional[Dict]
+) -> Dict:
+    """Returns the Zarr encoding of `data_array` for a quantization, e.g.
+    `{"method": "quantize", "precision": 0.01}`.
+
+    `quantization` can also be None, or NaN (as in rows of a DataFrame
+    without a quantization), for lossless storage.
+    """
+    if not isinstance(quantization, dict):
+        return {}
+    options = dict(quantization)
+    method = options.pop("method")
+    return QUANTIZATIONS[method](data_array, **options)
+
+
+# MOGREPS-UK and UKV are on (projection_y_coordinate, projection_x_coordinate)
+# grids.  All other dimensions (realization, height) are chunked one-by-one.
+SPATIAL_DIMS = ("projection_y_coordinate", "projection_x_coordinate")
+
+
+def choose_chunks(
+    data_array: xr.DataArray, target_chunk_mb: float = 2
+) -> Dict[str, int]:
+    """Choose chunk sizes so that each chunk is roughly `target_chunk_mb`.
+
+    Each chunk is a spatial tile of a single realization and height.  The
+    y dimension is split into equal-sized tiles until each tile is no
+    larger than `target_chunk_mb`, giving enough chunks to compress in
+    parallel while keeping each chunk big enough to compress well.
+    """
+    chunks = {dim: 1 for dim in data_array.dims if dim not in SPATIAL_DIMS}
+    spatial_dims = [dim for dim in data_array.dims if dim in SPATIAL_DIMS]
+    slab_size = data_array.dtype.itemsize
+    for dim in spatial_dims:
+        slab_size *= data_array.sizes[dim]
+    num_tiles = max(math.ceil(slab_size / (target_chunk_mb * 1e6)), 1)
+    for dim in spatial_dims:
+        chunks[dim] = data_array.sizes[dim]
+    if spatial_dims:
+        y_dim = spatial_dims[0]
+        chunks[y_dim] = math.ceil(data_array.sizes[y_dim] / num_tiles)
+    return chunks
 
 
 def write_zarr(
@@ -82,26 +299,264 @@ def write_zarr(
     dist: int = 4,
     mode: str = "w",
     consolidated: bool = True,
+    compression: str = "archive",
+    num_threads: Optional[int] = None,
+    quantization: Optional[Dict] = None,
 ) -> xr.backends.ZarrStore:
-    lzma_filters = [
-        dict(id=lzma.FILTER_DELTA, dist=dist),
-        dict(id=lzma.FILTER_LZMA2, preset=preset),
-    ]
-    compressor = numcodecs.LZMA(filters=lzma_filters, format=lzma.FORMAT_RAW)
+    """Compress and write `dataset` to a Zarr store.
+
+    Args:
+      preset, dist: LZMA parameters for the "archive" compression profile.
+      compression: The name of a profile in COMPRESSION_PROFILES.
+      num_threads: Number of threads used to compress chunks in parallel.
+        Defaults to the number of cores.
+      quantization: Lossy encoding, see `quantization_encoding`.
+    """
+    if compression == "archive":
+        compressor = lzma_compressor(preset=preset, dist=dist)
+    else:
+        compressor = COMPRESSION_PROFILES[compression]()
     var_name = get_variable_name(dataset)
-    encoding = {var_name: {"compressor": compressor}}
-    return dataset.to_zarr(
-        store, mode=mode, consolidated=consolidated, encoding=encoding
+    encoding = {
+        var_name: {
+            "compressor": compressor,
+            **quantization_encoding(dataset[var_name], quantization),
+        }
+    }
+    # Chunk with dask, so each chunk is compressed in its own thread.
+    dataset = dataset.copy()
+    dataset[var_name] = dataset[var_name].chunk(choose_chunks(dataset[var_name]))
+    with dask.config.set(scheduler="threads", num_workers=num_threads):
+        return dataset.to_zarr(
+            store, mode=mode, consolidated=consolidated, encoding=encoding
+        )
+
+
+# Interval between the valid times of a forecast run.
+RUN_TIME_STEP = pd.Timedelta(hours=1)
+
+# Guards the creation of per-run Zarr stores by this process's threads.
+_RUN_STORE_LOCK = threading.Lock()
+
+
+def run_times(
+    dataset: xr.Dataset, step: pd.Timedelta = RUN_TIME_STEP
+) -> pd.DatetimeIndex:
+    """All valid times of the forecast run which `dataset` is part of."""
+    forecast_ref_time = pd.Timestamp(dataset.forecast_reference_time.values)
+    # e.g. "PT126H".  pandas can't parse ISO 8601 durations of over a day.
+    match = re.fullmatch(r"PT(\d+)H", dataset.attrs["mosg__forecast_run_duration"])
+    if match is None:
+        raise ValueError(
+            "Unrecognised forecast run duration: {}".format(
+                dataset.attrs["mosg__forecast_run_duration"]
+            )
+        )
+    run_duration = pd.Timedelta(hours=int(match.group(1)))
+    return pd.date_range(forecast_ref_time, forecast_ref_time + run_duration, freq=step)
+
+
+def _expand_time(dataset: xr.Dataset) -> xr.Dataset:
+    """Make the main variable's scalar `time` coordinate a dimension."""
+    var_name = get_variable_name(dataset)
+    dataset = dataset.copy()
+    data_array = dataset[var_name].expand_dims("time")
+    dataset = dataset.drop_vars(["time", var_name])
+    dataset[var_name] = data_array
+    if "forecast_period" in dataset.coords:
+        dataset = dataset.assign_coords(
+            forecast_period=("time", [dataset.forecast_period.values])
+        )
+    return dataset
+
+
+def init_run_zarr(
+    dataset: xr.Dataset,
+    store: MutableMapping,
+    compression: str = "archive",
+    step: pd.Timedelta = RUN_TIME_STEP,
+    quantization: Optional[Dict] = None,
+):
+    """Create an empty Zarr store for all valid times of a forecast run.
+
+    Only the metadata and coordinates are written; the main variable is
+    pre-allocated along a `time` dimension covering every valid time in
+    the run, and is filled in, one valid time at a time, by
+    `write_zarr_region`.  The metadata never changes after this, so it is
+    consolidated once, here.
+
+    Args:
+      dataset: Any one valid time of the run, e.g. from `subset`.
+      store: Where to create the Zarr store.  Must be empty.
+      compression: The name of a profile in COMPRESSION_PROFILES.
+      step: Interval between the run's valid times.
+      quantization: Lossy encoding, see `quantization_encoding`.
+    """
+    var_name = get_variable_name(dataset)
+    data_array = _expand_time(dataset)[var_name]
+    times = run_times(dataset, step)
+    forecast_ref_time = pd.Timestamp(dataset.forecast_reference_time.values)
+    template = dataset.drop_vars([var_name, "time", "forecast_period"], errors="ignore")
+    template = template.assign_coords(
+        time=times, forecast_period=("time", times - forecast_ref_time)
+    )
+    chunks = choose_chunks(data_array)
+    template[var_name] = (
+        data_array.dims,
+        dask.array.full(
+            (len(times),) + data_array.shape[1:],
+            np.nan,
+            dtype=data_array.dtype,
+            chunks=tuple(chunks[dim] for dim in data_array.dims),
+        ),
+        data_array.attrs,
     )
+    encoding = {
+        var_name: {
+            "compressor": COMPRESSION_PROFILES[compression](),
+            **quantization_encoding(data_array, quantization),
+        }
+    }
+    # compute=False writes everything except the main variable's chunks.
+    template.to_zarr(
+        store, mode="w-", compute=False, consolidated=True, encoding=encoding
+    )
+
+
+def write_zarr_region(
+    dataset: xr.Dataset,
+    store: MutableMapping,
+    compression: str = "archive",
+    step: pd.Timedelta = RUN_TIME_STEP,
+    num_threads: Optional[int] = None,
+    init_timeout_secs: float = 60,
+    quantization: Optional[Dict] = None,
+):
+    """Write one valid time into the forecast run's Zarr store.
+
+    The store is created by `init_run_zarr` if it doesn't exist yet.  Each
+    valid time is stored in its own chunks, so messages for different
+    valid times of the same run can be written concurrently, by threads,
+    processes or separate machines.
+
+    Args:
+      dataset: A single valid time, e.g. from `subset`.
+      store: The run's Zarr store.
+      compression: Used if the store has to be created.
+      step: Interval between the run's valid times.
+      num_threads: Number of threads used to compress chunks in parallel.
+        Defaults to the number of cores.
+      init_timeout_secs: How long to wait for another writer to finish
+        creating the store.
+      quantization: Used if the store has to be created.
+    """
+    var_name = get_variable_name(dataset)
+    with _RUN_STORE_LOCK:
+        if ".zmetadata" not in store:
+            try:
+                init_run_zarr(
+                    dataset,
+                    store,
+                    compression=compression,
+                    step=step,
+                    quantization=quantization,
+                )
+            except zarr.errors.ContainsGroupError:
+                # Another process is creating the store.
+                pass
+    # .zmetadata is written last, so the store is complete once it exists.
+    deadline = time.time() + init_timeout_secs
+    while ".zmetadata" not in store:
+        if time.time() > deadline:
+            raise RuntimeError("Timed out waiting for the Zarr store to be created")
+        time.sleep(1)
+
+    valid_time = pd.Timestamp(dataset.time.values)
+    times = run_times(dataset, step)
+    if valid_time not in times:
+        raise ValueError(
+            "Valid time {} is not one of the run's valid times".format(valid_time)
+        )
+    time_index = times.get_loc(valid_time)
+    # The store's encoding is used, but check the values can be stored.
+    quantization_encoding(dataset[var_name], quantization)
+    # Only write the main variable.  Everything else, including the `time`
+    # and `forecast_period` coordinates, was written by `init_run_zarr`, and
+    # writing them again could race with other writers.
+    region = _expand_time(dataset)[[var_name]]
+    region = region.drop_vars([name for name in region.variables if name != var_name])
+    region[var_name] = region[var_name].chunk(choose_chunks(region[var_name]))
+    with dask.config.set(scheduler="threads", num_workers=num_threads):
+        region.to_zarr(store, region={"time": slice(time_index, time_index + 1)})
 
 
 def write_zarr_to_s3(
     dataset: xr.Dataset,
     full_zarr_filename: str,
-    s3: s3fs.S3FileSystem,
+    s3: fsspec.AbstractFileSystem,
+    check_exists: bool = True,
     **write_zarr_kwargs
 ) -> xr.backends.ZarrStore:
+    """Write `dataset` to a Zarr store on any fsspec filesystem (despite
+    the name), e.g. S3, local disk or memory.
 
-    prep_and_check_s3(full_zarr_filename, s3)
-    store = s3fs.S3Map(root=full_zarr_filename, s3=s3, check=False, create=True)
-    return write_zarr(dataset, store, **write_zarr_kwargs)
+    Args:
+      s3: The filesystem.
+      check_exists: If True, raise FileExistsError if the destination
+        exists.  Pass False if that has already been checked, e.g. with a
+        manifest.Manifest.
+    """
+    if check_exists:
+        prep_and_check_s3(full_zarr_filename, s3)
+    if full_zarr_filename.endswith(storage.ZIP_SUFFIX):
+        compressed: Dict[str, bytes] = {}
+        zarr_store = write_zarr(dataset, compressed, **write_zarr_kwargs)
+        s3.pipe_file(full_zarr_filename, storage.zip_store(compressed))
+        return zarr_store
+    return write_zarr(dataset, s3.get_mapper(full_zarr_filename), **write_zarr_kwargs)
+
+
+def write_zarr_to_s3_concurrently(
+    dataset: xr.Dataset,
+    full_zarr_filename: str,
+    s3: fsspec.AbstractFileSystem,
+    check_exists: bool = True,
+    max_concurrency: int = 16,
+    **write_zarr_kwargs
+) -> int:
+    """Compress `dataset` into memory, then upload its chunks with up to
+    `max_concurrency` uploads in flight.
+
+    The consolidated metadata is uploaded last, so the store only looks
+    complete once every chunk has been uploaded.  A zipped store (ending
+    '.zip') is uploaded as one file.
+
+    Args:
+      check_exists: As for `write_zarr_to_s3`.
+
+    Returns:
+      The number of bytes uploaded.
+    """
+    if check_exists:
+        prep_and_check_s3(full_zarr_filename, s3)
+    compressed: Dict[str, bytes] = {}
+    write_zarr(dataset, compressed, **write_zarr_kwargs)
+    if full_zarr_filename.endswith(storage.ZIP_SUFFIX):
+        zipped = storage.zip_store(compressed)
+        s3.pipe_file(full_zarr_filename, zipped)
+        return len(zipped)
+    store = s3.get_mapper(full_zarr_filename)
+    return aio.copy_store(compressed, store, max_concurrency=max_concurrency)
+
+
+def write_zarr_region_to_s3(
+    dataset: xr.Dataset,
+    full_zarr_filename: str,
+    s3: fsspec.AbstractFileSystem,
+    **write_zarr_region_kwargs
+):
+    if full_zarr_filename.endswith(storage.ZIP_SUFFIX):
+        raise ValueError("Zipped Zarr stores can't be written region by region")
+    write_zarr_region(
+        dataset, s3.get_mapper(full_zarr_filename), **write_zarr_region_kwargs
+    )
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import time
+
+from metoffice_ec2.aio import copy_store, gather_bounded
+
+
+def test_gather_bounded_limits_concurrency():
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def work(i):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return i
+
+    funcs = [lambda i=i: work(i) for i in range(10)]
+    results = asyncio.run(gather_bounded(funcs, max_concurrency=3))
+
+    assert results == list(range(10))
+    assert max_running[0] == 3
+
+
+class RecordingStore(dict):
+    def __init__(self):
+        super().__init__()
+        self.order = []
+
+    def __setitem__(self, key, value):
+        self.order.append(key)
+        super().__setitem__(key, value)
+
+
+def test_copy_store_copies_consolidated_metadata_last():
+    source = {".zmetadata": b"{}", ".zgroup": b"{}"}
+    for i in range(20):
+        source["var/{}.0".format(i)] = b"x" * i
+    dest = RecordingStore()
+
+    num_bytes = copy_store(source, dest, max_concurrency=4)
+
+    assert dest == source
+    assert dest.order[-1] == ".zmetadata"
+    assert num_bytes == sum(len(value) for value in source.values())
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from metoffice_ec2 import backfill, message
+
+SNS_MESSAGE_FILENAME = "data/sns_messages/mogreps_uk_surface_temperature.json"
+SQS_MESSAGE_FILENAME = "data/sqs_messages/mogreps_uk_wind_speed_10m.json"
+
+
+def test_read_archive_wraps_sns_notifications():
+    sqs_messages = list(backfill.read_archive([SNS_MESSAGE_FILENAME]))
+    assert len(sqs_messages) == 1
+    mo_message = message.MetOfficeMessage(sqs_messages[0])
+    assert mo_message.message["name"] == "surface_temperature"
+    assert sqs_messages[0]["Attributes"]["ApproximateReceiveCount"] == "1"
+
+
+def test_read_archive_reads_directories_and_json_lines(tmp_path):
+    with open(SNS_MESSAGE_FILENAME) as f:
+        notification = json.load(f)
+    with open(SQS_MESSAGE_FILENAME) as f:
+        sqs_message = json.load(f)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "lines.jsonl").write_text(
+        "{}\n\n{}\n".format(json.dumps(notification), json.dumps(sqs_message))
+    )
+    (tmp_path / "list.json").write_text(json.dumps([notification]))
+    (tmp_path / ".hidden").write_text("not JSON")
+
+    sqs_messages = list(backfill.read_archive([str(tmp_path)]))
+    names = [message.MetOfficeMessage(m).message["name"] for m in sqs_messages]
+    assert names == ["surface_temperature", "surface_temperature", "wind_speed"]
+
+
+def test_read_archive_rejects_other_json(tmp_path):
+    path = tmp_path / "other.json"
+    path.write_text(json.dumps({"foo": "bar"}))
+    with pytest.raises(ValueError):
+        list(backfill.read_archive([str(path)]))
+
+
+def test_checkpoint_resumes(tmp_path):
+    path = str(tmp_path / "checkpoint")
+    checkpoint = backfill.Checkpoint(path)
+    checkpoint.add("a")
+    checkpoint.add("b")
+    checkpoint.close()
+
+    checkpoint = backfill.Checkpoint(path)
+    assert len(checkpoint) == 2
+    assert "a" in checkpoint
+    assert "c" not in checkpoint
+    checkpoint.add("c")
+    checkpoint.close()
+    assert "c" in backfill.Checkpoint(path)
+
+
+def test_throughput_summary():
+    throughput = backfill.Throughput()
+    throughput.add("written", bytes_in=2000000, bytes_out=1000000)
+    throughput.add("written", bytes_in=2000000, bytes_out=1000000)
+    throughput.add("failed")
+    summary = throughput.summary()
+    assert summary["written"] == 2
+    assert summary["failed"] == 1
+    assert summary["files_per_sec"] == pytest.approx(
+        2 / summary["elapsed_secs"], rel=0.1
+    )
+    assert summary["mb_per_sec"] == pytest.approx(2 * summary["mb_out_per_sec"])
+    assert "2 written" in str(throughput)
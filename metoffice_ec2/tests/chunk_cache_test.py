@@ -0,0 +1,93 @@
+import os
+
+import fsspec
+import numpy as np
+import pytest
+import zarr
+
+import xarray as xr
+from metoffice_ec2.chunk_cache import ChunkCache
+from metoffice_ec2.predict import load_irradiance_data
+
+
+class CountingStore(dict):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.num_reads = 0
+
+    def __getitem__(self, key):
+        self.num_reads += 1
+        return super().__getitem__(key)
+
+
+@pytest.fixture
+def store():
+    dataset = xr.Dataset(
+        {"surface_temperature": (("y", "x"), np.arange(100.0).reshape(10, 10))}
+    )
+    memory_store = zarr.MemoryStore()
+    dataset.to_zarr(
+        memory_store,
+        consolidated=True,
+        encoding={"surface_temperature": {"chunks": (2, 10)}},
+    )
+    return CountingStore(memory_store)
+
+
+def test_second_read_comes_from_cache(store, tmp_path):
+    cached = ChunkCache(store, str(tmp_path), namespace="memory://test")
+    expected = xr.open_zarr(cached, consolidated=True).load()
+    num_reads = store.num_reads
+    assert num_reads > 0 and cached.misses == num_reads
+
+    # A new ChunkCache, like a new process would open.
+    cached = ChunkCache(store, str(tmp_path), namespace="memory://test")
+    xr.testing.assert_identical(
+        xr.open_zarr(cached, consolidated=True).load(), expected
+    )
+    assert store.num_reads == num_reads
+    assert cached.misses == 0 and cached.hits > 0
+
+
+def test_evicts_least_recently_used(store, tmp_path):
+    chunk_bytes = len(store["surface_temperature/0.0"])
+    cached = ChunkCache(
+        store, str(tmp_path), max_size_mb=2.5 * chunk_bytes / 1e6, namespace="a"
+    )
+    cached["surface_temperature/0.0"]
+    cached["surface_temperature/1.0"]
+    cached["surface_temperature/0.0"]
+    cached["surface_temperature/2.0"]
+
+    assert len(os.listdir(tmp_path)) == 2
+    assert cached.size_bytes <= 2.5 * chunk_bytes
+    num_reads = store.num_reads
+    cached["surface_temperature/0.0"]
+    assert store.num_reads == num_reads
+    cached["surface_temperature/1.0"]
+    assert store.num_reads == num_reads + 1
+
+
+def test_writes_replace_cached_values(store, tmp_path):
+    cached = ChunkCache(store, str(tmp_path), namespace="a")
+    cached["surface_temperature/0.0"]
+    cached["surface_temperature/0.0"] = b"new"
+    assert cached["surface_temperature/0.0"] == b"new"
+    assert store["surface_temperature/0.0"] == b"new"
+
+
+def test_load_irradiance_data_with_cache(tmp_path):
+    dataset = xr.Dataset(
+        {"surface_downwelling_shortwave_flux_in_air": ("x", np.arange(10.0))}
+    )
+    zarr_path = str(tmp_path / "irradiance.zarr")
+    dataset.to_zarr(zarr_path, consolidated=True)
+    cache_dir = str(tmp_path / "cache")
+
+    for _ in range(2):
+        loaded = load_irradiance_data(zarr_path, cache_dir=cache_dir)
+        xr.testing.assert_identical(loaded.load(), dataset)
+    assert len(os.listdir(cache_dir)) > 0
+    assert ChunkCache(fsspec.get_mapper(zarr_path), cache_dir).namespace.startswith(
+        "file://"
+    )
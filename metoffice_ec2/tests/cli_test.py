@@ -0,0 +1,83 @@
+import subprocess
+import sys
+
+import pytest
+
+from metoffice_ec2 import cli
+
+# Maximum time to import the CLI, in milliseconds.  It only imports the
+# standard library, which takes a few milliseconds.
+CLI_IMPORT_TIME_BUDGET_MS = 100
+
+# Modules which the ingest loop only imports when they're needed.
+DEFERRED_MODULES = ["metoffice_ec2.predict", "geojson", "matplotlib", "cartopy"]
+
+
+def import_time_ms(module: str) -> float:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    # Lines are like "import time: <self us> | <cumulative us> | <module>".
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative_us, name = line.split(":", 1)[1].split("|")
+        if name.strip() == module:
+            return int(cumulative_us) / 1000
+    raise ValueError("{} not found in the importtime output".format(module))
+
+
+def test_cli_import_time_budget():
+    assert import_time_ms("metoffice_ec2.cli") < CLI_IMPORT_TIME_BUDGET_MS
+
+
+def test_ingest_script_defers_imports():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, scripts.ec2;"
+            " print(' '.join(m for m in {!r} if m in sys.modules))".format(
+                DEFERRED_MODULES
+            ),
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_ingest_runs_ec2_script(monkeypatch):
+    run_paths = []
+    monkeypatch.setattr(
+        cli.runpy,
+        "run_path",
+        lambda path, run_name: run_paths.append((path, run_name)),
+    )
+    monkeypatch.setattr(sys, "argv", list(sys.argv))
+    assert cli.main(["ingest"]) == 0
+    assert run_paths == [(str(cli.SCRIPTS_DIR / "ec2.py"), "__main__")]
+    assert sys.argv == [str(cli.SCRIPTS_DIR / "ec2.py")]
+
+    with pytest.raises(SystemExit):
+        cli.main([])
+
+
+def test_backfill_passes_arguments_to_ec2_script(monkeypatch):
+    monkeypatch.setattr(cli.runpy, "run_path", lambda path, run_name: None)
+    monkeypatch.setattr(sys, "argv", list(sys.argv))
+    assert cli.main(["backfill", "--workers", "2", "archive/"]) == 0
+    assert sys.argv == [
+        str(cli.SCRIPTS_DIR / "ec2.py"),
+        "backfill",
+        "--workers",
+        "2",
+        "archive/",
+    ]
+
+    with pytest.raises(SystemExit):
+        cli.main(["ingest", "--workers", "2"])
@@ -0,0 +1,160 @@
+import threading
+import time
+
+import pytest
+
+from metoffice_ec2.concurrency import (
+    MemoryBudget,
+    ProcessingTimes,
+    VisibilityHeartbeat,
+)
+from metoffice_ec2.metrics import MetricsRegistry
+
+
+class FakeSQS:
+    def __init__(self):
+        self.calls = []
+
+    def change_message_visibility(self, **kwargs):
+        self.calls.append(kwargs)
+
+
+def test_memory_budget_blocks_until_released():
+    budget = MemoryBudget(max_mb=100)
+    budget.acquire(60)
+
+    acquired = threading.Event()
+
+    def acquire_more():
+        budget.acquire(60)
+        acquired.set()
+
+    thread = threading.Thread(target=acquire_more)
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    budget.release(60)
+    assert acquired.wait(1)
+    thread.join()
+    assert budget.in_flight_mb == 60
+
+
+def test_memory_budget_lets_oversized_request_through_when_idle():
+    budget = MemoryBudget(max_mb=100)
+    budget.acquire(500)
+    assert budget.in_flight_mb == 500
+    budget.release(500)
+    assert budget.in_flight_mb == 0
+
+
+def test_visibility_heartbeat():
+    sqs = FakeSQS()
+    heartbeat = VisibilityHeartbeat(
+        sqs, "queue-url", visibility_timeout_secs=30, interval_secs=0.01
+    )
+    with heartbeat:
+        heartbeat.add("handle-1")
+        time.sleep(0.1)
+        heartbeat.remove("handle-1")
+        time.sleep(0.05)
+        num_calls = len(sqs.calls)
+        time.sleep(0.05)
+
+    assert num_calls > 0
+    assert len(sqs.calls) == num_calls
+    assert sqs.calls[0] == dict(
+        QueueUrl="queue-url", ReceiptHandle="handle-1", VisibilityTimeout=30
+    )
+
+
+def test_visibility_heartbeat_extends_immediately_on_add():
+    sqs = FakeSQS()
+    heartbeat = VisibilityHeartbeat(
+        sqs, "queue-url", visibility_timeout_secs=30, interval_secs=10
+    )
+    with heartbeat:
+        heartbeat.add("handle-1")
+        assert len(sqs.calls) == 1
+
+
+def test_visibility_heartbeat_rejects_long_interval():
+    with pytest.raises(ValueError):
+        VisibilityHeartbeat(
+            FakeSQS(), "queue-url", visibility_timeout_secs=30, interval_secs=60
+        )
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_processing_times_learns_and_persists(tmp_path):
+    processing_times = ProcessingTimes(alpha=0.5, num_stddevs=2)
+    assert processing_times.estimate("wind_speed") is None
+    for _ in range(3):
+        processing_times.record("wind_speed", 10)
+    assert processing_times.estimate("wind_speed") == pytest.approx(10)
+    processing_times.record("wind_speed", 30)
+    # The mean moves halfway to 30, plus two standard deviations.
+    assert processing_times.estimate("wind_speed") > 20
+
+    path = str(tmp_path / "processing_times.json")
+    processing_times.save(path)
+    loaded = ProcessingTimes.load(path, alpha=0.5, num_stddevs=2)
+    assert len(loaded) == 1
+    assert loaded.estimate("wind_speed") == processing_times.estimate("wind_speed")
+    assert len(ProcessingTimes.load(str(tmp_path / "missing.json"))) == 0
+
+
+def test_visibility_heartbeat_adapts_to_processing_times():
+    sqs = FakeSQS()
+    clock = FakeClock()
+    processing_times = ProcessingTimes()
+    processing_times.record("big", 1000)
+    processing_times.record("small", 1)
+    registry = MetricsRegistry()
+    heartbeat = VisibilityHeartbeat(
+        sqs,
+        "queue-url",
+        visibility_timeout_secs=600,
+        interval_secs=10,
+        processing_times=processing_times,
+        safety_factor=2,
+        registry=registry,
+        clock=clock,
+    )
+    heartbeat.add("handle-big", "big")
+    heartbeat.add("handle-small", "small")
+    heartbeat.add("handle-new", "new")
+    timeouts = {call["ReceiptHandle"]: call["VisibilityTimeout"] for call in sqs.calls}
+    # At least three beats, for quick messages.
+    assert timeouts == {"handle-big": 2000, "handle-small": 30, "handle-new": 600}
+    assert len(heartbeat) == 3
+
+    # Only messages which would expire within two beats are extended.
+    clock.now = 5
+    heartbeat.beat()
+    assert len(sqs.calls) == 3
+    clock.now = 15
+    heartbeat.beat()
+    assert [call["ReceiptHandle"] for call in sqs.calls[3:]] == ["handle-small"]
+
+    # A message which runs for longer than expected gets longer extensions.
+    clock.now = 100
+    heartbeat.beat()
+    assert sqs.calls[-1] == dict(
+        QueueUrl="queue-url", ReceiptHandle="handle-small", VisibilityTimeout=200
+    )
+
+    heartbeat.remove("handle-small")
+    clock.now = 2000
+    heartbeat.beat()
+    assert "handle-small" not in [call["ReceiptHandle"] for call in sqs.calls[5:]]
+    assert heartbeat.num_extensions == len(sqs.calls)
+    rendered = registry.render()
+    assert 'metoffice_ec2_visibility_extensions_total{kind="small"} 3.0' in rendered
+    assert "metoffice_ec2_messages_in_flight 2.0" in rendered
@@ -1,9 +1,17 @@
 import os
+import shutil
 
 import boto3
 import pytest
+import s3fs
+import xarray as xr
 from moto import mock_s3, mock_sqs
 
+from metoffice_ec2 import storage
+from metoffice_ec2.concurrency import ProcessingTimes
+from metoffice_ec2.message import RecentlySeen
+from metoffice_ec2.metrics import MessageMetrics, MetricsRegistry
+from scripts import ec2
 from scripts.ec2 import loop
 
 
@@ -21,6 +29,16 @@ def aws_credentials():
     os.environ["AWS_SESSION_TOKEN"] = "testing"
 
 
+@pytest.fixture(autouse=True)
+def fresh_clients(monkeypatch):
+    """Don't re-use SQS clients, S3FileSystems or the record of recently
+    processed messages between tests."""
+    ec2.reset_clients()
+    monkeypatch.setattr(ec2, "_RECENTLY_PROCESSED", RecentlySeen())
+    yield
+    ec2.reset_clients()
+
+
 @pytest.fixture(scope="function")
 def queue(aws_credentials):
     with mock_sqs():
@@ -193,3 +211,428 @@ def test_handles_unwanted_messages(
     # Ensure no errors are logged
     for record in caplog.records:
         assert record.levelname != "ERROR"
+
+
+@pytest.fixture(scope="function")
+def worker_pool(monkeypatch):
+    """Process messages in a pool of two workers, of the type requested by
+    the test via `worker_pool.setattr(ec2, "WORKER_TYPE", ...)`."""
+    monkeypatch.setattr(ec2, "NUM_WORKERS", 2)
+    monkeypatch.setattr(ec2, "_EXECUTOR", None)
+    yield monkeypatch
+    ec2.reset_executor()
+
+
+def send_wanted_and_unwanted_messages(queue, s3):
+    source_bucket = s3.Bucket("aws-earth-mo-atmospheric-mogreps-uk-prd")
+    source_bucket.create()
+    wanted = test_input[:2]
+    for _, sns_message_filename, netcdf_path, netcdf_name, _, _ in wanted:
+        queue.send_message(
+            MessageBody=load_sns_message_from_file(
+                f"data/sns_messages/{sns_message_filename}"
+            )
+        )
+        source_bucket.upload_file(netcdf_path, netcdf_name)
+    queue.send_message(
+        MessageBody=load_sns_message_from_file(
+            "data/sns_messages/mogreps_uk_wind_speed_10m.json"
+        )
+    )
+    return wanted
+
+
+def test_handles_messages_with_worker_pool(queue, s3, caplog, worker_pool):
+    registry = MetricsRegistry()
+    worker_pool.setattr(ec2, "REGISTRY", registry)
+    wanted = send_wanted_and_unwanted_messages(queue, s3)
+    output_bucket = s3.Bucket("uk-metoffice-nwp")
+    output_bucket.create()
+
+    loop()
+
+    assert "3 sqs messages received" in caplog.text
+    assert "Message not wanted." in caplog.text
+    for record in caplog.records:
+        assert record.levelname != "ERROR"
+    for _, _, _, _, dest_filename, _ in wanted:
+        assert len(list(output_bucket.objects.filter(Prefix=dest_filename))) > 0
+    assert caplog.text.count("Message finished.") == 2
+    assert caplog.text.count("Deleting message") == 3
+    rendered = registry.render()
+    for var_name, *_ in wanted:
+        assert 'variable="{}"'.format(var_name) in rendered
+    assert rendered.count('stage="compress_upload"} 1.0') == 2
+    assert rendered.count("metoffice_ec2_queue_latency_seconds_count{") == 2
+    assert 'stage="receive"' in rendered
+
+
+def write_marker_file(mo_message, height_meters, s3, compression):
+    """Stand-in for load_subset_and_save_data in worker processes, which
+    can't see the parent process's mocked S3."""
+    path = os.path.join(os.environ["MARKER_DIR"], mo_message.message["name"])
+    with open(path, "w"):
+        pass
+    return MessageMetrics.from_message(mo_message)
+
+
+def kill_worker_process(mo_message, height_meters, s3, compression):
+    os._exit(1)
+
+
+def test_handles_messages_with_process_pool(queue, s3, caplog, worker_pool, tmp_path):
+    worker_pool.setattr(ec2, "WORKER_TYPE", "process")
+    worker_pool.setattr(ec2, "load_subset_and_save_data", write_marker_file)
+    worker_pool.setenv("MARKER_DIR", str(tmp_path))
+    wanted = send_wanted_and_unwanted_messages(queue, s3)
+
+    loop()
+
+    for record in caplog.records:
+        assert record.levelname != "ERROR"
+    assert sorted(os.listdir(tmp_path)) == sorted(var_name for var_name, *_ in wanted)
+    assert caplog.text.count("Deleting message") == 3
+
+
+def test_recovers_from_dead_worker_process(queue, s3, caplog, worker_pool):
+    worker_pool.setattr(ec2, "WORKER_TYPE", "process")
+    worker_pool.setattr(ec2, "load_subset_and_save_data", kill_worker_process)
+    send_wanted_and_unwanted_messages(queue, s3)
+
+    loop()
+
+    assert "BrokenProcessPool" in caplog.text
+    # Only the unwanted message is deleted; the others will be redelivered.
+    assert caplog.text.count("Deleting message") == 1
+    assert ec2._EXECUTOR is None
+
+
+def test_handles_message_with_ranged_download(queue, s3, caplog, monkeypatch):
+    monkeypatch.setattr(ec2, "NETCDF_LOAD_MODE", "ranged")
+    _, sns_message_filename, netcdf_path, netcdf_name, dest_filename, _ = test_input[0]
+    queue.send_message(
+        MessageBody=load_sns_message_from_file(
+            f"data/sns_messages/{sns_message_filename}"
+        )
+    )
+    source_bucket = s3.Bucket("aws-earth-mo-atmospheric-mogreps-uk-prd")
+    source_bucket.create()
+    source_bucket.upload_file(netcdf_path, netcdf_name)
+    output_bucket = s3.Bucket("uk-metoffice-nwp")
+    output_bucket.create()
+
+    loop()
+
+    assert "range requests" in caplog.text
+    for record in caplog.records:
+        assert record.levelname != "ERROR"
+    assert len(list(output_bucket.objects.filter(Prefix=dest_filename))) > 0
+    assert "Deleting message" in caplog.text
+
+
+def test_drains_unwanted_messages_in_batches(queue, s3, caplog, monkeypatch):
+    monkeypatch.setattr(ec2, "MAX_RECEIVES_PER_LOOP", 3)
+    sns_message = load_sns_message_from_file(
+        "data/sns_messages/mogreps_uk_wind_speed_10m.json"
+    )
+    for _ in range(12):
+        queue.send_message(MessageBody=sns_message)
+
+    loop()
+
+    assert "12 sqs messages received" in caplog.text
+    assert caplog.text.count("Message not wanted.") == 12
+    queue.reload()
+    assert queue.attributes["ApproximateNumberOfMessages"] == "0"
+    assert queue.attributes["ApproximateNumberOfMessagesNotVisible"] == "0"
+
+
+class FlakySQS:
+    """Fails to delete the first message of each batch, once."""
+
+    def __init__(self):
+        self.batches = []
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.batches.append([entry["ReceiptHandle"] for entry in Entries])
+        if len(self.batches) == 1:
+            return {"Failed": [{"Id": Entries[0]["Id"], "SenderFault": False}]}
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+
+def test_delete_messages_retries_failures():
+    sqs = FlakySQS()
+    sqs_messages = [{"ReceiptHandle": str(i)} for i in range(12)]
+    ec2.delete_messages(sqs, sqs_messages)
+    assert sqs.batches == [[str(i) for i in range(10)], ["0"], ["10", "11"]]
+
+
+def test_run_loops_stops_after_max_messages(monkeypatch):
+    num_loops = []
+
+    def fake_loop():
+        num_loops.append(1)
+        return 4
+
+    monkeypatch.setattr(ec2, "loop", fake_loop)
+    ec2.run_loops(max_messages=10)
+    assert len(num_loops) == 3
+
+
+def exit_with_error(*args):
+    os._exit(1)
+
+
+def test_supervisor_replaces_dead_workers(monkeypatch, caplog):
+    monkeypatch.setattr(ec2, "run_loops", exit_with_error)
+    monkeypatch.setattr(ec2, "CHILD_RESTART_DELAY_SECS", 0)
+    ec2.supervise(num_children=2)
+    assert caplog.text.count("Started worker process") == 2
+    assert caplog.text.count("died with exit code 1") == 2
+
+
+def test_writes_per_run_zarr(queue, s3, caplog, monkeypatch):
+    monkeypatch.setattr(ec2, "ZARR_LAYOUT", "per_run")
+    var_name, sns_message_filename, netcdf_path, netcdf_name, _, _ = test_input[0]
+    queue.send_message(
+        MessageBody=load_sns_message_from_file(
+            f"data/sns_messages/{sns_message_filename}"
+        )
+    )
+    source_bucket = s3.Bucket("aws-earth-mo-atmospheric-mogreps-uk-prd")
+    source_bucket.create()
+    source_bucket.upload_file(netcdf_path, netcdf_name)
+    output_bucket = s3.Bucket("uk-metoffice-nwp")
+    output_bucket.create()
+
+    loop()
+
+    for record in caplog.records:
+        assert record.levelname != "ERROR"
+    zarr_keys = [obj.key for obj in output_bucket.objects.all()]
+    assert any(key.endswith(".zarr/.zmetadata") for key in zarr_keys)
+    run_zarr = zarr_keys[0].split(".zarr/")[0] + ".zarr"
+    assert run_zarr.endswith(f"{var_name}__2020-07-16T14.zarr")
+    dataset = xr.open_zarr(
+        s3fs.S3Map(root=f"uk-metoffice-nwp/{run_zarr}", s3=ec2.new_dest_filesystem())
+    )
+    written = dataset[var_name].dropna("time", how="all")
+    assert written.sizes["time"] == 1
+
+
+def test_skips_stores_in_manifest(queue, s3, caplog, monkeypatch, tmp_path):
+    monkeypatch.setattr(ec2, "MANIFEST_PATH", str(tmp_path / "manifest.sqlite"))
+    monkeypatch.setattr(ec2, "_MANIFEST", None)
+    _, sns_message_filename, netcdf_path, netcdf_name, dest_filename, _ = test_input[0]
+    source_bucket = s3.Bucket("aws-earth-mo-atmospheric-mogreps-uk-prd")
+    source_bucket.create()
+    source_bucket.upload_file(netcdf_path, netcdf_name)
+    output_bucket = s3.Bucket("uk-metoffice-nwp")
+    output_bucket.create()
+
+    for _ in range(2):
+        queue.send_message(
+            MessageBody=load_sns_message_from_file(
+                f"data/sns_messages/{sns_message_filename}"
+            )
+        )
+        loop()
+        # Check the manifest rather than the record of recent messages.
+        monkeypatch.setattr(ec2, "_RECENTLY_PROCESSED", RecentlySeen())
+
+    assert len(list(output_bucket.objects.filter(Prefix=dest_filename))) > 0
+    assert caplog.text.count("SUCCESS! dest_url") == 1
+    assert "according to the manifest" in caplog.text
+    assert caplog.text.count("Deleting message") == 2
+
+
+def test_skips_existing_destination_without_downloading(queue, s3, caplog):
+    _, sns_message_filename, _, _, dest_filename, _ = test_input[0]
+    queue.send_message(
+        MessageBody=load_sns_message_from_file(
+            f"data/sns_messages/{sns_message_filename}"
+        )
+    )
+    # The source NetCDF isn't uploaded, so downloading it would fail.
+    s3.Bucket("aws-earth-mo-atmospheric-mogreps-uk-prd").create()
+    output_bucket = s3.Bucket("uk-metoffice-nwp")
+    output_bucket.create()
+    output_bucket.put_object(Key=dest_filename + "/.zmetadata", Body=b"{}")
+
+    loop()
+
+    for record in caplog.records:
+        assert record.levelname != "ERROR"
+    assert "Not downloading" in caplog.text
+    assert "Deleting message" in caplog.text
+
+
+def test_deletes_duplicate_messages(queue, s3, caplog):
+    _, sns_message_filename, netcdf_path, netcdf_name, _, _ = test_input[0]
+    source_bucket = s3.Bucket("aws-earth-mo-atmospheric-mogreps-uk-prd")
+    source_bucket.create()
+    source_bucket.upload_file(netcdf_path, netcdf_name)
+    s3.Bucket("uk-metoffice-nwp").create()
+
+    for _ in range(2):
+        queue.send_message(
+            MessageBody=load_sns_message_from_file(
+                f"data/sns_messages/{sns_message_filename}"
+            )
+        )
+        loop()
+
+    assert caplog.text.count("Message is wanted!") == 1
+    assert "duplicate of a recently processed message" in caplog.text
+    assert caplog.text.count("Deleting message") == 2
+
+
+def test_avoids_duplicate_work_and_learns_processing_times(
+    queue, s3, caplog, monkeypatch, tmp_path
+):
+    registry = MetricsRegistry()
+    monkeypatch.setattr(ec2, "REGISTRY", registry)
+    processing_times_path = str(tmp_path / "processing_times.json")
+    monkeypatch.setattr(ec2, "PROCESSING_TIMES_PATH", processing_times_path)
+    monkeypatch.setattr(ec2, "_PROCESSING_TIMES", None)
+    _, sns_message_filename, netcdf_path, netcdf_name, _, _ = test_input[0]
+    source_bucket = s3.Bucket("aws-earth-mo-atmospheric-mogreps-uk-prd")
+    source_bucket.create()
+    source_bucket.upload_file(netcdf_path, netcdf_name)
+    s3.Bucket("uk-metoffice-nwp").create()
+    sns_message = load_sns_message_from_file(
+        f"data/sns_messages/{sns_message_filename}"
+    )
+
+    # Duplicate notifications in one batch.
+    for _ in range(2):
+        queue.send_message(MessageBody=sns_message)
+    loop()
+    assert caplog.text.count("Message is wanted!") == 1
+    assert caplog.text.count("Deleting message") == 2
+    kind = "mo-atmospheric-mogreps-uk-prd/air_temperature"
+    assert ProcessingTimes.load(processing_times_path).estimate(kind) > 0
+
+    # The same notification, once it's no longer remembered.
+    monkeypatch.setattr(ec2, "_RECENTLY_PROCESSED", RecentlySeen())
+    queue.send_message(MessageBody=sns_message)
+    loop()
+    assert caplog.text.count("Message is wanted!") == 2
+    assert "Not downloading" in caplog.text
+
+    rendered = registry.render()
+    for reason in ["same_batch", "destination_exists"]:
+        assert f'reason="{reason}"}} 1.0' in rendered
+    assert f'metoffice_ec2_visibility_extensions_total{{kind="{kind}"}}' in rendered
+
+
+def test_handles_messages_with_asyncio_io(queue, s3, caplog, monkeypatch):
+    monkeypatch.setattr(ec2, "IO_MODE", "asyncio")
+    monkeypatch.setattr(ec2, "UPLOAD_CONCURRENCY", 4)
+    wanted = send_wanted_and_unwanted_messages(queue, s3)
+    output_bucket = s3.Bucket("uk-metoffice-nwp")
+    output_bucket.create()
+
+    loop()
+
+    for record in caplog.records:
+        assert record.levelname != "ERROR"
+    s3_fs = s3fs.S3FileSystem(skip_instance_cache=True)
+    for var_name, _, _, _, dest_filename, _ in wanted:
+        dataset = xr.open_zarr(
+            s3fs.S3Map("uk-metoffice-nwp/" + dest_filename, s3=s3_fs),
+            consolidated=True,
+        )
+        assert var_name in dataset
+    assert caplog.text.count("Message finished.") == 2
+    assert caplog.text.count("Deleting message") == 3
+
+
+def test_handles_messages_with_pipeline(queue, s3, caplog, monkeypatch):
+    registry = MetricsRegistry()
+    monkeypatch.setattr(ec2, "REGISTRY", registry)
+    monkeypatch.setattr(ec2, "IO_MODE", "pipeline")
+    wanted = send_wanted_and_unwanted_messages(queue, s3)
+    output_bucket = s3.Bucket("uk-metoffice-nwp")
+    output_bucket.create()
+
+    loop()
+
+    for record in caplog.records:
+        assert record.levelname != "ERROR"
+    for _, _, _, _, dest_filename, _ in wanted:
+        assert len(list(output_bucket.objects.filter(Prefix=dest_filename))) > 0
+    assert caplog.text.count("Message finished.") == 2
+    assert caplog.text.count("Deleting message") == 3
+    rendered = registry.render()
+    for stage in ("download", "subset", "save"):
+        assert 'pipeline_stage_utilization{stage="' + stage + '"}' in rendered
+
+
+@pytest.fixture(scope="function")
+def local_backfill(monkeypatch, tmp_path):
+    """Backfill from, and to, local directories.  The configuration is also
+    set in the environment, for spawned worker processes."""
+    source_dir = tmp_path / "source" / "aws-earth-mo-atmospheric-mogreps-uk-prd"
+    source_dir.mkdir(parents=True)
+    for _, _, netcdf_path, netcdf_name, _, _ in test_input[:2]:
+        shutil.copy(netcdf_path, str(source_dir / netcdf_name))
+    config = {
+        "DEST_URL": "file://" + str(tmp_path / "dest"),
+        "NETCDF_SOURCE": str(tmp_path / "source"),
+    }
+    for name, value in config.items():
+        monkeypatch.setattr(ec2, name, value)
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(ec2, "DEST", storage.Storage(config["DEST_URL"]))
+    archive_paths = [
+        f"data/sns_messages/{sns_message_filename}"
+        for _, sns_message_filename, _, _, _, _ in test_input[:2]
+    ]
+    # A duplicate, and an unwanted message.
+    archive_paths += archive_paths[:1] + [
+        "data/sns_messages/mogreps_uk_wind_from_direction_10m.json"
+    ]
+    yield tmp_path, archive_paths
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_backfill(local_backfill, caplog, num_workers):
+    tmp_path, archive_paths = local_backfill
+    checkpoint_path = str(tmp_path / "checkpoint")
+
+    summary = ec2.run_backfill(archive_paths, checkpoint_path, num_workers)
+
+    assert summary["written"] == 2
+    assert summary["duplicate"] == 1
+    assert summary["unwanted"] == 1
+    for _, _, _, _, dest_filename, _ in test_input[:2]:
+        assert (tmp_path / "dest" / dest_filename / ".zmetadata").exists()
+    assert "Backfill finished: " in caplog.text
+
+    # Resuming skips the messages which have been processed.
+    summary = ec2.run_backfill(archive_paths, checkpoint_path, num_workers)
+    assert summary["checkpointed"] == 2
+    assert summary["duplicate"] == 1
+    assert "written" not in summary
+
+    # Without the checkpoint, the existing Zarr stores aren't rewritten.
+    summary = ec2.run_backfill(archive_paths, None, num_workers)
+    assert summary["existing"] == 2
+    assert "written" not in summary
+
+
+def test_backfill_writes_zipped_stores(local_backfill, monkeypatch):
+    tmp_path, archive_paths = local_backfill
+    monkeypatch.setattr(ec2, "ZIP_ZARR_STORES", True)
+
+    summary = ec2.run_backfill(archive_paths, None, num_workers=1)
+
+    assert summary["written"] == 2
+    var_name, _, netcdf_path, _, dest_filename, _ = test_input[1]
+    zarr_path = tmp_path / "dest" / (dest_filename + ".zip")
+    assert zarr_path.is_file()
+    assert var_name in xr.open_zarr(str(zarr_path)).data_vars
+
+    summary = ec2.run_backfill(archive_paths, None, num_workers=1)
+    assert summary["existing"] == 2
@@ -0,0 +1,71 @@
+import os
+
+import boto3
+import fsspec
+import pytest
+import s3fs
+from moto import mock_s3
+
+import xarray as xr
+from metoffice_ec2.manifest import Manifest, key_for_dataset, key_for_zarr_filename
+from metoffice_ec2.subset import get_zarr_filename
+
+NETCDF_PATH = "data/mogreps/MOGREPS-UK__air_temperature_2020-07-16T14:00:00Z.nc"
+KEY = ("MOGREPS-UK", "air_temperature", "2020-07-16T14", "2020-07-17T00")
+
+
+@pytest.fixture(scope="module")
+def dataset() -> xr.Dataset:
+    return xr.open_dataset(NETCDF_PATH)
+
+
+def test_keys(dataset):
+    assert key_for_dataset(dataset) == KEY
+    assert key_for_zarr_filename(get_zarr_filename(dataset, "bucket")) == KEY
+    assert key_for_zarr_filename("bucket/MOGREPS-UK/not_a_store") is None
+
+
+def test_manifest_persists(tmp_path):
+    path = str(tmp_path / "manifest.sqlite")
+    manifest = Manifest(path)
+    assert KEY not in manifest
+    manifest.add(KEY, "bucket/path.zarr")
+    assert KEY in manifest
+    manifest.close()
+
+    reopened = Manifest(path)
+    assert KEY in reopened
+    assert len(reopened) == 1
+
+
+def test_manifest_rebuilds_from_bucket_listing(dataset):
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    with mock_s3():
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket="bucket")
+        zarr_filename = get_zarr_filename(dataset, "bucket")
+        zarr_key = zarr_filename[len("bucket/") :]
+        s3_client.put_object(Bucket="bucket", Key=zarr_key + "/.zmetadata", Body=b"")
+        # An incomplete store, without consolidated metadata.
+        s3_client.put_object(
+            Bucket="bucket",
+            Key="MOGREPS-UK/x/MOGREPS-UK__x__2020-07-16T14__2020-07-16T15.zarr/.zgroup",
+            Body=b"",
+        )
+
+        manifest = Manifest()
+        s3 = s3fs.S3FileSystem(skip_instance_cache=True)
+        assert manifest.rebuild(s3, "bucket") == 1
+        assert KEY in manifest
+
+
+def test_manifest_rebuilds_with_zipped_stores(dataset, tmp_path):
+    zarr_filename = get_zarr_filename(dataset, str(tmp_path), zipped=True)
+    assert key_for_zarr_filename(zarr_filename) == KEY
+    fs = fsspec.filesystem("file", auto_mkdir=True)
+    fs.pipe_file(zarr_filename, b"")
+
+    manifest = Manifest()
+    assert manifest.rebuild(fs, str(tmp_path)) == 1
+    assert KEY in manifest
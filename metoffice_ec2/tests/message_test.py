@@ -4,7 +4,14 @@ from pathlib import Path
 import pandas as pd
 import pytest
 
-from metoffice_ec2.message import MetOfficeMessage
+from metoffice_ec2.message import (
+    MetOfficeMessage,
+    RecentlySeen,
+    classify_messages,
+    compile_params,
+    prioritise,
+)
+from metoffice_ec2.metrics import MessageMetrics
 
 
 def _load_message(filename: str) -> MetOfficeMessage:
@@ -70,3 +77,99 @@ def test_is_wanted_single_level_wind(single_level_wind_message):
         "name"
     )
     assert not single_level_wind_message.is_wanted(not_wanted)
+
+
+def test_compile_params():
+    params = pd.DataFrame(
+        [
+            {"name": "wind_speed", "height": [10, 50]},
+            {"name": "surface_temperature"},
+        ]
+    ).set_index("name")
+    assert compile_params(params) == {
+        "wind_speed": (frozenset([10, 50]),),
+        "surface_temperature": (frozenset(),),
+    }
+
+
+def test_classify_messages(multi_level_wind_message, single_level_wind_message):
+    params = compile_params(
+        pd.DataFrame([{"name": "wind_speed", "height": [50]}]).set_index("name")
+    )
+    wanted, unwanted = classify_messages(
+        [
+            single_level_wind_message.sqs_message,
+            multi_level_wind_message.sqs_message,
+        ],
+        params,
+    )
+    assert [m.sqs_message for m in wanted] == [multi_level_wind_message.sqs_message]
+    assert [m.sqs_message for m in unwanted] == [single_level_wind_message.sqs_message]
+
+
+def test_height_meters_is_parsed_once(multi_level_wind_message):
+    assert multi_level_wind_message.height_meters() is (
+        multi_level_wind_message.height_meters()
+    )
+
+
+def test_zarr_filename(multi_level_wind_message):
+    assert multi_level_wind_message.manifest_key() == (
+        "MOGREPS-UK",
+        "wind_speed",
+        "2020-05-28T20",
+        "2020-06-01T22",
+    )
+    assert multi_level_wind_message.zarr_filename("bucket") == (
+        "bucket/MOGREPS-UK/wind_speed/2020/m05/d28/h20/"
+        "MOGREPS-UK__wind_speed__2020-05-28T20__2020-06-01T22.zarr"
+    )
+
+
+def test_recently_seen(multi_level_wind_message, single_level_wind_message):
+    recently_seen = RecentlySeen(max_size=1)
+    recently_seen.add(multi_level_wind_message)
+    assert multi_level_wind_message in recently_seen
+    assert single_level_wind_message not in recently_seen
+
+    recently_seen.add(single_level_wind_message)
+    assert single_level_wind_message in recently_seen
+    assert multi_level_wind_message not in recently_seen
+
+
+def test_prioritise():
+    def make_message(name, forecast_reference_time, object_size):
+        mo_message = _load_message("mogreps_uk_wind_speed_10m.json")
+        mo_message.message["name"] = name
+        mo_message.message["forecast_reference_time"] = forecast_reference_time
+        mo_message.message["object_size"] = object_size
+        return mo_message
+
+    old_big = make_message("wind_speed", "2020-05-28T20:00:00Z", 9e6)
+    new_big = make_message("wind_speed", "2020-05-28T21:00:00Z", 9e6)
+    new_small = make_message("wind_speed", "2020-05-28T21:00:00Z", 1e6)
+    old_irradiance = make_message(
+        "surface_downwelling_shortwave_flux_in_air", "2020-05-28T20:00:00Z", 9e6
+    )
+    mo_messages = [old_big, new_big, new_small, old_irradiance]
+
+    assert prioritise(mo_messages, []) == mo_messages
+    assert prioritise(
+        mo_messages,
+        ["inference", "freshness", "size"],
+        ["surface_downwelling_shortwave_flux_in_air"],
+    ) == [old_irradiance, new_small, new_big, old_big]
+    assert prioritise(mo_messages, ["size"]) == [
+        new_small,
+        old_big,
+        new_big,
+        old_irradiance,
+    ]
+    with pytest.raises(ValueError):
+        prioritise(mo_messages, ["colour"])
+
+
+def test_queue_latency(single_level_wind_message):
+    metrics = MessageMetrics.from_message(single_level_wind_message)
+    # The message was sent on 2020-05-29.
+    assert metrics.queue_latency_secs > 365 * 24 * 60 * 60
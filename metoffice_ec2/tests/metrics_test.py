@@ -0,0 +1,91 @@
+import urllib.request
+
+from metoffice_ec2.metrics import MessageMetrics, MetricsRegistry
+from metoffice_ec2.timer import Timer
+
+
+def make_metrics(variable="wind_speed"):
+    metrics = MessageMetrics(
+        model="mo-atmospheric-mogreps-uk-prd", variable=variable, multi_level=True
+    )
+    metrics.add_stage("download", 2.0)
+    metrics.add_stage("subset", 0.5)
+    metrics.bytes_in = 3000
+    metrics.bytes_subset = 8000
+    metrics.bytes_out = 1000
+    metrics.peak_rss_mb = 123.0
+    metrics.queue_latency_secs = 30.0
+    return metrics
+
+
+def test_timer_feeds_metrics():
+    metrics = MessageMetrics()
+    timer = Timer(metrics)
+    timer.tick("Downloading", stage="download")
+    timer.tick("Not a stage")
+    assert list(metrics.stage_secs) == ["download"]
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    registry.record(make_metrics())
+    registry.record(make_metrics())
+    registry.record(MessageMetrics(variable="air_temperature"), success=False)
+    registry.observe("receive", 0.25)
+    rendered = registry.render()
+
+    labels = (
+        'model="mo-atmospheric-mogreps-uk-prd",variable="wind_speed",multi_level="true"'
+    )
+    assert "# TYPE metoffice_ec2_stage_seconds summary" in rendered
+    assert (
+        "metoffice_ec2_stage_seconds_sum{" + labels + ',stage="download"} 4.0'
+    ) in rendered
+    assert (
+        "metoffice_ec2_stage_seconds_count{" + labels + ',stage="download"} 2.0'
+    ) in rendered
+    assert "metoffice_ec2_bytes_in_total{" + labels + "} 6000.0" in rendered
+    assert "metoffice_ec2_compression_ratio{" + labels + "} 8.0" in rendered
+    assert "metoffice_ec2_peak_rss_megabytes 123.0" in rendered
+    assert "metoffice_ec2_queue_latency_seconds_sum{" + labels + "} 60.0" in rendered
+    assert 'variable="air_temperature",multi_level="false",status="failure"' in rendered
+    assert 'metoffice_ec2_stage_seconds_sum{stage="receive"} 0.25' in rendered
+
+
+def test_registry_serves_and_writes(tmp_path):
+    registry = MetricsRegistry()
+    registry.record(make_metrics())
+
+    server = registry.serve(port=0, host="127.0.0.1")
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            assert response.read().decode("utf-8") == registry.render()
+    finally:
+        server.shutdown()
+
+    path = str(tmp_path / "metrics.prom")
+    registry.write(path)
+    with open(path) as f:
+        assert f.read() == registry.render()
+
+
+def test_registry_counts_duplicate_work_avoided():
+    registry = MetricsRegistry()
+    metrics = make_metrics()
+    metrics.work_avoided = "manifest"
+    registry.record(metrics)
+    registry.increment(
+        "duplicate_work_avoided_total", **metrics.labels, reason="manifest"
+    )
+    rendered = registry.render()
+
+    labels = (
+        'model="mo-atmospheric-mogreps-uk-prd",variable="wind_speed",multi_level="true"'
+    )
+    assert (
+        "metoffice_ec2_duplicate_work_avoided_total{"
+        + labels
+        + ',reason="manifest"} 2.0'
+    ) in rendered
+    assert metrics.kind() == "mo-atmospheric-mogreps-uk-prd/wind_speed/multi_level"
@@ -1,14 +1,21 @@
 import imghdr
 from pathlib import Path
 
+import fsspec
+import numpy as np
 import pytest
+from PIL import Image
 from zarr.storage import ZipStore
 
 import xarray as xr
+from metoffice_ec2 import nwp_plot
 from metoffice_ec2.nwp_plot import (
     extract_wind_from_direction,
     filename_for_plot,
+    find_zarr,
+    plot_frames,
     plot_xarray_data_array,
+    plot_zarr_stores,
 )
 
 
@@ -37,3 +44,67 @@ def test_local_plot_pipeline(tmp_path):
         plot_xarray_data_array(ds, da, file)
     assert Path(output_file).is_file()
     assert imghdr.what(output_file) == "png"
+
+
+@pytest.fixture
+def irradiance_run(tmp_path):
+    """Three hourly irradiance datasets, on a coarsened MOGREPS-UK grid."""
+    dataset = (
+        xr.open_zarr(
+            "data/mogreps/MOGREPS-UK__surface_downwelling_shortwave_flux_in_air__2020-09-08T12__2020-09-08T13.zarr.zip"
+        )
+        .isel(projection_x_coordinate=slice(None, None, 8))
+        .isel(projection_y_coordinate=slice(None, None, 8))
+        .load()
+    )
+    return [
+        dataset.assign_coords(time=dataset.time + np.timedelta64(hours, "h"))
+        for hours in range(3)
+    ]
+
+
+# Cartopy downloads coastlines, which often times out.
+RENDERER_KWARGS = {"coastline_resolution": None, "vmin": 0, "vmax": 800}
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_plot_zarr_stores(irradiance_run, tmp_path, num_workers):
+    zarr_dir = tmp_path / "zarr"
+    for i, dataset in enumerate(irradiance_run):
+        dataset.to_zarr(str(zarr_dir / "irradiance{}.zarr".format(i)))
+    fs = fsspec.filesystem("file")
+    zarr_paths = sorted(find_zarr(fs, str(zarr_dir)))
+    animation_path = str(tmp_path / "run.gif")
+
+    output_paths = plot_zarr_stores(
+        fs,
+        zarr_paths,
+        str(tmp_path),
+        num_workers=num_workers,
+        animation_path=animation_path,
+        **RENDERER_KWARGS,
+    )
+
+    assert output_paths == [
+        filename_for_plot(str(tmp_path), zarr_path) for zarr_path in zarr_paths
+    ]
+    for output_path in output_paths:
+        assert imghdr.what(output_path) == "png"
+    with Image.open(animation_path) as animation:
+        assert animation.n_frames == 3
+
+
+def test_plot_frames_reuses_figure(irradiance_run, tmp_path):
+    dataset = xr.concat(irradiance_run, dim="time")
+    nwp_plot._RENDERERS.clear()
+
+    output_paths = plot_frames(dataset, str(tmp_path), **RENDERER_KWARGS)
+
+    assert [Path(path).name for path in output_paths] == [
+        "surface_downwelling_shortwave_flux_in_air_time{:04d}.png".format(i)
+        for i in range(3)
+    ]
+    assert len(nwp_plot._RENDERERS) == 1
+    # Each frame shows different data.
+    images = [Path(path).read_bytes() for path in output_paths]
+    assert len(set(images)) == 3
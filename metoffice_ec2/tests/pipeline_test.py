@@ -0,0 +1,77 @@
+import threading
+import time
+
+from metoffice_ec2.concurrency import MemoryBudget
+from metoffice_ec2.pipeline import Pipeline, Stage
+
+
+def run_pipeline(nwp_pipeline, items):
+    done = {}
+    lock = threading.Lock()
+
+    def on_done(item, value, error):
+        with lock:
+            done[item] = (value, error)
+
+    nwp_pipeline.run(items, on_done)
+    return done
+
+
+def test_pipeline_runs_items_through_every_stage():
+    def fail_on_three(item, value):
+        if item == 3:
+            raise ValueError("three")
+        return value * 10
+
+    nwp_pipeline = Pipeline(
+        [
+            Stage("first", lambda item, _: item + 1, num_workers=2),
+            # Items which need no more work are finished early.
+            Stage("second", lambda item, value: None if item == 0 else value),
+            Stage("third", fail_on_three),
+        ]
+    )
+    done = run_pipeline(nwp_pipeline, range(5))
+
+    assert set(done) == set(range(5))
+    assert done[0] == (None, None)
+    assert done[1] == (20, None)
+    assert done[4] == (50, None)
+    value, error = done[3]
+    assert value is None and isinstance(error, ValueError)
+
+
+def test_pipeline_overlaps_stages():
+    def sleep(item, _):
+        time.sleep(0.05)
+        return item
+
+    nwp_pipeline = Pipeline([Stage("a", sleep), Stage("b", sleep)])
+    run_pipeline(nwp_pipeline, range(6))
+
+    # Run serially, the 12 sleeps would take at least 0.6 seconds.
+    assert nwp_pipeline.wall_secs < 0.5
+    for utilization in nwp_pipeline.utilization().values():
+        assert 0.4 < utilization <= 1
+
+
+def test_pipeline_limits_size_in_flight():
+    budget = MemoryBudget(max_mb=100)
+    max_in_flight = [0.0]
+
+    def record(item, _):
+        max_in_flight[0] = max(max_in_flight[0], budget.in_flight_mb)
+        time.sleep(0.01)
+        return item
+
+    nwp_pipeline = Pipeline(
+        [Stage("download", record, num_workers=4), Stage("save", record)],
+        queue_size=4,
+        budget=budget,
+        size_mb=lambda item: 40,
+    )
+    done = run_pipeline(nwp_pipeline, range(8))
+
+    assert len(done) == 8
+    assert max_in_flight[0] == 80
+    assert budget.in_flight_mb == 0
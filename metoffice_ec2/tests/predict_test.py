@@ -1,8 +1,23 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
 from metoffice_ec2.predict import (
+    ModelRegistry,
+    PVModel,
+    dumps_geojson,
+    iter_predict_batch,
     load_irradiance_data,
     load_model,
     predict,
     predict_as_geojson,
+    predict_batch,
+    predictions_to_geojson,
+    predictions_to_ndjson,
 )
 
 
@@ -41,3 +56,125 @@ def test_predict_zarr():
     assert feature0["properties"]["system_id"] == 973
     assert feature0["properties"]["time"] == "2020-09-08T13:00:00"
     assert feature0["properties"]["pv_yield_predicted"] > 0
+
+
+def test_pv_model_interp_matches_xarray():
+    irradiance = load_irradiance_data(
+        "data/mogreps/MOGREPS-UK__surface_downwelling_shortwave_flux_in_air__2020-09-08T12__2020-09-08T13.zarr.zip"
+    )["surface_downwelling_shortwave_flux_in_air"].isel(realization=0)
+    model_df = load_model("model/predict_pv_yield_nwp.csv")
+    model = PVModel(model_df)
+
+    def expected(data_array):
+        return data_array.interp(
+            projection_x_coordinate=xr.DataArray(model_df["easting"], dims="system_id"),
+            projection_y_coordinate=xr.DataArray(
+                model_df["northing"], dims="system_id"
+            ),
+        ).values
+
+    np.testing.assert_allclose(
+        model.interp(irradiance).values, expected(irradiance), rtol=1e-5
+    )
+    # Flip the grid to check that descending coordinates work too.
+    flipped = irradiance.isel(projection_y_coordinate=slice(None, None, -1))
+    np.testing.assert_allclose(
+        model.interp(flipped).values, expected(flipped), rtol=1e-5
+    )
+    assert len(model._weights) == 2
+
+
+def test_model_registry_reloads_changed_model(tmp_path):
+    path = str(tmp_path / "model.csv")
+    model_df = load_model("model/predict_pv_yield_nwp.csv")
+    model_df.to_csv(path, index=False)
+    registry = ModelRegistry()
+    model = registry.get(path)
+    assert registry.get(path) is model
+
+    model_df.iloc[:10].to_csv(path, index=False)
+    os.utime(path, (0, 0))
+    reloaded = registry.get(path)
+    assert reloaded is not model
+    assert len(reloaded.model_df) == 10
+
+
+def test_predictions_to_geojson_and_ndjson():
+    irradiance_dataset = load_irradiance_data(
+        "data/mogreps/MOGREPS-UK__surface_downwelling_shortwave_flux_in_air__2020-09-08T12__2020-09-08T13.zarr.zip"
+    )
+    predictions = predict(
+        irradiance_dataset, load_model("model/predict_pv_yield_nwp.csv")
+    )
+    # Some systems are outside the MOGREPS-UK grid.
+    assert predictions["pv_yield_predicted"].isna().any()
+
+    feature_collection = json.loads(dumps_geojson(predictions_to_geojson(predictions)))
+    features = feature_collection["features"]
+    assert len(features) == len(predictions)
+    assert features[0]["geometry"]["coordinates"] == [-1.299834, 54.3686]
+    assert features[0]["properties"]["system_id"] == 973
+    assert features[0]["properties"]["forecastTime"] == "2020-09-08T13:00:00"
+    yields = [feature["properties"]["pv_yield_predicted"] for feature in features]
+    assert yields.count(None) == predictions["pv_yield_predicted"].isna().sum()
+
+    records = [
+        json.loads(line) for line in predictions_to_ndjson(predictions).splitlines()
+    ]
+    assert len(records) == len(predictions)
+    assert records[0]["system_id"] == 973
+    assert records[0]["time"] == "2020-09-08T13:00:00"
+
+
+@pytest.fixture
+def irradiance_datasets():
+    """Three hourly MOGREPS-UK irradiance datasets, like separate Zarr stores."""
+    irradiance_dataset = load_irradiance_data(
+        "data/mogreps/MOGREPS-UK__surface_downwelling_shortwave_flux_in_air__2020-09-08T12__2020-09-08T13.zarr.zip"
+    ).load()
+    return [
+        irradiance_dataset.assign_coords(
+            time=irradiance_dataset.time + np.timedelta64(hours, "h")
+        )
+        * (1 + hours / 10)
+        for hours in range(3)
+    ]
+
+
+@pytest.mark.parametrize("max_steps", [1, 2, 256])
+def test_predict_batch_matches_predict(irradiance_datasets, max_steps):
+    model = PVModel(load_model("model/predict_pv_yield_nwp.csv"))
+    expected = pd.concat(
+        [predict(dataset, model) for dataset in irradiance_datasets], ignore_index=True
+    )
+    predictions = predict_batch(irradiance_datasets, model, max_steps=max_steps)
+
+    pd.testing.assert_frame_equal(
+        predictions.drop(columns="forecast_reference_time"), expected
+    )
+    assert (
+        predictions["forecast_reference_time"] == np.datetime64("2020-09-08T12")
+    ).all()
+
+    # The same datasets, concatenated lazily along a time dimension.
+    concatenated = xr.concat(irradiance_datasets, dim="time").chunk({"time": 1})
+    pd.testing.assert_frame_equal(
+        predict_batch(concatenated, model, max_steps=max_steps), predictions
+    )
+
+
+def test_iter_predict_batch_bounds_chunk_size(irradiance_datasets):
+    model = PVModel(load_model("model/predict_pv_yield_nwp.csv"))
+    num_systems = len(model.system_id)
+    chunks = list(iter_predict_batch(irradiance_datasets, model, max_steps=2))
+    assert [len(chunk) for chunk in chunks] == [2 * num_systems, num_systems]
+
+    # Grids with different coordinates aren't predicted together.
+    shifted = irradiance_datasets[1].assign_coords(
+        projection_x_coordinate=irradiance_datasets[1].projection_x_coordinate + 1000
+    )
+    chunks = list(
+        iter_predict_batch([irradiance_datasets[0], shifted], model, max_steps=2)
+    )
+    assert [len(chunk) for chunk in chunks] == [num_systems, num_systems]
+    assert len(predict_batch([], model)) == 0
@@ -0,0 +1,19 @@
+import tracemalloc
+
+from metoffice_ec2.profiling import MemoryProfiler
+
+
+def test_memory_profiler_finds_growing_allocations(caplog):
+    profiler = MemoryProfiler(top_n=3)
+    try:
+        profiler.top_allocations()
+        leak = [bytearray(1000) for _ in range(1000)]  # noqa: F841
+        top = profiler.top_allocations()
+        assert top[0].size_diff >= 1e6
+        assert top[0].traceback[0].filename == __file__
+
+        caplog.set_level("INFO")
+        profiler.log_top_allocations()
+        assert "Traced memory" in caplog.text
+    finally:
+        tracemalloc.stop()
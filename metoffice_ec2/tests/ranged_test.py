@@ -0,0 +1,70 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_s3
+
+import xarray as xr
+from metoffice_ec2 import subset
+from metoffice_ec2.ranged import S3RangedFile
+
+NETCDF_PATH = "data/mogreps/MOGREPS-UK__wind_speed_2020-07-26T13:00:00Z.nc"
+BUCKET = "aws-earth-mo-atmospheric-mogreps-uk-prd"
+KEY = "322e3e40b90b05604152dfa5ad9698d618b61c19.nc"
+
+
+@pytest.fixture(scope="function")
+def s3_client():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    with mock_s3():
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket=BUCKET)
+        s3_client.upload_file(NETCDF_PATH, BUCKET, KEY)
+        yield s3_client
+
+
+def test_read_and_seek(s3_client):
+    with open(NETCDF_PATH, "rb") as f:
+        expected = f.read()
+
+    ranged_file = S3RangedFile(BUCKET, KEY, s3_client=s3_client, block_size=1000)
+    assert ranged_file.size == len(expected)
+    assert ranged_file.read(10) == expected[:10]
+
+    ranged_file.seek(2500)
+    assert ranged_file.read(1000) == expected[2500:3500]
+    # Blocks 2 and 3 were fetched with one request.
+    assert ranged_file.num_requests == 2
+
+    ranged_file.seek(-5, os.SEEK_END)
+    assert ranged_file.read() == expected[-5:]
+    assert ranged_file.read() == b""
+
+
+def test_cache_is_bounded(s3_client):
+    ranged_file = S3RangedFile(
+        BUCKET, KEY, s3_client=s3_client, block_size=1000, max_blocks=4
+    )
+    for offset in range(0, 20000, 1000):
+        ranged_file.seek(offset)
+        ranged_file.read(10)
+    assert len(ranged_file._blocks) == 4
+
+
+def test_subset_downloads_less_than_whole_file(s3_client):
+    ranged_file = S3RangedFile(BUCKET, KEY, s3_client=s3_client, block_size=16384)
+    dataset = xr.open_dataset(ranged_file, engine="h5netcdf")
+    dataset = subset.subset(
+        dataset, north=200000, south=-200000, east=200000, west=-200000
+    ).load()
+    assert 0 < ranged_file.bytes_transferred < ranged_file.size / 2
+
+    expected = subset.subset(
+        xr.open_dataset(NETCDF_PATH),
+        north=200000,
+        south=-200000,
+        east=200000,
+        west=-200000,
+    )
+    xr.testing.assert_identical(dataset, expected)
@@ -0,0 +1,85 @@
+import os
+
+import fsspec
+import pytest
+
+import xarray as xr
+from metoffice_ec2 import storage, subset
+
+NETCDF_PATH = "data/mogreps/MOGREPS-UK__wind_speed_2020-07-26T13:00:00Z.nc"
+
+
+@pytest.fixture(scope="module")
+def dataset() -> xr.Dataset:
+    return xr.open_dataset(NETCDF_PATH).isel(realization=[0]).load()
+
+
+@pytest.mark.parametrize(
+    "url, protocol, root",
+    [
+        ("s3://uk-metoffice-nwp", "s3", "uk-metoffice-nwp"),
+        ("s3://uk-metoffice-nwp/staging/", "s3", "uk-metoffice-nwp/staging"),
+        ("memory://nwp", "memory", "/nwp"),
+        ("file:///mnt/nvme/nwp", "file", "/mnt/nvme/nwp"),
+        ("/mnt/nvme/nwp", "file", "/mnt/nvme/nwp"),
+    ],
+)
+def test_storage_parses_urls(url, protocol, root):
+    dest = storage.Storage(url)
+    assert dest.protocol == protocol
+    assert dest.root == root
+    assert dest.path("a", "b.zarr") == root + "/a/b.zarr"
+
+
+def test_storage_filesystems_are_new_instances(tmp_path):
+    dest = storage.Storage(str(tmp_path))
+    fs = dest.filesystem()
+    assert fs is not dest.filesystem()
+    # Parent directories are created as needed.
+    fs.pipe_file(dest.path("a/b/c.txt"), b"c")
+    assert (tmp_path / "a" / "b" / "c.txt").read_bytes() == b"c"
+
+
+@pytest.mark.parametrize("zipped", [False, True])
+@pytest.mark.parametrize("concurrently", [False, True])
+def test_write_zarr_to_memory_filesystem(dataset, zipped, concurrently, tmp_path):
+    dest = storage.Storage(
+        "memory://test_write_zarr_{}_{}".format(zipped, concurrently)
+    )
+    fs = dest.filesystem()
+    full_zarr_filename = subset.get_zarr_filename(dataset, dest.root, zipped)
+    assert full_zarr_filename.endswith(".zarr.zip" if zipped else ".zarr")
+    if concurrently:
+        subset.write_zarr_to_s3_concurrently(
+            dataset, full_zarr_filename, fs, compression="fast"
+        )
+    else:
+        subset.write_zarr_to_s3(dataset, full_zarr_filename, fs, compression="fast")
+
+    if zipped:
+        assert fs.isfile(full_zarr_filename)
+        store = os.path.join(str(tmp_path), "local.zarr.zip")
+        fs.get_file(full_zarr_filename, store)
+    else:
+        store = fs.get_mapper(full_zarr_filename)
+    loaded = xr.open_zarr(store)
+    xr.testing.assert_equal(loaded["wind_speed"], dataset["wind_speed"])
+
+    with pytest.raises(subset.FileExistsError):
+        subset.write_zarr_to_s3(dataset, full_zarr_filename, fs, compression="fast")
+
+
+def test_zip_store_is_readable_by_zarr(dataset, tmp_path):
+    compressed = {}
+    subset.write_zarr(dataset, compressed, compression="fast")
+    path = os.path.join(str(tmp_path), "dataset.zarr.zip")
+    with open(path, "wb") as f:
+        f.write(storage.zip_store(compressed))
+    loaded = xr.open_zarr(path)
+    xr.testing.assert_equal(loaded["wind_speed"], dataset["wind_speed"])
+
+
+def test_regions_cant_be_written_to_zipped_stores(dataset):
+    fs = fsspec.filesystem("memory")
+    with pytest.raises(ValueError):
+        subset.write_zarr_region_to_s3(dataset, "/nwp/run.zarr.zip", fs)
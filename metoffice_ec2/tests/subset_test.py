@@ -0,0 +1,175 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import zarr
+
+import xarray as xr
+from metoffice_ec2.subset import (
+    COMPRESSION_PROFILES,
+    choose_chunks,
+    quantization_encoding,
+    run_times,
+    subset,
+    write_zarr,
+    write_zarr_region,
+)
+
+NETCDF_PATH = "data/mogreps/MOGREPS-UK__wind_speed_2020-07-26T13:00:00Z.nc"
+
+
+@pytest.fixture(scope="module")
+def dataset() -> xr.Dataset:
+    return xr.open_dataset(NETCDF_PATH).load()
+
+
+def test_choose_chunks(dataset):
+    chunks = choose_chunks(dataset["wind_speed"], target_chunk_mb=1)
+    assert chunks["realization"] == 1
+    assert chunks["projection_x_coordinate"] == dataset.sizes["projection_x_coordinate"]
+    assert chunks["projection_y_coordinate"] < dataset.sizes["projection_y_coordinate"]
+    chunk_bytes = (
+        chunks["projection_y_coordinate"] * chunks["projection_x_coordinate"] * 4
+    )
+    assert chunk_bytes <= 1e6
+
+
+@pytest.mark.parametrize("compression", list(COMPRESSION_PROFILES))
+def test_write_zarr_round_trips(dataset, compression):
+    store = zarr.MemoryStore()
+    write_zarr(dataset, store, compression=compression, num_threads=2)
+    loaded = xr.open_zarr(store)
+    xr.testing.assert_equal(loaded["wind_speed"], dataset["wind_speed"])
+    assert loaded["wind_speed"].encoding["chunks"][0] == 1
+
+
+def test_write_zarr_region_concurrently(dataset):
+    dataset = subset(dataset, north=100000, south=-100000, east=100000, west=-100000)
+    one_hour = np.timedelta64(1, "h")
+    datasets = [
+        dataset.assign(wind_speed=dataset["wind_speed"] + i).assign_coords(
+            time=dataset.time.values + i * one_hour,
+            forecast_period=dataset.forecast_period.values + i * one_hour,
+        )
+        for i in range(4)
+    ]
+    store = zarr.MemoryStore()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(
+            executor.map(
+                lambda ds: write_zarr_region(ds, store, compression="fast"), datasets
+            )
+        )
+
+    loaded = xr.open_zarr(store)
+    assert loaded.sizes["time"] == len(run_times(dataset))
+    assert loaded.time.values[0] == dataset.forecast_reference_time.values
+    for ds in datasets:
+        written = loaded["wind_speed"].sel(time=ds.time.values)
+        np.testing.assert_array_equal(written.values, ds["wind_speed"].values)
+        assert written.forecast_period.values == ds.forecast_period.values
+    assert loaded["wind_speed"].count("time").max() == len(datasets)
+
+
+BOUNDARY = dict(north=100000.0, south=-150000.0, east=120000.0, west=-90000.0)
+
+
+def test_subset_matches_label_based_selection():
+    dataset = xr.open_dataset(
+        "data/mogreps/MOGREPS-UK__wind_speed_2020-07-26T13:00:00Z.nc"
+    )
+    expected = dataset.loc[
+        dict(
+            projection_x_coordinate=slice(BOUNDARY["west"], BOUNDARY["east"]),
+            projection_y_coordinate=slice(BOUNDARY["south"], BOUNDARY["north"]),
+        )
+    ]
+    for _ in range(2):  # The second time, the indexers are cached.
+        subset_ds = subset(dataset, **BOUNDARY)
+        xr.testing.assert_identical(subset_ds, expected)
+
+
+def test_subset_selects_heights():
+    dims = ("height", "projection_y_coordinate", "projection_x_coordinate")
+    dataset = xr.Dataset(
+        {"wind_speed": (dims, np.ones((4, 1, 3)))},
+        coords={
+            "height": [5.0, 10.0, 20.0, 50.0],
+            "projection_y_coordinate": [0.0],
+            "projection_x_coordinate": [0.0, 1.0, 2.0],
+        },
+    )
+    subset_ds = subset(dataset, height_meters=[10, 50])
+    np.testing.assert_array_equal(subset_ds.height.values, [10.0, 50.0])
+    with pytest.raises(KeyError):
+        subset(dataset, height_meters=[10, 15])
+
+
+def test_subset_is_lazy():
+    dataset = xr.open_dataset(
+        "data/mogreps/MOGREPS-UK__wind_speed_2020-07-26T13:00:00Z.nc"
+    )
+    subset_ds = subset(dataset, **BOUNDARY)
+    # Nothing has been read yet, so only the subset will be read on `load`.
+    assert not isinstance(subset_ds["wind_speed"].variable._data, np.ndarray)
+    assert not isinstance(dataset["wind_speed"].variable._data, np.ndarray)
+    assert subset_ds.load()["wind_speed"].shape[-2:] == (
+        subset_ds.sizes["projection_y_coordinate"],
+        subset_ds.sizes["projection_x_coordinate"],
+    )
+
+
+@pytest.mark.parametrize(
+    "quantization,max_error",
+    [
+        ({"method": "quantize", "precision": 1}, 0.5),
+        ({"method": "float16"}, 0.02),
+        ({"method": "scale_offset", "precision": 0.01, "offset": 10.0}, 0.006),
+    ],
+)
+def test_write_zarr_quantized(dataset, quantization, max_error):
+    lossless_store = zarr.MemoryStore()
+    write_zarr(dataset, lossless_store, compression="fast")
+    store = zarr.MemoryStore()
+    write_zarr(dataset, store, compression="fast", quantization=quantization)
+
+    loaded = xr.open_zarr(store)["wind_speed"].values
+    error = np.abs(loaded.astype(np.float64) - dataset["wind_speed"].values)
+    assert np.nanmax(error) <= max_error
+    assert sum(map(len, store.values())) < sum(map(len, lossless_store.values()))
+
+
+def test_scale_offset_keeps_missing_values():
+    dataset = xr.Dataset({"air_temperature": ("x", [280.0, np.nan, 290.125])})
+    store = zarr.MemoryStore()
+    write_zarr(
+        dataset,
+        store,
+        compression="fast",
+        quantization={"method": "scale_offset", "precision": 0.25, "offset": 285},
+    )
+    np.testing.assert_array_equal(
+        xr.open_zarr(store)["air_temperature"].values, [280.0, np.nan, 290.0]
+    )
+
+
+def test_quantization_encoding(dataset):
+    assert quantization_encoding(dataset["wind_speed"], None) == {}
+    assert quantization_encoding(dataset["wind_speed"], np.nan) == {}
+    with pytest.raises(ValueError):
+        quantization_encoding(
+            dataset["wind_speed"],
+            {"method": "scale_offset", "precision": 0.0001, "offset": 0},
+        )
+
+
+def test_write_zarr_region_quantized(dataset):
+    dataset = subset(dataset, north=100000, south=-100000, east=100000, west=-100000)
+    quantization = {"method": "scale_offset", "precision": 0.0625, "offset": 0}
+    store = zarr.MemoryStore()
+    write_zarr_region(dataset, store, compression="fast", quantization=quantization)
+
+    assert zarr.open_group(store)["wind_speed"].dtype == np.int16
+    written = xr.open_zarr(store)["wind_speed"].sel(time=dataset.time.values)
+    # The sample wind speeds are multiples of 1/16, so they're stored exactly.
+    np.testing.assert_array_equal(written.values, dataset["wind_speed"].values)
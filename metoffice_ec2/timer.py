@@ -5,11 +5,19 @@ _LOG = logging.getLogger("metoffice_ec2")
 
 
 class Timer:
-    def __init__(self):
+    def __init__(self, metrics=None):
+        """
+        Args:
+          metrics: Optional metrics.MessageMetrics.  Ticks with a `stage`
+            record their duration in it.
+        """
         self.t = time.time()
+        self.metrics = metrics
 
-    def tick(self, label=""):
+    def tick(self, label="", stage=None):
         now = time.time()
         time_since_last_tick = now - self.t
         self.t = now
         _LOG.info("{} took {:.2f} secs.".format(label, time_since_last_tick))
+        if self.metrics is not None and stage is not None:
+            self.metrics.add_stage(stage, time_since_last_tick)
@@ -1,26 +1,58 @@
 #!/usr/bin/env python
+import argparse
+import asyncio
+import io
 import logging
+import multiprocessing
 import os
+import resource
+import threading
 import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timezone
+from typing import Dict, List, Optional
 
 import boto3
+import fsspec
 import pandas as pd
-import s3fs
 import sentry_sdk
-import geojson
 
-from metoffice_ec2 import message, subset
-from metoffice_ec2.timer import Timer
-from metoffice_ec2.predict import (
-    load_model,
-    predict_as_geojson,
+from metoffice_ec2 import (
+    aio,
+    backfill,
+    manifest,
+    message,
+    pipeline,
+    storage,
+    subset,
 )
+from metoffice_ec2.concurrency import (
+    MemoryBudget,
+    ProcessingTimes,
+    VisibilityHeartbeat,
+)
+from metoffice_ec2.metrics import REGISTRY, MessageMetrics
+from metoffice_ec2.profiling import MemoryProfiler
+from metoffice_ec2.ranged import S3RangedFile
+from metoffice_ec2.timer import Timer
+
+# metoffice_ec2.predict is only imported once a message needs inference
+# (see run_inference), to keep startup fast.  See benchmarks/importtime.py.
 
 sentry_sdk.init(
     "https://4e4ddd1fa2aa4353bd904fa74852913e@o400768.ingest.sentry.io/5259484",
     release=f'metoffice_ec2@{os.getenv("RELEASE_VERSION", "UNSET")}',
     environment=os.getenv("SENTRY_ENV", "development"),
+    # Otherwise sentry imports every library it has an integration for
+    # which is installed (e.g. flask), none of which this script uses.
+    auto_enabling_integrations=False,
 )
 
 SQS_URL_DEFAULT = "https://sqs.eu-west-1.amazonaws.com/741607616921/uk-metoffice-nwp"
@@ -29,32 +61,197 @@ SQS_URL = os.getenv("SQS_URL", SQS_URL_DEFAULT)
 DEST_BUCKET_DEFAULT = "uk-metoffice-nwp"
 DEST_BUCKET = os.getenv("DEST_BUCKET", DEST_BUCKET_DEFAULT)
 
-PREDICTIONS_BUCKET = "ocf-forecasting-data"
+# Where the Zarr stores are written: any fsspec URL, e.g. "s3://<bucket>",
+# "file:///mnt/nvme/nwp" to stage them on local disk (and sync them to S3
+# in bulk), or "memory://nwp".  Defaults to the S3 bucket DEST_BUCKET.
+DEST_URL = os.getenv("DEST_URL", "s3://" + DEST_BUCKET)
+DEST = storage.Storage(DEST_URL)
+
+# If "1", write each Zarr store as a single zip file ("<name>.zarr.zip"),
+# which is much cheaper to write and copy than a directory of chunks.
+# Needs ZARR_LAYOUT "per_time".
+ZIP_ZARR_STORES = os.getenv("ZIP_ZARR_STORES", "0") == "1"
+
+# Where PV predictions are written: any fsspec URL, as for DEST_URL.
+PREDICTIONS_URL = os.getenv("PREDICTIONS_URL", "s3://ocf-forecasting-data/nwp")
 
 REGION = "eu-west-1"
 
+# Number of messages to process concurrently.  1 means process messages
+# serially, in the main thread.
+NUM_WORKERS = int(os.getenv("NUM_WORKERS", "1"))
+
+# "thread" or "process".  Only used when NUM_WORKERS > 1.
+WORKER_TYPE = os.getenv("WORKER_TYPE", "thread")
+
+# Upper bound on the summed size of the NetCDF files being processed at once.
+MAX_IN_FLIGHT_MB = float(os.getenv("MAX_IN_FLIGHT_MB", "1000"))
+
+# Keep in-flight messages invisible to other consumers by extending their
+# visibility timeout when they are received, and then (checking every
+# HEARTBEAT_INTERVAL_SECS) before it expires, until they're finished.  Each
+# extension is VISIBILITY_SAFETY_FACTOR times the time messages of the same
+# kind have taken to process, or VISIBILITY_TIMEOUT_SECS until that has
+# been learned.  See concurrency.VisibilityHeartbeat.
+VISIBILITY_TIMEOUT_SECS = int(os.getenv("VISIBILITY_TIMEOUT_SECS", "600"))
+HEARTBEAT_INTERVAL_SECS = float(os.getenv("HEARTBEAT_INTERVAL_SECS", "60"))
+VISIBILITY_SAFETY_FACTOR = float(os.getenv("VISIBILITY_SAFETY_FACTOR", "2"))
+
+# If set, the processing times learned for the visibility heartbeat are
+# loaded from this JSON file on startup, and saved to it after every loop,
+# so they survive restarts (and recycled child processes).
+PROCESSING_TIMES_PATH = os.getenv("PROCESSING_TIMES_PATH")
+
+# "memory" downloads each NetCDF file into memory in one go.  "ranged" only
+# downloads the byte ranges needed for the subset, using HTTP range requests.
+NETCDF_LOAD_MODE = os.getenv("NETCDF_LOAD_MODE", "memory")
+
+# If set, NetCDF files are read from "<NETCDF_SOURCE>/<bucket>/<key>" (any
+# fsspec URL, e.g. a local directory of archived files) instead of from the
+# Met Office's S3 buckets.  Only used when NETCDF_LOAD_MODE is "memory".
+NETCDF_SOURCE = os.getenv("NETCDF_SOURCE")
+
+# "blocking" downloads, processes and uploads one message at a time.
+# "asyncio" downloads the NetCDF files of up to PREFETCH_MESSAGES - 1
+# upcoming messages while the current message is subset and compressed,
+# and uploads Zarr chunks with up to UPLOAD_CONCURRENCY uploads in flight.
+# "pipeline" runs messages through download, subset and save stages, each
+# in its own threads, connected by queues of at most PIPELINE_QUEUE_SIZE
+# messages, while the NetCDF files in flight fit in MAX_IN_FLIGHT_MB.
+# Only used when NUM_WORKERS is 1.
+IO_MODE = os.getenv("IO_MODE", "blocking")
+PREFETCH_MESSAGES = int(os.getenv("PREFETCH_MESSAGES", "2"))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "16"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "1"))
+PIPELINE_DOWNLOAD_WORKERS = int(os.getenv("PIPELINE_DOWNLOAD_WORKERS", "2"))
+
+# If set, the Zarr stores written are recorded in an SQLite database at
+# MANIFEST_PATH, so checking whether a store already exists needs no S3
+# requests.  If the database is empty, it's rebuilt from a bucket listing.
+MANIFEST_PATH = os.getenv("MANIFEST_PATH")
+
+# Number of recently processed messages to remember, so that duplicate
+# notifications and redeliveries can be deleted without any S3 requests.
+RECENTLY_PROCESSED_MAX_SIZE = int(os.getenv("RECENTLY_PROCESSED_MAX_SIZE", "10000"))
+
+# "per_time" writes a Zarr store for every valid time.  "per_run" writes
+# each valid time into a single Zarr store per variable per forecast run.
+ZARR_LAYOUT = os.getenv("ZARR_LAYOUT", "per_time")
+
+# Per-stage metrics are served in the Prometheus text format on METRICS_PORT
+# and/or written to METRICS_FILE every METRICS_FLUSH_INTERVAL_SECS.
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_FLUSH_INTERVAL_SECS = float(os.getenv("METRICS_FLUSH_INTERVAL_SECS", "60"))
+
+# Comma-separated formats to save predictions in: "geojson", "ndjson"
+# (newline-delimited JSON) and/or "parquet" (needs pyarrow).
+PREDICTIONS_FORMATS = os.getenv("PREDICTIONS_FORMATS", "geojson").split(",")
+
+# Comma-separated priorities (names in message.PRIORITIES) which wanted
+# messages are processed in, most important first.  All the messages
+# received in one loop are ordered together, so receiving more batches per
+# loop (MAX_RECEIVES_PER_LOOP) gives a bigger window to choose from.
+# Empty means process messages in the order SQS returns them.
+MESSAGE_PRIORITIES_DEFAULT = "inference,freshness,size"
+MESSAGE_PRIORITIES = os.getenv("MESSAGE_PRIORITIES", MESSAGE_PRIORITIES_DEFAULT)
+MESSAGE_PRIORITIES = [
+    priority for priority in MESSAGE_PRIORITIES.split(",") if priority
+]
+
+# SQS returns, and deletes, at most this many messages per request.
+SQS_MAX_BATCH_SIZE = 10
+
+# How long each loop waits for new messages (at most 20 seconds).
+RECEIVE_WAIT_TIME_SECS = int(os.getenv("RECEIVE_WAIT_TIME_SECS", "20"))
+
+# While the queue returns full batches, receive up to this many batches
+# per loop, so that unwanted messages are deleted in bulk before any
+# heavy work starts.
+MAX_RECEIVES_PER_LOOP = int(os.getenv("MAX_RECEIVES_PER_LOOP", "1"))
+
+# The SQS client and S3FileSystem are re-used, and re-created after this
+# many loops.
+CLIENT_RECYCLE_ITERATIONS = int(os.getenv("CLIENT_RECYCLE_ITERATIONS", "100"))
+
+# If either is non-zero, messages are processed in a child process, which
+# is replaced after it has received RECYCLE_AFTER_MESSAGES messages, or
+# its peak RSS has reached RECYCLE_AFTER_RSS_MB.
+RECYCLE_AFTER_MESSAGES = int(os.getenv("RECYCLE_AFTER_MESSAGES", "0"))
+RECYCLE_AFTER_RSS_MB = float(os.getenv("RECYCLE_AFTER_RSS_MB", "0"))
+CHILD_RESTART_DELAY_SECS = 5
+
+# If non-zero, log the MEMORY_PROFILE_TOP_N source lines whose memory
+# allocations grew the most during each loop, to help find leaks.
+MEMORY_PROFILE_TOP_N = int(os.getenv("MEMORY_PROFILE_TOP_N", "0"))
+
+# How often `backfill` logs its progress and throughput.
+BACKFILL_REPORT_INTERVAL_SECS = float(os.getenv("BACKFILL_REPORT_INTERVAL_SECS", "60"))
+
+# NWP fields which PV yield is predicted from.
+INFERENCE_VARIABLES = ["surface_downwelling_shortwave_flux_in_air"]
+
 WIND_HEIGHTS_METERS = [10, 50, 100, 150]  # Heights for wind power forecasting.
 
-# DataFrame with index 'name' column 'height' (vertical levels in meters).
+# DataFrame with index 'name' column 'height' (vertical levels in meters),
+# column 'compression' (a profile in subset.COMPRESSION_PROFILES) and
+# optional column 'quantization' (a lossy encoding; see
+# subset.quantization_encoding, and benchmarks/quantization.py for the
+# errors and savings of each on the sample data).
 # 'height' should be a list of numbers.
 # Remember to update infrastructure/inputs.tf as well, when modifying this.
 PARAMS_TO_COPY = pd.DataFrame(
     [
         # For wind power forecasting:
         # Select wind_speed at 5 meters to help with PV forecasting.
-        {"name": "wind_speed", "height": [5] + WIND_HEIGHTS_METERS},
-        {"name": "wind_speed_of_gust", "height": WIND_HEIGHTS_METERS},
-        {"name": "wind_from_direction", "height": WIND_HEIGHTS_METERS},
+        {
+            "name": "wind_speed",
+            "height": [5] + WIND_HEIGHTS_METERS,
+            "compression": "archive",
+        },
+        {
+            "name": "wind_speed_of_gust",
+            "height": WIND_HEIGHTS_METERS,
+            "compression": "archive",
+        },
+        {
+            "name": "wind_from_direction",
+            "height": WIND_HEIGHTS_METERS,
+            "compression": "archive",
+        },
         # For solar PV power forecasting:
-        {"name": "air_temperature", "height": [1.5]},
+        # Rounding to multiples of 1/16 saves about 40% for air_temperature
+        # and 20% for the irradiance fields.  The other fields are already
+        # stored to a coarse precision, so only lossy encodings with bigger
+        # errors than we want would make them smaller.
+        {
+            "name": "air_temperature",
+            "height": [1.5],
+            "compression": "archive",
+            "quantization": {"method": "quantize", "precision": 0.1},
+        },
         # The following have no height parameter.
-        {"name": "surface_temperature"},
-        {"name": "surface_diffusive_downwelling_shortwave_flux_in_air"},
-        {"name": "surface_direct_downwelling_shortwave_flux_in_air"},
-        {"name": "surface_downwelling_shortwave_flux_in_air"},
+        {"name": "surface_temperature", "compression": "archive"},
+        {
+            "name": "surface_diffusive_downwelling_shortwave_flux_in_air",
+            "compression": "archive",
+            "quantization": {"method": "quantize", "precision": 0.1},
+        },
+        {
+            "name": "surface_direct_downwelling_shortwave_flux_in_air",
+            "compression": "archive",
+        },
+        {
+            "name": "surface_downwelling_shortwave_flux_in_air",
+            "compression": "archive",
+            "quantization": {"method": "quantize", "precision": 0.1},
+        },
     ]
 ).set_index("name")
 
+# PARAMS_TO_COPY compiled for fast filtering of messages.
+WANTED_PARAMS = message.compile_params(PARAMS_TO_COPY)
+
 # Approximate boundaries of UKV data from JASMIN, projected into
 # MOGREPS-UK's Lambert Azimuthal Equal Area projection.
 DEFAULT_GEO_BOUNDARY = {
@@ -88,21 +285,223 @@ def configure_logger():
 _LOG = configure_logger()
 
 
-def load_subset_and_save_data(mo_message, height_meters, s3):
-    timer = Timer()
-    dataset = mo_message.load_netcdf()
-    timer.tick("Opening xarray Dataset")
-    dataset = subset.subset(dataset, height_meters, **DEFAULT_GEO_BOUNDARY)
-    timer.tick("Subsetting")
-    full_zarr_filename = subset.get_zarr_filename(dataset, DEST_BUCKET)
+# netCDF4 and HDF5 aren't thread-safe, so worker threads take turns to
+# open, subset and load NetCDF files.  Downloading, compressing and
+# uploading still happen concurrently.
+_NETCDF_LOCK = threading.Lock()
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process, in megabytes."""
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def destination_exists(mo_message, s3, metrics=None) -> bool:
+    """Returns True if the message's subset has already been written.
+
+    Uses only the message's metadata, so nothing needs to be downloaded.
+    Without a manifest, only the "per_time" layout can be checked.  If so,
+    the reason is recorded in `metrics.work_avoided`.
+    """
+    zarr_manifest = get_manifest(s3)
+    if zarr_manifest is not None:
+        key = mo_message.manifest_key()
+        if key is not None and key in zarr_manifest:
+            _LOG.warning(
+                "Destination already written, according to the manifest: %s."
+                "  Not downloading.",
+                key,
+            )
+            if metrics is not None:
+                metrics.work_avoided = "manifest"
+            return True
+    elif ZARR_LAYOUT == "per_time":
+        full_zarr_filename = mo_message.zarr_filename(DEST.root, ZIP_ZARR_STORES)
+        if full_zarr_filename is not None and s3.exists(full_zarr_filename):
+            _LOG.warning(
+                "Destination already exists: %s.  Not downloading.",
+                full_zarr_filename,
+            )
+            if metrics is not None:
+                metrics.work_avoided = "destination_exists"
+            return True
+    return False
+
+
+def fetch_netcdf(mo_message, s3, metrics):
+    """Download the message's NetCDF file (or, in "ranged" mode, open it
+    for range requests).
+
+    Returns:
+      The NetCDF file, for `subset_and_save_data`, or None if the
+      destination already exists.
+    """
+    timer = Timer(metrics)
+    exists = destination_exists(mo_message, s3, metrics)
+    timer.tick("Checking destination", stage="check_destination")
+    if exists:
+        return None
+    if NETCDF_LOAD_MODE == "memory":
+        netcdf_file = mo_message.download_netcdf(NETCDF_SOURCE)
+        metrics.bytes_in = len(netcdf_file)
+        timer.tick("Downloading NetCDF file", stage="download")
+    elif NETCDF_LOAD_MODE == "ranged":
+        if NETCDF_SOURCE:
+            raise ValueError('NETCDF_SOURCE needs NETCDF_LOAD_MODE "memory"')
+        netcdf_file = mo_message.ranged_file()
+    else:
+        raise ValueError("Unrecognised NETCDF_LOAD_MODE: {}".format(NETCDF_LOAD_MODE))
+    return netcdf_file
+
+
+def load_subset_and_save_data(
+    mo_message, height_meters, s3, compression="archive", metrics=None, inference=True
+):
+    if metrics is None:
+        metrics = MessageMetrics.from_message(mo_message)
+    netcdf_file = fetch_netcdf(mo_message, s3, metrics)
+    if netcdf_file is None:
+        return metrics
+    return subset_and_save_data(
+        mo_message, netcdf_file, height_meters, s3, compression, metrics, inference
+    )
+
+
+def subset_and_save_data(
+    mo_message, netcdf_file, height_meters, s3, compression, metrics, inference=True
+):
+    """Subset the NetCDF file from `fetch_netcdf` and write it to Zarr."""
+    dataset = open_and_subset(mo_message, netcdf_file, height_meters, metrics)
+    del netcdf_file
+    return save_dataset(dataset, s3, compression, metrics, mo_message, inference)
+
+
+def open_and_subset(mo_message, netcdf_file, height_meters, metrics):
+    """Open the NetCDF file from `fetch_netcdf`, and load the subset."""
+    timer = Timer(metrics)
+    try:
+        # In "ranged" mode, the HDF5 chunks covering the subset are
+        # downloaded by `load()`, so downloads also take turns.
+        with _NETCDF_LOCK:
+            full_dataset = mo_message.load_netcdf(netcdf_file)
+            timer.tick("Opening xarray Dataset", stage="open")
+            try:
+                dataset = subset.subset(
+                    full_dataset, height_meters, **DEFAULT_GEO_BOUNDARY
+                )
+                dataset = dataset.load()
+            finally:
+                full_dataset.close()
+    finally:
+        if isinstance(netcdf_file, S3RangedFile):
+            metrics.bytes_in = netcdf_file.bytes_transferred
+            _LOG.info(
+                "Downloaded %.1f MB of %.1f MB using %d range requests."
+                " Peak RSS so far: %.1f MB",
+                netcdf_file.bytes_transferred / 1e6,
+                netcdf_file.size / 1e6,
+                netcdf_file.num_requests,
+                peak_rss_mb(),
+            )
+            netcdf_file.close()
+    timer.tick("Subsetting", stage="subset")
+    metrics.bytes_subset = dataset.nbytes
+    return dataset
+
+
+def save_dataset(dataset, s3, compression, metrics, mo_message, inference=True):
+    """Write the subset to Zarr, and run inference on it if needed (and
+    `inference` is True)."""
+    timer = Timer(metrics)
+    zarr_manifest = get_manifest(s3)
+    quantization = PARAMS_TO_COPY["quantization"][mo_message.message["name"]]
     try:
-        subset.write_zarr_to_s3(dataset, full_zarr_filename, s3)
+        if zarr_manifest is not None:
+            manifest_key = manifest.key_for_dataset(dataset)
+            if manifest_key in zarr_manifest:
+                raise subset.FileExistsError(
+                    "Destination already written, according to the manifest: {}".format(
+                        manifest_key
+                    )
+                )
+        if ZARR_LAYOUT == "per_time":
+            full_zarr_filename = subset.get_zarr_filename(
+                dataset, DEST.root, ZIP_ZARR_STORES
+            )
+            # Already checked by destination_exists, unless the model isn't
+            # in message.MODEL_NAMES.
+            check_exists = mo_message.zarr_filename(DEST.root, ZIP_ZARR_STORES) is None
+            if IO_MODE == "asyncio":
+                metrics.bytes_out = subset.write_zarr_to_s3_concurrently(
+                    dataset,
+                    full_zarr_filename,
+                    s3,
+                    check_exists=check_exists,
+                    max_concurrency=UPLOAD_CONCURRENCY,
+                    compression=compression,
+                    quantization=quantization,
+                )
+            else:
+                subset.write_zarr_to_s3(
+                    dataset,
+                    full_zarr_filename,
+                    s3,
+                    check_exists=check_exists,
+                    compression=compression,
+                    quantization=quantization,
+                )
+                metrics.bytes_out = s3.du(full_zarr_filename)
+        elif ZARR_LAYOUT == "per_run":
+            if ZIP_ZARR_STORES:
+                raise ValueError('ZIP_ZARR_STORES needs ZARR_LAYOUT "per_time"')
+            full_zarr_filename = subset.get_run_zarr_filename(dataset, DEST.root)
+            subset.write_zarr_region_to_s3(
+                dataset,
+                full_zarr_filename,
+                s3,
+                compression=compression,
+                quantization=quantization,
+            )
+        else:
+            raise ValueError("Unrecognised ZARR_LAYOUT: {}".format(ZARR_LAYOUT))
     except subset.FileExistsError as e:
         _LOG.warning(e)
     else:
-        timer.tick("Compressing & writing Zarr file to S3")
+        if zarr_manifest is not None:
+            zarr_manifest.add(manifest_key, full_zarr_filename)
+        # Chunks are compressed and uploaded concurrently, so these two
+        # stages are timed together.
+        timer.tick("Compressing & writing Zarr file to S3", stage="compress_upload")
         _LOG.info("SUCCESS! dest_url=%s", full_zarr_filename)
-        run_inference(dataset)
+        if inference and run_inference(dataset):
+            timer.tick("Running inference", stage="inference")
+    finally:
+        metrics.peak_rss_mb = peak_rss_mb()
+    return metrics
+
+
+# Messages processed successfully by this process.
+_RECENTLY_PROCESSED = message.RecentlySeen(RECENTLY_PROCESSED_MAX_SIZE)
+
+_MANIFEST: Optional[manifest.Manifest] = None
+_MANIFEST_PID: Optional[int] = None
+
+
+def get_manifest(s3) -> Optional[manifest.Manifest]:
+    """Return this process's manifest of written Zarr stores, or None if
+    MANIFEST_PATH isn't set.  An empty manifest is first rebuilt from a
+    listing of DEST."""
+    global _MANIFEST, _MANIFEST_PID
+    if not MANIFEST_PATH:
+        return None
+    # SQLite connections can't be shared with forked worker processes.
+    if _MANIFEST is None or _MANIFEST_PID != os.getpid():
+        _MANIFEST = manifest.Manifest(MANIFEST_PATH)
+        _MANIFEST_PID = os.getpid()
+        if not len(_MANIFEST):
+            _MANIFEST.rebuild(s3, DEST.root)
+    return _MANIFEST
 
 
 def delete_message(sqs, sqs_message):
@@ -111,78 +510,765 @@ def delete_message(sqs, sqs_message):
     sqs.delete_message(QueueUrl=SQS_URL, ReceiptHandle=receipt_handle)
 
 
-def run_inference(dataset):
+def delete_messages(sqs, sqs_messages, max_attempts=3):
+    """Delete messages using batch requests of up to 10 messages each.
+
+    Messages which fail to be deleted are retried up to `max_attempts`
+    times in total.  Messages which still can't be deleted will be
+    redelivered, so are only logged.
+    """
+    for batch_start in range(0, len(sqs_messages), SQS_MAX_BATCH_SIZE):
+        batch = sqs_messages[batch_start : batch_start + SQS_MAX_BATCH_SIZE]
+        entries = []
+        for i, sqs_message in enumerate(batch):
+            receipt_handle = sqs_message["ReceiptHandle"]
+            _LOG.info("Deleting message with ReceiptHandle=" + receipt_handle)
+            entries.append({"Id": str(i), "ReceiptHandle": receipt_handle})
+        for attempt in range(max_attempts):
+            response = sqs.delete_message_batch(QueueUrl=SQS_URL, Entries=entries)
+            failed_ids = {failure["Id"] for failure in response.get("Failed", [])}
+            entries = [entry for entry in entries if entry["Id"] in failed_ids]
+            if not entries:
+                break
+            _LOG.warning(
+                "Failed to delete %d messages (attempt %d/%d): %s",
+                len(entries),
+                attempt + 1,
+                max_attempts,
+                response["Failed"],
+            )
+
+
+def run_inference(dataset) -> bool:
+    """Returns True if inference was run for this dataset."""
     variable_name = subset.get_variable_name(dataset)
-    if variable_name != 'surface_downwelling_shortwave_flux_in_air':
+    if variable_name not in INFERENCE_VARIABLES:
         _LOG.info("Not running inference for variable %s", variable_name)
-        return
-    
+        return False
+
     _LOG.info("Starting inference for variable %s", variable_name)
-    
-    # Load model
-    model_df = load_model("model/predict_pv_yield_nwp.csv")
+    from metoffice_ec2 import predict
+
+    # Load model (cached until the file changes)
+    model = predict.MODEL_REGISTRY.get("model/predict_pv_yield_nwp.csv")
 
-    # predict_as_geojson
-    feature_collection = predict_as_geojson(dataset, model_df)
+    # Predict
+    predictions = predict.predict(dataset, model)
 
     # Save
     timestamp_now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
-    s3 = boto3.client('s3')
-    s3.put_object(
-        Bucket=PREDICTIONS_BUCKET,
-        Key=f'nwp/predictions_{timestamp_now}.geojson',
-        Body=geojson.dumps(feature_collection, indent=4)
-    )
-    _LOG.info("SUCCESS! Saved predictions to bucket %s", PREDICTIONS_BUCKET)
-
-
-def loop():
-    # Re-create `sqs` and `s3` objects on every loop iteration
-    # to prevent the script from using ever-increasing amounts of RAM!
-    sqs = boto3.client("sqs", region_name=REGION)
-    sqs_reply = sqs.receive_message(
-        WaitTimeSeconds=20,
-        QueueUrl=SQS_URL,
-        MaxNumberOfMessages=10,
-        AttributeNames=["ApproximateReceiveCount", "SentTimestamp"],
+    predictions_storage = storage.Storage(PREDICTIONS_URL)
+    fs = predictions_storage.filesystem()
+    for predictions_format in PREDICTIONS_FORMATS:
+        fs.pipe_file(
+            predictions_storage.path(
+                f"predictions_{timestamp_now}.{predictions_format}"
+            ),
+            serialise_predictions(predictions, predictions_format),
+        )
+    _LOG.info("SUCCESS! Saved predictions to %s", PREDICTIONS_URL)
+    return True
+
+
+def serialise_predictions(predictions: pd.DataFrame, predictions_format: str):
+    from metoffice_ec2 import predict
+
+    if predictions_format == "geojson":
+        return predict.dumps_geojson(predict.predictions_to_geojson(predictions))
+    elif predictions_format == "ndjson":
+        return predict.predictions_to_ndjson(predictions)
+    elif predictions_format == "parquet":
+        # Needs pyarrow or fastparquet.
+        buffer = io.BytesIO()
+        predictions.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+    raise ValueError("Unrecognised predictions format: {}".format(predictions_format))
+
+
+def new_dest_filesystem() -> fsspec.AbstractFileSystem:
+    """Returns a new filesystem for DEST, e.g. an S3FileSystem."""
+    return DEST.filesystem()
+
+
+def process_wanted_message(sqs_message, s3=None) -> MessageMetrics:
+    """Load, subset and save the NWP described by a wanted SQS message.
+
+    Args:
+      sqs_message: An AWS Simple Queue Service message.
+      s3: The filesystem for DEST.  If None, a new one is created.  Worker
+        processes must pass None because filesystem objects (e.g.
+        S3FileSystem) can't be shared between processes.
+
+    Returns:
+      The metrics measured while processing the message, for the caller
+      to record (worker processes can't record into the main process's
+      metrics.REGISTRY).
+    """
+    if s3 is None:
+        s3 = new_dest_filesystem()
+    mo_message = message.MetOfficeMessage(sqs_message)
+    _LOG.info("Message is wanted!  Loading NetCDF file...")
+    time_start = time.time()
+    try:
+        var_name = mo_message.message["name"]
+        height_meters = PARAMS_TO_COPY["height"][var_name]
+        compression = PARAMS_TO_COPY["compression"][var_name]
+        return load_subset_and_save_data(mo_message, height_meters, s3, compression)
+    finally:
+        time_end = time.time()
+        _LOG.info("Message finished. Took %d seconds", time_end - time_start)
+
+
+_EXECUTOR: Optional[Executor] = None
+
+
+def get_executor() -> Executor:
+    """Return the worker pool, creating it on first use."""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        if WORKER_TYPE == "process":
+            _EXECUTOR = ProcessPoolExecutor(max_workers=NUM_WORKERS)
+        elif WORKER_TYPE == "thread":
+            _EXECUTOR = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+        else:
+            raise ValueError("Unrecognised WORKER_TYPE: {}".format(WORKER_TYPE))
+    return _EXECUTOR
+
+
+def reset_executor():
+    """Discard the worker pool, e.g. because a worker process died."""
+    global _EXECUTOR
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = None
+
+
+_PROCESSING_TIMES: Optional[ProcessingTimes] = None
+
+
+def get_processing_times() -> ProcessingTimes:
+    """Return the processing times learned by this process, loaded from
+    PROCESSING_TIMES_PATH (if set) on first use."""
+    global _PROCESSING_TIMES
+    if _PROCESSING_TIMES is None:
+        if PROCESSING_TIMES_PATH:
+            _PROCESSING_TIMES = ProcessingTimes.load(PROCESSING_TIMES_PATH)
+        else:
+            _PROCESSING_TIMES = ProcessingTimes()
+    return _PROCESSING_TIMES
+
+
+def learn_processing_time(metrics: MessageMetrics):
+    """Learn from a successfully processed message, unless no work was
+    needed (e.g. because its Zarr store already existed)."""
+    if "compress_upload" in metrics.stage_secs:
+        get_processing_times().record(metrics.kind(), sum(metrics.stage_secs.values()))
+
+
+def message_kind(mo_message) -> str:
+    return MessageMetrics.from_message(mo_message).kind()
+
+
+def make_heartbeat(sqs) -> VisibilityHeartbeat:
+    return VisibilityHeartbeat(
+        sqs,
+        SQS_URL,
+        VISIBILITY_TIMEOUT_SECS,
+        HEARTBEAT_INTERVAL_SECS,
+        processing_times=get_processing_times(),
+        safety_factor=VISIBILITY_SAFETY_FACTOR,
+        registry=REGISTRY,
     )
 
-    if "Messages" not in sqs_reply:
-        _LOG.info("No more SQS messages!")
-        return
 
-    sqs_messages = sqs_reply["Messages"]
-    num_messages = len(sqs_messages)
-    _LOG.debug("{:d} sqs messages received".format(num_messages))
-    if not sqs_messages:
-        _LOG.info("No more SQS messages!")
-        return
+def classify_messages(sqs, sqs_messages):
+    """Returns the wanted messages.  Unwanted messages, and duplicates of
+    recently processed messages or of other messages in the batch, are
+    deleted first.
 
-    s3 = s3fs.S3FileSystem(default_fill_cache=False, default_cache_type="none")
-    for i, sqs_message in enumerate(sqs_messages):
-        mo_message = message.MetOfficeMessage(sqs_message)
+    A duplicate in the batch is safe to delete before the message it
+    duplicates has been processed: if that fails, it is redelivered.
+    """
+    wanted_messages, unwanted_messages = message.classify_messages(
+        sqs_messages, WANTED_PARAMS
+    )
+    in_batch = message.RecentlySeen(len(sqs_messages))
+    duplicates = []
+    for mo_message in wanted_messages:
+        labels = MessageMetrics.from_message(mo_message).labels
+        if mo_message.sqs_approx_receive_count() > 1:
+            REGISTRY.increment("redelivered_messages_total", **labels)
+        if mo_message in _RECENTLY_PROCESSED:
+            reason = "recently_processed"
+        elif mo_message in in_batch:
+            reason = "same_batch"
+        else:
+            in_batch.add(mo_message)
+            continue
+        duplicates.append(mo_message)
+        REGISTRY.increment("duplicate_work_avoided_total", **labels, reason=reason)
+    wanted_messages = [m for m in wanted_messages if m not in duplicates]
+    num_messages = len(sqs_messages)
+    for i, mo_message in enumerate(unwanted_messages + duplicates + wanted_messages):
         _LOG.info("Loading SQS message %d/%d: %s", i + 1, num_messages, mo_message)
+        if i < len(unwanted_messages):
+            _LOG.info("Message not wanted.")
+        elif i < len(unwanted_messages) + len(duplicates):
+            _LOG.info(
+                "Message is a duplicate of a recently processed message, or of"
+                " another message in this batch."
+            )
+    unwanted_messages += duplicates
+    delete_messages(sqs, [mo_message.sqs_message for mo_message in unwanted_messages])
+    if MESSAGE_PRIORITIES and len(wanted_messages) > 1:
+        wanted_messages = message.prioritise(
+            wanted_messages, MESSAGE_PRIORITIES, INFERENCE_VARIABLES
+        )
+        _LOG.info(
+            "Processing wanted messages in order of %s: %s",
+            ", ".join(MESSAGE_PRIORITIES),
+            ", ".join(mo_message.message["name"] for mo_message in wanted_messages),
+        )
+    return wanted_messages
+
+
+def process_messages_serially(sqs, sqs_messages, s3):
+    with make_heartbeat(sqs) as heartbeat:
+        for mo_message in classify_messages(sqs, sqs_messages):
+            sqs_message = mo_message.sqs_message
+            heartbeat.add(sqs_message["ReceiptHandle"], message_kind(mo_message))
+            try:
+                metrics = process_wanted_message(sqs_message, s3)
+            except Exception as e:
+                _LOG.exception(e)
+                REGISTRY.record(MessageMetrics.from_message(mo_message), False)
+            else:
+                REGISTRY.record(metrics)
+                learn_processing_time(metrics)
+                _RECENTLY_PROCESSED.add(mo_message)
+                delete_message(sqs, sqs_message)
+            finally:
+                heartbeat.remove(sqs_message["ReceiptHandle"])
+
+
+def process_messages_concurrently(sqs, sqs_messages, s3):
+    """Process wanted messages in the worker pool.
+
+    Each message is deleted as soon as it has been processed successfully.
+    Messages are only submitted to the pool while the summed size of
+    in-flight NetCDF files is below MAX_IN_FLIGHT_MB.  The visibility
+    timeouts of all wanted messages are extended until they finish, so
+    they can't be redelivered while they wait or while they're processed.
+    """
+    # S3FileSystem objects can be shared between threads but not processes.
+    worker_s3 = s3 if WORKER_TYPE == "thread" else None
+    budget = MemoryBudget(MAX_IN_FLIGHT_MB)
+    with make_heartbeat(sqs) as heartbeat:
+        wanted_messages = classify_messages(sqs, sqs_messages)
+        for mo_message in wanted_messages:
+            heartbeat.add(
+                mo_message.sqs_message["ReceiptHandle"], message_kind(mo_message)
+            )
+
+        # Released once for every wanted message which has been dealt with.
+        finished = threading.Semaphore(0)
 
-        if mo_message.is_wanted(PARAMS_TO_COPY):
-            _LOG.info("Message is wanted!  Loading NetCDF file...")
-            time_start = time.time()
-            var_name = mo_message.message["name"]
-            height_meters = PARAMS_TO_COPY["height"][var_name]
+        def on_done(future, mo_message):
+            sqs_message = mo_message.sqs_message
             try:
-                load_subset_and_save_data(mo_message, height_meters, s3)
+                metrics = future.result()
+            except BrokenProcessPool as e:
+                _LOG.exception(e)
+                reset_executor()
+                REGISTRY.record(MessageMetrics.from_message(mo_message), False)
             except Exception as e:
                 _LOG.exception(e)
+                REGISTRY.record(MessageMetrics.from_message(mo_message), False)
             else:
+                REGISTRY.record(metrics)
+                learn_processing_time(metrics)
+                _RECENTLY_PROCESSED.add(mo_message)
                 delete_message(sqs, sqs_message)
+            finally:
+                heartbeat.remove(sqs_message["ReceiptHandle"])
+                budget.release(mo_message.object_size_mb())
+                finished.release()
+
+        for mo_message in wanted_messages:
+            budget.acquire(mo_message.object_size_mb())
+            try:
+                future = get_executor().submit(
+                    process_wanted_message, mo_message.sqs_message, worker_s3
+                )
+            except BrokenProcessPool as e:
+                _LOG.exception(e)
+                reset_executor()
+                heartbeat.remove(mo_message.sqs_message["ReceiptHandle"])
+                budget.release(mo_message.object_size_mb())
+                finished.release()
+            else:
+                future.add_done_callback(
+                    lambda future, mo_message=mo_message: on_done(future, mo_message)
+                )
+
+        for _ in wanted_messages:
+            finished.acquire()
+
 
-            time_end = time.time()
-            _LOG.info("Message finished. Took %d seconds", time_end - time_start)
+def process_messages_asyncio(sqs, sqs_messages, s3):
+    """Process wanted messages one at a time, while downloading the NetCDF
+    files of the next PREFETCH_MESSAGES - 1 messages.
+
+    At most PREFETCH_MESSAGES NetCDF files are held in memory at once.
+    """
+    with make_heartbeat(sqs) as heartbeat:
+        wanted_messages = classify_messages(sqs, sqs_messages)
+        for mo_message in wanted_messages:
+            heartbeat.add(
+                mo_message.sqs_message["ReceiptHandle"], message_kind(mo_message)
+            )
+        asyncio.run(_process_wanted_messages_async(sqs, wanted_messages, s3, heartbeat))
+
+
+async def _process_wanted_messages_async(sqs, wanted_messages, s3, heartbeat):
+    # Each message holds a slot from before its download starts until it
+    # has been processed.  Waiters get slots in order, so messages are
+    # processed in the order they were received.
+    slots = asyncio.Semaphore(PREFETCH_MESSAGES)
+    # Subsetting and compressing use all cores, so only one message at once.
+    cpu_lock = asyncio.Lock()
+
+    async def fetch_subset_and_save(mo_message, metrics, executor):
+        netcdf_file = await aio.run_blocking(
+            executor, fetch_netcdf, mo_message, s3, metrics
+        )
+        if netcdf_file is None:
+            return
+        var_name = mo_message.message["name"]
+        async with cpu_lock:
+            await aio.run_blocking(
+                executor,
+                subset_and_save_data,
+                mo_message,
+                netcdf_file,
+                PARAMS_TO_COPY["height"][var_name],
+                s3,
+                PARAMS_TO_COPY["compression"][var_name],
+                metrics,
+            )
+
+    async def process(mo_message, executor):
+        sqs_message = mo_message.sqs_message
+        metrics = MessageMetrics.from_message(mo_message)
+        try:
+            async with slots:
+                _LOG.info("Message is wanted!  Loading NetCDF file...")
+                time_start = time.time()
+                try:
+                    await fetch_subset_and_save(mo_message, metrics, executor)
+                finally:
+                    time_end = time.time()
+                    _LOG.info(
+                        "Message finished. Took %d seconds", time_end - time_start
+                    )
+        except Exception as e:
+            _LOG.exception(e)
+            REGISTRY.record(metrics, False)
         else:
-            _LOG.info("Message not wanted.")
-            delete_message(sqs, sqs_message)
+            REGISTRY.record(metrics)
+            learn_processing_time(metrics)
+            _RECENTLY_PROCESSED.add(mo_message)
+            await aio.run_blocking(executor, delete_message, sqs, sqs_message)
+        finally:
+            heartbeat.remove(sqs_message["ReceiptHandle"])
 
+    # One thread per slot, plus one for deleting messages.
+    with ThreadPoolExecutor(max_workers=PREFETCH_MESSAGES + 1) as executor:
+        await asyncio.gather(*(process(m, executor) for m in wanted_messages))
 
-if __name__ == "__main__":
-    _LOG.info("Starting scripts/ec2.py loop...")
+
+def process_messages_pipeline(sqs, sqs_messages, s3):
+    """Process wanted messages in a pipeline.Pipeline, so that one message
+    can be downloaded while another is subset and a third is saved.
+
+    Compression and upload are a single "save" stage, because
+    `subset.write_zarr` already uploads each chunk as soon as it has been
+    compressed.  The utilization of each stage is recorded in REGISTRY.
+    """
+    all_metrics = {}
+    time_starts = {}
+
+    def download(mo_message, _):
+        _LOG.info("Message is wanted!  Loading NetCDF file...")
+        time_starts[mo_message] = time.time()
+        all_metrics[mo_message] = MessageMetrics.from_message(mo_message)
+        return fetch_netcdf(mo_message, s3, all_metrics[mo_message])
+
+    def open_and_subset_stage(mo_message, netcdf_file):
+        height_meters = PARAMS_TO_COPY["height"][mo_message.message["name"]]
+        return open_and_subset(
+            mo_message, netcdf_file, height_meters, all_metrics[mo_message]
+        )
+
+    def save(mo_message, dataset):
+        compression = PARAMS_TO_COPY["compression"][mo_message.message["name"]]
+        return save_dataset(
+            dataset, s3, compression, all_metrics[mo_message], mo_message
+        )
+
+    def on_done(mo_message, _, error):
+        sqs_message = mo_message.sqs_message
+        try:
+            _LOG.info(
+                "Message finished. Took %d seconds",
+                time.time() - time_starts.pop(mo_message),
+            )
+            metrics = all_metrics.pop(mo_message)
+            if error is not None:
+                _LOG.exception(error, exc_info=error)
+                REGISTRY.record(metrics, False)
+            else:
+                REGISTRY.record(metrics)
+                learn_processing_time(metrics)
+                _RECENTLY_PROCESSED.add(mo_message)
+                delete_message(sqs, sqs_message)
+        finally:
+            heartbeat.remove(sqs_message["ReceiptHandle"])
+
+    nwp_pipeline = pipeline.Pipeline(
+        [
+            pipeline.Stage("download", download, PIPELINE_DOWNLOAD_WORKERS),
+            pipeline.Stage("subset", open_and_subset_stage),
+            pipeline.Stage("save", save),
+        ],
+        queue_size=PIPELINE_QUEUE_SIZE,
+        budget=MemoryBudget(MAX_IN_FLIGHT_MB),
+        size_mb=lambda mo_message: mo_message.object_size_mb(),
+    )
+    with make_heartbeat(sqs) as heartbeat:
+        wanted_messages = classify_messages(sqs, sqs_messages)
+        for mo_message in wanted_messages:
+            heartbeat.add(
+                mo_message.sqs_message["ReceiptHandle"], message_kind(mo_message)
+            )
+        nwp_pipeline.run(wanted_messages, on_done)
+    for stage_name, utilization in nwp_pipeline.utilization().items():
+        REGISTRY.set_gauge("pipeline_stage_utilization", utilization, stage=stage_name)
+    _LOG.info("Pipeline stage utilization: %s", nwp_pipeline.utilization())
+
+
+_SQS = None
+_S3: Optional[fsspec.AbstractFileSystem] = None
+_NUM_CLIENT_USES = 0
+
+
+def get_clients():
+    """Return the SQS client and the filesystem for DEST, re-creating them
+    every CLIENT_RECYCLE_ITERATIONS calls.
+
+    Re-using them keeps their connection pools warm.  The filesystem's
+    directory listing cache is cleared on every call, and both objects
+    are re-created periodically, so their memory use stays bounded.
+    """
+    global _SQS, _S3, _NUM_CLIENT_USES
+    if _SQS is None or _NUM_CLIENT_USES >= CLIENT_RECYCLE_ITERATIONS:
+        _SQS = boto3.client("sqs", region_name=REGION)
+        _S3 = new_dest_filesystem()
+        _NUM_CLIENT_USES = 0
+    else:
+        _S3.invalidate_cache()
+    _NUM_CLIENT_USES += 1
+    return _SQS, _S3
+
+
+def reset_clients():
+    global _SQS, _S3
+    _SQS = _S3 = None
+
+
+def receive_messages(sqs):
+    """Receive up to MAX_RECEIVES_PER_LOOP batches of messages.
+
+    The first receive long-polls for RECEIVE_WAIT_TIME_SECS.  Further
+    receives only happen while the queue keeps returning full batches,
+    and don't wait.
+    """
+    sqs_messages = []
+    for i in range(MAX_RECEIVES_PER_LOOP):
+        time_start = time.time()
+        sqs_reply = sqs.receive_message(
+            WaitTimeSeconds=RECEIVE_WAIT_TIME_SECS if i == 0 else 0,
+            QueueUrl=SQS_URL,
+            MaxNumberOfMessages=SQS_MAX_BATCH_SIZE,
+            VisibilityTimeout=VISIBILITY_TIMEOUT_SECS,
+            AttributeNames=["ApproximateReceiveCount", "SentTimestamp"],
+        )
+        REGISTRY.observe("receive", time.time() - time_start)
+        batch = sqs_reply.get("Messages", [])
+        sqs_messages.extend(batch)
+        if len(batch) < SQS_MAX_BATCH_SIZE:
+            break
+    return sqs_messages
+
+
+def loop() -> int:
+    """Receive and process one batch of messages.
+
+    Returns:
+      The number of messages received.
+    """
+    sqs, s3 = get_clients()
+    sqs_messages = receive_messages(sqs)
+    num_messages = len(sqs_messages)
+    _LOG.debug("{:d} sqs messages received".format(num_messages))
+    if not sqs_messages:
+        _LOG.info("No more SQS messages!")
+        return 0
+
+    if NUM_WORKERS > 1:
+        process_messages_concurrently(sqs, sqs_messages, s3)
+    elif IO_MODE == "asyncio":
+        process_messages_asyncio(sqs, sqs_messages, s3)
+    elif IO_MODE == "pipeline":
+        process_messages_pipeline(sqs, sqs_messages, s3)
+    elif IO_MODE == "blocking":
+        process_messages_serially(sqs, sqs_messages, s3)
+    else:
+        raise ValueError("Unrecognised IO_MODE: {}".format(IO_MODE))
+    if PROCESSING_TIMES_PATH:
+        try:
+            get_processing_times().save(PROCESSING_TIMES_PATH)
+        except OSError as e:
+            _LOG.warning("Failed to save processing times: %s", e)
+    return num_messages
+
+
+def start_metrics():
+    if METRICS_PORT:
+        REGISTRY.serve(int(METRICS_PORT))
+    if METRICS_FILE:
+        REGISTRY.flush_periodically(METRICS_FILE, METRICS_FLUSH_INTERVAL_SECS)
+
+
+def run_loops(max_messages: int = 0, max_rss_mb: float = 0):
+    """Call `loop()` until `max_messages` messages have been received, or
+    the peak RSS reaches `max_rss_mb`.  Zero means no limit."""
+    profiler = MemoryProfiler(MEMORY_PROFILE_TOP_N) if MEMORY_PROFILE_TOP_N else None
+    num_messages = 0
     while True:
-        loop()
+        num_messages += loop()
+        if profiler is not None:
+            profiler.log_top_allocations()
+        if max_messages and num_messages >= max_messages:
+            _LOG.info("Received %d messages.", num_messages)
+            return
+        if max_rss_mb and peak_rss_mb() >= max_rss_mb:
+            _LOG.info("Peak RSS is %.1f MB.", peak_rss_mb())
+            return
+
+
+def _run_child():
+    start_metrics()
+    run_loops(RECYCLE_AFTER_MESSAGES, RECYCLE_AFTER_RSS_MB)
+
+
+def supervise(num_children: Optional[int] = None):
+    """Process messages in a child process, which is replaced by a fresh
+    one after RECYCLE_AFTER_MESSAGES messages or RECYCLE_AFTER_RSS_MB of
+    peak RSS, or if it dies.  The supervisor itself stays small, so
+    memory leaks can't take the service down.
+
+    Args:
+      num_children: Stop after this many child processes.  If None, run
+        forever.
+    """
+    num_started = 0
+    while num_children is None or num_started < num_children:
+        child = multiprocessing.Process(target=_run_child, name="ec2-worker")
+        child.start()
+        num_started += 1
+        _LOG.info("Started worker process %d (pid %d)", num_started, child.pid)
+        child.join()
+        if child.exitcode == 0:
+            _LOG.info("Recycling worker process (pid %d)", child.pid)
+        else:
+            _LOG.error(
+                "Worker process (pid %d) died with exit code %d",
+                child.pid,
+                child.exitcode,
+            )
+            time.sleep(CHILD_RESTART_DELAY_SECS)
+
+
+def backfill_message(sqs_message) -> MessageMetrics:
+    """Load, subset and save the NWP described by an archived message.
+    Predictions aren't made from backfilled data."""
+    mo_message = message.MetOfficeMessage(sqs_message)
+    var_name = mo_message.message["name"]
+    return load_subset_and_save_data(
+        mo_message,
+        PARAMS_TO_COPY["height"][var_name],
+        new_dest_filesystem(),
+        PARAMS_TO_COPY["compression"][var_name],
+        inference=False,
+    )
+
+
+def run_backfill(
+    archive_paths: List[str],
+    checkpoint_path: Optional[str] = None,
+    num_workers: Optional[int] = None,
+) -> Dict[str, float]:
+    """Process archived notifications, e.g. to replay data which was lost,
+    as fast as possible.
+
+    Unwanted messages and duplicates (of the same NetCDF file or Zarr
+    store) are skipped, as are messages whose Zarr store already exists
+    (checked by the workers, as in `loop`).  The throughput is logged every
+    BACKFILL_REPORT_INTERVAL_SECS.
+
+    The worker processes are started with the "spawn" method, so they
+    inherit no threads (e.g. dask's thread pools) or HDF5 state, which
+    means they only see configuration set by environment variables.  If a
+    worker process dies, the backfill stops: run it again to resume.
+
+    Args:
+      archive_paths: See `backfill.read_archive`.
+      checkpoint_path: If given, each message processed is recorded in this
+        file, and messages recorded by an earlier backfill are skipped.
+        Failed messages aren't recorded, so are retried.
+      num_workers: Number of worker processes.  Defaults to the number of
+        CPUs.  1 means process messages serially, in this process.
+
+    Returns:
+      The number of messages with each outcome, and the throughput: see
+      `backfill.Throughput.summary`.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    checkpoint = backfill.Checkpoint(checkpoint_path)
+    throughput = backfill.Throughput()
+    seen = set()
+    last_report_time = time.time()
+    _LOG.info(
+        "Backfilling from %s with %d workers.  %d messages already done.",
+        archive_paths,
+        num_workers,
+        len(checkpoint),
+    )
+
+    def wanted_messages():
+        for sqs_message in backfill.read_archive(archive_paths):
+            mo_message = message.MetOfficeMessage(sqs_message)
+            source_url = mo_message.source_url()
+            ids = {source_url, mo_message.zarr_filename(DEST.root, ZIP_ZARR_STORES)} - {
+                None
+            }
+            if not ids.isdisjoint(seen):
+                throughput.add("duplicate")
+                continue
+            seen.update(ids)
+            if source_url in checkpoint:
+                throughput.add("checkpointed")
+            elif not mo_message.is_wanted(WANTED_PARAMS):
+                throughput.add("unwanted")
+            else:
+                yield mo_message
+
+    def finish(mo_message, metrics, error):
+        nonlocal last_report_time
+        if error is not None:
+            _LOG.error("Failed to backfill %s: %r", mo_message.source_url(), error)
+            REGISTRY.record(MessageMetrics.from_message(mo_message), False)
+            throughput.add("failed")
+        else:
+            REGISTRY.record(metrics)
+            written = "compress_upload" in metrics.stage_secs
+            throughput.add(
+                "written" if written else "existing",
+                metrics.bytes_in,
+                metrics.bytes_out,
+            )
+            checkpoint.add(mo_message.source_url())
+        if time.time() - last_report_time >= BACKFILL_REPORT_INTERVAL_SECS:
+            _LOG.info("Backfill progress: %s", throughput)
+            last_report_time = time.time()
+
+    try:
+        if num_workers == 1:
+            for mo_message in wanted_messages():
+                try:
+                    metrics = backfill_message(mo_message.sqs_message)
+                except Exception as e:
+                    _LOG.exception(e)
+                    finish(mo_message, None, e)
+                else:
+                    finish(mo_message, metrics, None)
+        else:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(num_workers, mp_context=context) as executor:
+                futures = {}
+
+                def finish_futures(done):
+                    for future in done:
+                        mo_message = futures.pop(future)
+                        error = future.exception()
+                        metrics = None if error is not None else future.result()
+                        finish(mo_message, metrics, error)
+
+                for mo_message in wanted_messages():
+                    # Only read ahead of the workers a little.
+                    if len(futures) >= 2 * num_workers:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        finish_futures(done)
+                    future = executor.submit(backfill_message, mo_message.sqs_message)
+                    futures[future] = mo_message
+                finish_futures(wait(futures).done)
+    finally:
+        checkpoint.close()
+    _LOG.info("Backfill finished: %s", throughput)
+    return throughput.summary()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Process Met Office notifications from SQS until stopped,"
+        " or backfill archived notifications.  Configured with environment"
+        " variables: see README.md."
+    )
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    backfill_parser = commands.add_parser(
+        "backfill", help="Process archived notifications, rather than SQS."
+    )
+    backfill_parser.add_argument(
+        "archives",
+        nargs="+",
+        metavar="ARCHIVE",
+        help="JSON files of SNS notifications or SQS messages (like those in"
+        " data/sns_messages and data/sqs_messages), or directories of them.",
+    )
+    backfill_parser.add_argument(
+        "--checkpoint",
+        help="File recording the messages processed, to resume from.",
+    )
+    backfill_parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes.  Defaults to the number of CPUs.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill":
+        start_metrics()
+        run_backfill(args.archives, args.checkpoint, args.workers)
+        return
+    _LOG.info("Starting scripts/ec2.py loop...")
+    if RECYCLE_AFTER_MESSAGES or RECYCLE_AFTER_RSS_MB:
+        supervise()
+    else:
+        start_metrics()
+        run_loops()
+
+
+if __name__ == "__main__":
+    main()
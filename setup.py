@@ -3,4 +3,7 @@ from setuptools import find_packages, setup
 setup(
     name='metoffice_ec2',
     version='1.5.0',
-    packages=find_packages())
+    packages=find_packages(),
+    entry_points={
+        'console_scripts': ['metoffice_ec2=metoffice_ec2.cli:main'],
+    })